@@ -0,0 +1,102 @@
+import app
+from models import *
+import pandas as pd
+import argparse
+import os
+import sys
+import logging
+import datetime
+
+import annotation_types
+from annotation_ingest import copy_gene_annotation_file
+from bulk_copy import defer_indexes, restore_indexes, BULK_LOAD_TABLES
+from gene_count_ingest import copy_gene_counts
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+def main(args):
+    # connect to database
+    session = app.db.session()
+
+    annotation_type = annotation_types.annotation_type(args.annotation_type)
+    annotation_class = annotation_type.annotation_class
+
+    if args.bulk_load:
+        logging.info("Dropping indexes and constraints for the bulk load")
+        deferred_indexes = defer_indexes(session, BULK_LOAD_TABLES)
+
+    # find the reference assembly
+    ref_assemblies = ReferenceAssembly.query.filter_by(name=str(args.reference_assembly)).all()
+    assert len(ref_assemblies) == 1
+    ref_assembly = ref_assemblies[0]
+
+    if args.annotation_info:
+        if annotation_class.query.first() is not None:
+            logging.info("The {} annotation info is already in the database".format(args.annotation_type))
+        else:
+            logging.info("Adding all {} annotation info".format(args.annotation_type))
+            annotation_types.copy_catalogue(session, args.annotation_type, args.annotation_info)
+            session.commit()
+
+    # Only the annotations of this type, which are the ones the rpkm table needs updating for
+    annotation_ids = dict( session.query(annotation_class.type_identifier, annotation_class.id).all() )
+    logging.info("{} {} annotations in the database".format(len(annotation_ids), args.annotation_type))
+
+    logging.info("Adding annotation source")
+    annotation_source_info = pd.read_table(args.annotation_source_info, sep=',', header=None, names=["annotation_type", "db_version", "algorithm", "algorithm_parameters"], index_col = 0)
+    row = annotation_source_info.loc[args.annotation_type]
+    annotation_source = AnnotationSource(args.annotation_type, row.db_version, row.algorithm, row.algorithm_parameters)
+    session.add(annotation_source)
+    session.flush()
+
+    logging.info("Adding genes with {} annotations".format(args.annotation_type))
+    commited_genes = dict( session.query(Gene.name, Gene.id).all() )
+    new_gene_names = copy_gene_annotation_file(session, args.gene_annotations, commited_genes,
+            annotation_ids, annotation_source.id, ref_assembly.id)
+    session.commit()
+    logging.info("{} genes present in database".format(len(commited_genes.keys())))
+
+    if args.gene_counts:
+        # Stream the gene count matrix into the database a chunk of genes at a time,
+        # only the genes added here need their counts
+        logging.info("Start adding gene counts for {} new genes".format(len(new_gene_names)))
+        new_gene_ids = dict((name, commited_genes[name]) for name in new_gene_names)
+
+        all_samples = {}
+        for sample in session.query(Sample).all():
+            all_samples[sample.scilifelab_code] = sample
+
+        nr_gene_counts = copy_gene_counts(session, args.gene_counts, new_gene_ids, all_samples)
+        logging.info("Added {} gene counts".format(nr_gene_counts))
+        session.commit()
+
+    if args.bulk_load:
+        logging.info("Rebuilding indexes and constraints")
+        restore_indexes(session, deferred_indexes)
+
+    if args.gene_counts and GeneCountVectorSample.in_use():
+        # The new genes also need vectors, or they are missing when the
+        # gene counts are read from the vectors
+        nr_vectors = GeneCountVector.add_genes(new_gene_ids.values())
+        logging.info("Added {} gene count vectors".format(nr_vectors))
+        session.commit()
+
+    # The new genes have no taxonomy, so only the rows of the rpkm table
+    # for the annotations of this type change
+    logging.info("Updating the rpkm table for the {} annotations".format(args.annotation_type))
+    RpkmTable.update_annotations(list(annotation_ids.values()))
+    session.commit()
+    logging.info("Finished!")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Adds the annotations of one annotation type, and the genes annotated with it, to a populated database")
+    parser.add_argument("--annotation_type", required=True, choices=list(annotation_types.ANNOTATION_TYPES.keys()), help="The annotation type, as named in the annotation source info file")
+    parser.add_argument("--annotation_source_info", help="A csv file with all the annotation source info.")
+    parser.add_argument("--annotation_info", help="A tsv file with all the possible annotations of the type, skipped if they are already in the database")
+    parser.add_argument("--gene_annotations", help="A tsv file with all the gene annotations of the type")
+    parser.add_argument("--reference_assembly", help="Name of the reference assembly that the genes belong to")
+    parser.add_argument("--gene_counts", help="The gene counts, probably for all samples and sample sets, needed for the genes that are new to the database")
+    parser.add_argument("--bulk_load", action="store_true", help="Drop the indexes and constraints of the gene, gene annotation and gene count tables while loading and rebuild them afterwards")
+    args = parser.parse_args()
+
+    main(args)
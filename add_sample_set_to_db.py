@@ -7,7 +7,8 @@ import sys
 import logging
 import datetime
 
-from materialized_view_factory import refresh_all_mat_views
+from bulk_copy import defer_indexes, restore_indexes
+from gene_count_ingest import copy_gene_counts, copy_gene_count_vectors
 
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
 
@@ -15,6 +16,10 @@ def main(args):
     # connect to database
     session = app.db.session()
 
+    if args.bulk_load:
+        logging.info("Dropping indexes and constraints for the bulk load")
+        deferred_indexes = defer_indexes(session, ['gene_count'])
+
     logging.info("Reading sample information")
     # Add all samples from the sample info file
     sample_info = pd.read_table(args.sample_info, sep=',', index_col=0)
@@ -23,6 +28,12 @@ def main(args):
         if len(SampleSet.query.filter_by(name=sample_set_name).all()) > 0:
             ss = SampleSet.query.filter_by(name=sample_set_name).first()
             if args.force:
+                # Dropping the partition removes all gene counts for the sample set at once
+                GeneCount.drop_partition(ss.id)
+                sample_ids = [sample.id for sample in ss.samples]
+                delete_sample_aggregates(sample_ids)
+                GeneCountVectorSample.query.filter(GeneCountVectorSample.sample_id.in_(sample_ids)).\
+                        delete(synchronize_session=False)
                 for sample in ss.samples:
                     session.delete(sample)
                 session.delete(ss)
@@ -79,55 +90,39 @@ def main(args):
             if meta_category in ['Latitude', 'Longitude', 'Collection date', 'Collection time']:
                 continue
             if meta_data[meta_category] is not None:
-                sample_properties.append(SampleProperty(meta_category, meta_data[meta_category], default_units[meta_category], all_samples[sample_id]))
+                sample_properties.append((meta_category, meta_data[meta_category], default_units[meta_category], sample_id))
+
+    session.add_all(list(sample_sets.values()) + list(all_samples.values()) + time_places)
+    session.flush()
 
-    session.add_all(list(sample_sets.values()) + list(all_samples.values()) + time_places + sample_properties)
+    logging.info("Adding {} sample properties".format(len(sample_properties)))
+    sample_properties = pd.DataFrame(sample_properties, columns=['name', 'value', 'unit', 'scilifelab_code'])
+    sample_properties['sample_id'] = sample_properties['scilifelab_code'].map(
+            dict((code, sample.id) for code, sample in all_samples.items()))
+    SampleProperty.copy_properties(session, sample_properties)
 
     logging.info("Commiting everything except gene counts")
     session.commit()
 
     commited_genes = dict( session.query(Gene.name, Gene.id).all() )
 
-    # Fetch each gene from the gene count file and create the corresponding gene count
+    # Stream the gene count matrix into the database a chunk of genes at a time
     logging.info("Starting with gene counts")
-    gene_counts = pd.read_table(args.gene_counts, index_col=0)
-    total_gene_count_len = len(gene_counts)
-    val_cols = gene_counts.columns
-    nr_columns = len(val_cols)
-
-    filtered_gene_counts = gene_counts[ gene_counts.index.isin(commited_genes.keys()) ].copy()
-    filtered_gene_counts['gene_name'] = filtered_gene_counts.index
-    filtered_gene_counts['gene_id'] = filtered_gene_counts['gene_name'].apply(lambda x: commited_genes[x])
-
-    all_sample_ids = dict((sample_name, sample.id) for sample_name, sample in all_samples.items())
-    filtered_gene_counts.rename(columns=all_sample_ids, inplace=True)
-
-    sample_id_cols = filtered_gene_counts.columns.tolist()
-    sample_id_cols.remove('gene_id')
-    sample_id_cols.remove('gene_name')
-    sample_id_cols.remove('gene_length')
+    if args.gene_count_vectors:
+        logging.info("Adding gene count vectors")
+        copy_gene_count_vectors(args.gene_counts, commited_genes, all_samples)
 
-    filtered_gene_counts.index = filtered_gene_counts['gene_id']
-    filtered_gene_counts = pd.DataFrame(filtered_gene_counts[sample_id_cols].stack())
-    filtered_gene_counts.reset_index(inplace=True)
-    filtered_gene_counts.columns = ['gene_id', 'sample_id', 'rpkm']
-
-    tot_nr_samples = len(all_samples.values())
     logging.info("Start adding gene counts")
-
-    for i, sample_t in enumerate(filtered_gene_counts.groupby('sample_id')):
-        sample, sample_df = sample_t
-        with open(args.tmp_file, 'w') as gene_counts_file:
-            sample_df.to_csv(gene_counts_file, index=False, header=False)
-
-        logging.info("Adding gene counts from file. Sample {}/{}".format(i+1, tot_nr_samples))
-        session.execute("COPY gene_count (gene_id, sample_id, rpkm) FROM '{}' WITH CSV;".format(args.tmp_file))
-
-    logging.info("{} out of {} are annotated genes".format(len(filtered_gene_counts), total_gene_count_len))
+    nr_gene_counts = copy_gene_counts(session, args.gene_counts, commited_genes, all_samples)
+    logging.info("Added {} gene counts".format(nr_gene_counts))
     session.commit()
 
-    logging.info("Refreshing materialized view")
-    refresh_all_mat_views()
+    if args.bulk_load:
+        logging.info("Rebuilding indexes and constraints")
+        restore_indexes(session, deferred_indexes)
+
+    logging.info("Updating the rpkm tables for the new samples")
+    update_sample_aggregates([sample.id for sample in all_samples.values()])
     session.commit()
     logging.info("Finished!")
 
@@ -136,8 +131,9 @@ if __name__ == '__main__':
     parser.add_argument("--sample_info", help="A csv file with all the sample information.")
     parser.add_argument("--gene_counts", help="A tsv file with each sample as a column containing all the gene counts")
     parser.add_argument("--metadata_reference", help="A tsv file with which metadata parameters that are supposed to be added")
-    parser.add_argument("--tmp_file", help="A file that will be used to import gene counts to postgres")
+    parser.add_argument("--gene_count_vectors", action="store_true", help="Also store the gene counts as one vector per gene")
     parser.add_argument("--force", action="store_true", help="Remove any sample set and samples with the same names already existing in the database")
+    parser.add_argument("--bulk_load", action="store_true", help="Drop the indexes and constraints of the gene count table while loading and rebuild them afterwards")
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,146 @@
+"""Ingest of gene annotation files (all.<type>.standardized.tsv).
+
+Each file has one row per gene annotation, with the gene name, the type
+identifier of the annotation, the e-value and the score.
+
+copy_gene_annotation_file adds one file in the transaction of the
+session. copy_gene_annotations parses several files in a pool of
+processes, in two rounds:
+
+1. The gene names of every file are read, so that the genes missing from
+   the database can be created in a single copy.
+2. Each file is parsed again, mapped to gene and annotation ids and
+   copied into gene_annotation by its worker, over a connection of its
+   own.
+
+The id maps are handed to the workers as module globals inherited when
+the workers are forked, instead of being pickled for every file.
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+import app
+import bulk_copy
+
+ANNOTATION_COLUMNS = ["name", "type_identifier", "e_value", "score"]
+
+# Set in the parent before the copying workers are forked
+_gene_ids = None
+_annotation_ids = None
+
+
+def read_annotations(path, **kwargs):
+    return pd.read_table(path, header=None, names=ANNOTATION_COLUMNS, **kwargs)
+
+
+def gene_names(path, annotation_ids=None):
+    """The unique gene names in the annotation file path, only of the
+    annotations known to annotation_ids if given"""
+    if annotation_ids is None:
+        return read_annotations(path, usecols=["name"])['name'].unique()
+    gene_annotations = known_annotations(read_annotations(path, usecols=["name", "type_identifier"]), annotation_ids, path)
+    return gene_annotations['name'].unique()
+
+
+def known_annotations(gene_annotations, annotation_ids, path):
+    """The rows of gene_annotations with type identifiers in annotation_ids.
+
+    Annotations missing from the annotation info files cannot be stored,
+    they are dropped and logged."""
+    known = gene_annotations['type_identifier'].isin(annotation_ids.keys())
+    if not known.all():
+        unknown = sorted(gene_annotations.loc[~known, 'type_identifier'].astype(str).unique())
+        logging.warning("Skipping {} annotations in {} with {} type identifiers missing from the database: {}{}".format(
+            (~known).sum(), path, len(unknown), ', '.join(unknown[:10]), ', ...' if len(unknown) > 10 else ''))
+    return gene_annotations[known]
+
+
+def _gene_annotation_rows(gene_annotations, gene_ids, annotation_ids, annotation_source_id):
+    gene_annotations = gene_annotations.assign(
+            gene_id=gene_annotations['name'].map(gene_ids).astype(int),
+            annotation_id=gene_annotations['type_identifier'].map(annotation_ids).astype(int),
+            annotation_source_id=annotation_source_id)
+    return gene_annotations[['gene_id', 'annotation_id', 'annotation_source_id', 'e_value']]
+
+
+def copy_gene_annotation_file(session, path, gene_ids, annotation_ids, annotation_source_id, reference_assembly_id):
+    """Adds the genes and gene annotations in the annotation file path.
+
+    gene_ids maps the names of the genes already in the database to
+    their ids and is updated with the genes that are missing, which are
+    added to the reference assembly. Annotations with type identifiers
+    missing from annotation_ids are skipped, see known_annotations.
+    Returns the names of the new genes."""
+    gene_annotations = known_annotations(read_annotations(path), annotation_ids, path)
+
+    # Only add genes once
+    names = pd.Series(gene_annotations['name'].unique())
+    new_genes = pd.DataFrame({'name': names[~names.isin(gene_ids.keys())]})
+    new_genes['reference_assembly_id'] = reference_assembly_id
+    logging.info("Adding {} new genes".format(len(new_genes)))
+    gene_ids.update(bulk_copy.copy_dataframe_returning(session, new_genes, 'gene', ['name', 'reference_assembly_id'], 'name'))
+
+    logging.info("Adding {} gene annotations".format(len(gene_annotations)))
+    bulk_copy.copy_dataframe(session, _gene_annotation_rows(gene_annotations, gene_ids,
+            annotation_ids, annotation_source_id), 'gene_annotation')
+    return new_genes['name'].tolist()
+
+
+def _gene_names(path):
+    return gene_names(path, _annotation_ids)
+
+
+def _copy_annotations(path, annotation_source_id):
+    gene_annotations = known_annotations(read_annotations(path), _annotation_ids, path)
+    rows = _gene_annotation_rows(gene_annotations, _gene_ids, _annotation_ids, annotation_source_id)
+    with app.db.engine.begin() as connection:
+        return bulk_copy.copy_dataframe(connection, rows, 'gene_annotation')
+
+
+def _process_pool(max_workers):
+    # The workers must not share the connections of the parent
+    app.db.engine.dispose()
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+            mp_context=multiprocessing.get_context('fork'))
+
+
+def copy_gene_annotations(session, annotation_files, gene_ids, annotation_ids, reference_assembly_id, max_workers=None):
+    """Adds the genes and gene annotations of annotation_files, a list of
+    (annotation type, path, annotation source id), using a process per file.
+
+    gene_ids maps the names of the genes already in the database to
+    their ids and is updated with the new genes, which are committed
+    before the annotations are copied. annotation_ids maps type
+    identifiers to annotation ids, annotations with other type
+    identifiers are skipped. Returns gene_ids."""
+    global _gene_ids, _annotation_ids
+    max_workers = max_workers or len(annotation_files)
+    session.commit()
+
+    _annotation_ids = annotation_ids
+    try:
+        logging.info("Reading the gene names of {} annotation files".format(len(annotation_files)))
+        with _process_pool(max_workers) as executor:
+            names = list(executor.map(_gene_names, [path for _, path, _ in annotation_files]))
+        new_names = pd.unique(np.concatenate(names)) if names else []
+        new_genes = pd.DataFrame({'name': [name for name in new_names if name not in gene_ids]})
+        new_genes['reference_assembly_id'] = reference_assembly_id
+
+        logging.info("Commiting {} new genes".format(len(new_genes)))
+        gene_ids.update(bulk_copy.copy_dataframe_returning(session, new_genes, 'gene', ['name', 'reference_assembly_id'], 'name'))
+        session.commit()
+
+        _gene_ids = gene_ids
+        with _process_pool(max_workers) as executor:
+            futures = dict((executor.submit(_copy_annotations, path, annotation_source_id), annotation_type)
+                    for annotation_type, path, annotation_source_id in annotation_files)
+            for future in concurrent.futures.as_completed(futures):
+                logging.info("Commited {} {} gene annotations".format(future.result(), futures[future]))
+    finally:
+        _gene_ids = None
+        _annotation_ids = None
+    return gene_ids
@@ -0,0 +1,87 @@
+"""The annotation types known to the loaders.
+
+Each type is registered under the name it has in the annotation source
+info file, with the Annotation subclass storing it and a function that
+reads its annotation info file into a catalogue for
+Annotation.copy_catalogue: type_identifier and description columns, and
+the columns of the table of the subclass.
+
+A new annotation family takes a model, a migration and a register call
+here, after which add_annotation_type_to_db.py loads it into an existing
+database.
+"""
+import collections
+
+import pandas as pd
+
+from models import Pfam, TigrFam, EggNOG, EcNumber, DbCAN
+
+AnnotationType = collections.namedtuple('AnnotationType', ['name', 'annotation_class', 'read_info', 'columns'])
+
+ANNOTATION_TYPES = collections.OrderedDict()
+
+
+def register(name, annotation_class, read_info=None, columns=()):
+    ANNOTATION_TYPES[name] = AnnotationType(name, annotation_class,
+            read_info or read_annotation_info, list(columns))
+
+
+def annotation_type(name):
+    if name not in ANNOTATION_TYPES:
+        raise ValueError("Unknown annotation type {}, expected one of {}".format(
+            name, ', '.join(ANNOTATION_TYPES.keys())))
+    return ANNOTATION_TYPES[name]
+
+
+def read_annotation_info(path):
+    """Reads an annotation info file with an Id and a Description column"""
+    annotation_info = pd.read_table(path, index_col=0)
+    annotation_info['type_identifier'] = annotation_info.index.astype(str)
+    annotation_info['description'] = annotation_info['Description']
+    return annotation_info
+
+
+def read_eggnog_info(path):
+    # Columns:Id,Categories,Description
+    annotation_info = read_annotation_info(path)
+    annotation_info['categories'] = annotation_info['Categories']
+    return annotation_info
+
+
+EC_DIGIT_COLUMNS = ['first_digit', 'second_digit', 'third_digit', 'fourth_digit']
+
+def read_ec_info(path):
+    # Columns:Id,Name,Description
+    annotation_info = read_annotation_info(path)
+    # Unspecified digits, written as -, are left empty
+    digits = annotation_info['type_identifier'].str.split('.', expand=True)
+    assert digits.shape[1] == 4
+    for i, digit_column in enumerate(EC_DIGIT_COLUMNS):
+        annotation_info[digit_column] = pd.to_numeric(digits[i], errors='coerce').astype('Int64')
+    return annotation_info
+
+
+def read_dbcan_info(path):
+    # Columns:Id,ncbi-cdd,cazy-class,cazy-note,cazy-activities
+    annotation_info = pd.read_table(path, index_col=0)
+    annotation_info['type_identifier'] = annotation_info.index.astype(str)
+    annotation_info['description'] = annotation_info['cazy-activities'].fillna(annotation_info['cazy-note'])
+    annotation_info['cazy_class'] = annotation_info['cazy-class']
+    annotation_info['ncbi_cdd'] = annotation_info['ncbi-cdd']
+    return annotation_info
+
+
+register('Pfam', Pfam)
+register('TigrFam', TigrFam)
+register('EggNOG', EggNOG, read_eggnog_info)
+register('EC', EcNumber, read_ec_info, EC_DIGIT_COLUMNS)
+register('dbCAN', DbCAN, read_dbcan_info, ['cazy_class', 'ncbi_cdd'])
+
+
+def copy_catalogue(session, name, path):
+    """Adds the annotations in the annotation info file path, of the
+    annotation type name, and returns a dict from type identifier to
+    annotation id."""
+    registered = annotation_type(name)
+    annotation_info = registered.read_info(path)
+    return registered.annotation_class.copy_catalogue(session, annotation_info, registered.columns)
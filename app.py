@@ -1,20 +1,21 @@
-from flask import Flask, render_template, request, make_response, jsonify, redirect, url_for, flash
+from flask import Flask, render_template, request, make_response, jsonify, redirect, url_for, flash, abort, \
+        Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_dance.contrib.google import make_google_blueprint, google
 from flask_dance.consumer.storage.sqla import SQLAlchemyStorage
 from flask_dance.consumer import oauth_authorized, oauth_error
 from flask_login import current_user, LoginManager, login_user, logout_user, login_required
 from forms import FunctionClassFilterForm, TaxonomyTableFilterForm, BlastFilterForm
+from blast import BlastRunner, BlastJobs, BlastQueueFull
+from sequence_store import SequenceStore
 import sqlalchemy
+from sqlalchemy.orm import selectinload
 import config
 import json
 import os
+import time
 from collections import OrderedDict
 from urllib.parse import urlparse, urljoin
-import subprocess
-import shutil
-import pandas as pd
-import io
 
 app = Flask(__name__)
 app.config.from_object(os.environ['APP_SETTINGS'])
@@ -30,6 +31,7 @@ config.check_oauth_variables(os.environ['APP_SETTINGS'])
 db = SQLAlchemy(app)
 
 from models import Sample, SampleSet, TimePlace, SampleProperty, Annotation, Taxon, OAuth, User, Gene
+from search import annotation_search_query, search_annotations, search_taxa
 
 ##########################
 ## Some Helper Methods
@@ -76,7 +78,58 @@ def collect_property_names():
     IDABLE_PROPERTY_TO_UNIT = idable_to_unit
     BARM_PROPERTIES_SET = True
 
-def _prepare_json_table_row(sample_to_rpkm, sample_sets, taxonomy=False):
+@app.template_filter('rpkm')
+def format_rpkm(rpkm):
+    """Rpkm values are kept as floats until they are rendered"""
+    return "{0:.4f}".format(rpkm)
+
+# Sample information used in the json tables, keyed by sample id,
+# dropped when it is older than SAMPLE_DESCRIPTORS_MAX_AGE seconds
+SAMPLE_DESCRIPTORS = {}
+SAMPLE_DESCRIPTORS_LOADED_AT = None
+
+def _sample_descriptor(sample):
+    """The json information for a sample, except for the y-value"""
+    json_sample_d = {'sample': sample.scilifelab_code,
+            'date': sample.timeplace.date_formatted(),
+            'latitude': "{0:.6f}".format(sample.timeplace.latitude),
+            'longitude': "{0:.6f}".format(sample.timeplace.longitude)}
+
+    for prop in sample.properties:
+        if prop.name not in PROPERTIES_TO_SKIP:
+            idable = SampleProperty.idable_property_name_(prop.name)
+            json_sample_d[idable] = prop.value
+    return json_sample_d
+
+def _sample_descriptors(sample_sets):
+    """Caching the json information for all samples in sample_sets.
+
+    Samples not seen before are loaded together with their time place and
+    properties in a few queries instead of one lazy load per sample.
+    Everything is reloaded once the cache is older than the configured
+    max age, so that changed samples and properties show up."""
+    global SAMPLE_DESCRIPTORS_LOADED_AT
+    now = time.time()
+    if SAMPLE_DESCRIPTORS_LOADED_AT is None or \
+            now - SAMPLE_DESCRIPTORS_LOADED_AT > app.config['SAMPLE_DESCRIPTORS_MAX_AGE']:
+        SAMPLE_DESCRIPTORS.clear()
+        SAMPLE_DESCRIPTORS_LOADED_AT = now
+
+    missing_ids = [sample.id for sample_set in sample_sets for sample in sample_set.samples
+            if sample.id not in SAMPLE_DESCRIPTORS]
+
+    if missing_ids:
+        q = Sample.query.\
+                options(selectinload(Sample.timeplace), selectinload(Sample.properties)).\
+                filter(Sample.id.in_(missing_ids))
+        for sample in q.all():
+            SAMPLE_DESCRIPTORS[sample.id] = _sample_descriptor(sample)
+
+    return SAMPLE_DESCRIPTORS
+
+def _prepare_json_table_row(sample_to_rpkm, sample_sets, taxonomy=False, sample_descriptors=None):
+    if sample_descriptors is None:
+        sample_descriptors = _sample_descriptors(sample_sets)
     row = {}
     row['highcharts_max_val'] = {}
     for sample_set in sample_sets:
@@ -84,15 +137,8 @@ def _prepare_json_table_row(sample_to_rpkm, sample_sets, taxonomy=False):
         ymax = 0
         for sample in sample_set.samples:
             yval = float("{0:.4f}".format(float(sample_to_rpkm[sample]))) # HAHA!
-            json_sample_d = {'y': yval, 'sample': sample.scilifelab_code,
-                    'date': sample.timeplace.date_formatted(),
-                    'latitude': "{0:.6f}".format(sample.timeplace.latitude),
-                    'longitude': "{0:.6f}".format(sample.timeplace.longitude)}
-
-            for prop in sample.properties:
-                if prop.name not in PROPERTIES_TO_SKIP:
-                    idable = SampleProperty.idable_property_name_(prop.name)
-                    json_sample_d[idable] = prop.value
+            json_sample_d = dict(sample_descriptors[sample.id])
+            json_sample_d['y'] = yval
             json_table_row.append(json_sample_d)
             if yval > ymax:
                 ymax = yval
@@ -100,6 +146,29 @@ def _prepare_json_table_row(sample_to_rpkm, sample_sets, taxonomy=False):
         row['highcharts_max_val'][sample_set.name] = "{0:.1E}".format(ymax)
     return row
 
+def _prepare_taxon_table(level, taxa_names_and_values, sample_sets):
+    """Fetches all the rows for the taxonomy table in one query and
+    prepares them for rendering."""
+    table_rows = Taxon.rpkm_table_rows(level,
+            [complete_taxonomy for taxa_name, complete_taxonomy in taxa_names_and_values])
+
+    sample_descriptors = _sample_descriptors(sample_sets)
+    complete_val_to_val = {}
+    table = OrderedDict()
+    json_table = {}
+    for taxa_name, complete_taxonomy in taxa_names_and_values:
+        complete_val_to_val[complete_taxonomy] = taxa_name
+
+        table_row = table_rows[complete_taxonomy]
+
+        json_table[complete_taxonomy] = _prepare_json_table_row(table_row, sample_sets, sample_descriptors=sample_descriptors)
+        table_row['highcharts_max_val'] = json_table[complete_taxonomy]['highcharts_max_val']
+
+        table_row['complete_taxonomy_id'] = complete_taxonomy.replace(';','-').replace(' ', '_').replace('.','_')
+        table[complete_taxonomy] = table_row
+
+    return table, json_table, complete_val_to_val
+
 def is_safe_url(target):
     ref_url = urlparse(request.host_url)
     test_url = urlparse(urljoin(request.host_url, target))
@@ -132,7 +201,16 @@ if os.environ.get('NUC_SEQUENCES'):
 else:
     raise Exception('The variable NUC_SEQUENCES is not set')
 
-assert(shutil.which('cdbyank') is not None)
+SEQUENCE_STORES = {AA_SEQUENCES: SequenceStore(AA_SEQUENCES),
+        NUC_SEQUENCES: SequenceStore(NUC_SEQUENCES)}
+
+BLAST_RUNNER = BlastRunner(max_workers=app.config['BLAST_WORKERS'],
+        max_queued=app.config['BLAST_MAX_QUEUED'],
+        cache_size=app.config['BLAST_CACHE_SIZE'],
+        cache_ttl=app.config['BLAST_CACHE_TTL'])
+BLAST_JOBS = BlastJobs(BLAST_RUNNER, app.config['BLAST_SPOOL_DIR'],
+        max_age=app.config['BLAST_JOB_MAX_AGE'],
+        max_running=app.config['BLAST_JOB_MAX_RUNNING'])
 
 blueprint = make_google_blueprint(
     client_id=google_client_id,
@@ -222,28 +300,45 @@ def taxon_tree_nodes_for_table(parent_level, parent_value):
 
 @app.route('/ajax/taxon_tree_table_row/<string:level>/<string:complete_taxonomy>')
 def taxon_tree_table_row(level, complete_taxonomy):
-    complete_val_to_val = {}
     complete_val = complete_taxonomy.split(';')[-1]
     if complete_val == '':
         complete_val = '<unassigned {}>'.format(complete_taxonomy.split(';')[-2])
-    complete_val_to_val[complete_taxonomy] = complete_val
 
     sample_sets = OrderedDict()
     for sample_set in sorted(SampleSet.all_public(), key=lambda ss: ss.name):
         sample_sets[sample_set] = sample_set.samples
 
-    rpkm_row = Taxon.rpkm_table_row(level, complete_taxonomy)
-    rpkm_row['complete_taxonomy_id'] = complete_taxonomy.replace(';','-').replace(' ', '_').replace('.','_')
-
-    json_table = {}
-    json_table[complete_taxonomy] = _prepare_json_table_row(rpkm_row, sample_sets)
-    rpkm_row['highcharts_max_val'] = json_table[complete_taxonomy]['highcharts_max_val']
+    table, json_table, complete_val_to_val = _prepare_taxon_table(level,
+            [(complete_val, complete_taxonomy)], sample_sets)
 
     return render_template('taxon_tree_table_row.html',
             complete_taxon = complete_taxonomy,
             complete_val_to_val = complete_val_to_val,
             sample_sets= sample_sets,
-            table_row=rpkm_row,
+            table_row=table[complete_taxonomy],
+            json_table=json_table)
+
+@app.route('/ajax/taxon_tree_table_children/<string:parent_level>/<string:parent_value>')
+def taxon_tree_table_children(parent_level, parent_value):
+    """All the children of a node as table rows, fetched in one request"""
+    if parent_value.endswith(';'):
+        return ""
+    tree_nodes = Taxon.tree_nodes(parent_level, parent_value)
+    if tree_nodes is None:
+        return ""
+    child_level, child_values = tree_nodes
+
+    sample_sets = OrderedDict()
+    for sample_set in sorted(SampleSet.all_public(), key=lambda ss: ss.name):
+        sample_sets[sample_set] = sample_set.samples
+
+    table, json_table, complete_val_to_val = _prepare_taxon_table(child_level,
+            child_values, sample_sets)
+
+    return render_template('taxon_tree_table_rows.html',
+            complete_val_to_val = complete_val_to_val,
+            sample_sets= sample_sets,
+            table=table,
             json_table=json_table)
 
 @app.route('/taxonomy_tree', methods=['GET'])
@@ -265,25 +360,13 @@ def taxonomy_tree_table():
     parent_values = None
     limit = 20
 
-    complete_val_to_val = {}
     sample_sets = OrderedDict()
     sample_scilifelab_codes = [] # Used for highcharts labels
     for sample_set in sorted(SampleSet.all_public(), key=lambda ss: ss.name):
         sample_sets[sample_set] = sample_set.samples
         sample_scilifelab_codes += [sample.scilifelab_code for sample in sample_set.samples]
 
-    table = OrderedDict()
-    json_table = {}
-    for taxa_name, complete_taxonomy in node_values:
-        complete_val_to_val[complete_taxonomy] = taxa_name
-
-        table_row = Taxon.rpkm_table_row(complete_taxonomy=complete_taxonomy)
-
-        json_table[complete_taxonomy] = _prepare_json_table_row(table_row, sample_sets)
-        table_row['highcharts_max_val'] = json_table[complete_taxonomy]['highcharts_max_val']
-
-        table_row['complete_taxonomy_id'] = complete_taxonomy.replace(';','-').replace(' ', '_').replace('.','_')
-        table[complete_taxonomy] = table_row
+    table, json_table, complete_val_to_val = _prepare_taxon_table(taxon_level, node_values, sample_sets)
 
     if not BARM_PROPERTIES_SET:
         collect_property_names()
@@ -301,14 +384,32 @@ def taxonomy_tree_table():
             properties_to_skip=PROPERTIES_TO_SKIP,
             json_table=json_table)
 
+def _streamed_download(lines, filename, content_type):
+    """ A response that sends the lines as they are generated,
+    without building the whole file in memory."""
+    r = Response(stream_with_context(lines), content_type=content_type)
+    r.headers["Content-Disposition"] = "attachment; filename={}".format(filename)
+    return r
+
 def table_to_csv(table, samples, blast=True):
+    """ Yields the csv lines for the gene counts table"""
+    return paged_table_to_csv([table], samples, blast=blast)
+
+def paged_table_to_csv(tables, samples, blast=True):
+    """ Yields the csv lines for a gene counts table
+    which is split into several tables"""
     first_row = ','.join(['gene_id', 'functions', 'taxonomy'])
 
     if blast:
         first_row += ',' + ','.join(['e_value', 'identity', 'alignment_length'])
 
     first_row += ',' + ','.join(sample.scilifelab_code for sample in samples)
-    csv_output = [first_row]
+    yield first_row + '\n'
+    for table in tables:
+        for row in _table_to_csv_rows(table, samples, blast):
+            yield row
+
+def _table_to_csv_rows(table, samples, blast):
     for gene, sample_d in table.items():
         row = [gene.name]
         annotations_combined = []
@@ -326,158 +427,176 @@ def table_to_csv(table, samples, blast=True):
             row.append("{0:.2f}".format(sample_d['identity']))
             row.append("{}".format(sample_d['alignment_length']))
         for sample in samples:
-            row.append(sample_d[sample])
-        csv_output.append(','.join(row))
+            row.append(sample_d.get(sample, ''))
+        yield ','.join(row) + '\n'
+
+BLAST_OUTPUT_COLUMNS = ['qacc', 'sacc', 'pident', 'length', 'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore']
 
-    csv_str = '\n'.join(csv_output)
+def _blast_command(form):
+    cmd = [form.blast_algorithm.data]
 
-    return csv_str
+    e_val = int(form.e_value_factor.data) * 10**int(form.e_value_exponent.data)
+    cmd += ["-evalue", str(e_val)]
+
+    if form.blast_algorithm.data == 'blastp':
+        blast_db = AA_SEQUENCES
+    else:
+        blast_db = NUC_SEQUENCES
+    cmd += ['-db', blast_db]
+    cmd += ['-outfmt', '6 {}'.format(" ".join(BLAST_OUTPUT_COLUMNS))]
+    return cmd
+
+def _empty_blast_page(form, **kwargs):
+    return render_template('blast_page.html',
+        form=form,
+        samples=[],
+        table={},
+        general_information_property_names=GENERAL_INFORMATION_PROPERTY_NAMES,
+        measured_parameters_property_names=MEASURED_PARAMETERS_PROPERTY_NAMES,
+        idable_property_to_unit=IDABLE_PROPERTY_TO_UNIT,
+        properties_to_skip=PROPERTIES_TO_SKIP,
+        sample_scilifelab_codes=[],
+        **kwargs)
 
 @app.route('/blast_search_table', methods=['GET', 'POST'])
 def blast_page():
     form = BlastFilterForm()
     form.select_sample_groups.choices = [(sample_set.name, sample_set.name) for sample_set in  SampleSet.all_public()]
-    if form.validate_on_submit():
-        cmd = [form.blast_algorithm.data]
 
-        e_val = int(form.e_value_factor.data) * 10**int(form.e_value_exponent.data)
-        cmd += ["-evalue", str(e_val)]
+    if not BARM_PROPERTIES_SET:
+        collect_property_names()
 
-        if form.blast_algorithm.data == 'blastp':
-            blast_db = AA_SEQUENCES
-        else:
-            blast_db = NUC_SEQUENCES
-        cmd += ['-db', blast_db]
-        names = ['qacc', 'sacc', 'pident', 'length', 'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore']
-        cmd += ['-outfmt', '6 {}'.format(" ".join(names))]
-
-        if not BARM_PROPERTIES_SET:
-            collect_property_names()
-
-        with subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,\
-                stderr=subprocess.PIPE) as process:
-            blast_stdout, stderr = process.communicate(input=form.sequence.data.encode())
-            returncode = process.returncode
-
-        if returncode == 0:
-            with io.StringIO(blast_stdout.decode()) as stdout_buf:
-                df = pd.read_csv(stdout_buf, sep='\t', index_col=1, header=None, names=names)
-            total_hits = len(df)
-            # Filter on identity and alignment length
-            df = df[df['pident'] >= form.min_identity.data]
-
-            hits_after_pident = len(df)
-            df = df[df['length'] >= form.min_aln_length.data]
-
-            hits_after_length = len(df)
-
-            # Fetch counts for the matching genes
-            if len(df) == 0:
-                msg = "No hits were found in the BLAST search"
-                flash(msg, category="error")
-                return render_template('blast_page.html',
-                        form=form,
-                        table = {})
+    if form.validate_on_submit():
+        form_data = {field.name: field.data for field in form if field.name != 'csrf_token'}
+        try:
+            job_id = BLAST_JOBS.submit(_blast_command(form), form.sequence.data,
+                    BLAST_OUTPUT_COLUMNS, form_data)
+        except BlastQueueFull:
+            msg = "The BLAST server is busy at the moment, please try again in a little while."
+            flash(msg, category="error")
+            return _empty_blast_page(form)
 
+        return redirect(url_for('blast_job', job_id=job_id))
 
-            # If gene counts are requested
-            if not form.submit_download.data or form.download_select.data == 'Gene Counts':
-                samples, table = Gene.rpkm_table(list(df.index))
+    return _empty_blast_page(form)
 
-                sample_set_names = form.select_sample_groups.data
-                if len(sample_set_names) > 0:
-                    sample_sets = SampleSet.query.filter(SampleSet.name.in_(sample_set_names))
-                    samples = Sample.all_from_sample_sets(sample_set_names)
-                else:
-                    sample_sets = SampleSet.all_public()
-                    sample_set_names = [s.name for s in sample_sets]
-                    samples = Sample.all_from_sample_sets(sample_set_names)
+@app.route('/ajax/blast_job_status/<string:job_id>')
+def blast_job_status(job_id):
+    job = BLAST_JOBS.status(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(status=job['status'])
 
-                def _prepare_json_table(table, sample_sets):
-                    json_table = {}
-                    for gene, sample_d in table.items():
-                        json_table[gene.name] = _prepare_json_table_row(sample_d, sample_sets)
+@app.route('/blast_job/<string:job_id>', methods=['GET'])
+def blast_job(job_id):
+    """ Shows a waiting page while the BLAST job is running,
+    and the results or the requested download once it has finished."""
+    job = BLAST_JOBS.status(job_id)
+    if job is None:
+        abort(404)
 
-                    return json_table
+    form = BlastFilterForm(data=job['form'])
+    form.select_sample_groups.choices = [(sample_set.name, sample_set.name) for sample_set in  SampleSet.all_public()]
 
-                json_table = _prepare_json_table(table, sample_sets)
+    if not BARM_PROPERTIES_SET:
+        collect_property_names()
 
-                # Update table with blast info
-                for gene, sample_d in table.items():
-                    table[gene]['e_value'] = df.loc[gene.name]['evalue']
-                    table[gene]['identity'] = df.loc[gene.name]['pident']
-                    table[gene]['alignment_length'] = df.loc[gene.name]['length']
-
-                if form.submit_download.data:
-                    r = make_response(table_to_csv(table, samples))
-                    r.headers["Content-Disposition"] = "attachment; filename=gene_counts.csv"
-                    r.headers["Content-Type"] = "text/plain"
-                    return r
-                else:
-                    return render_template('blast_page.html',
-                        form=form,
-                        samples=samples,
-                        table=table,
-                        sample_scilifelab_codes = [s.scilifelab_code for s in samples],
-                        sample_sets=sample_set_names,
-                        general_information_property_names=GENERAL_INFORMATION_PROPERTY_NAMES,
-                        measured_parameters_property_names=MEASURED_PARAMETERS_PROPERTY_NAMES,
-                        idable_property_to_unit=IDABLE_PROPERTY_TO_UNIT,
-                        properties_to_skip=PROPERTIES_TO_SKIP,
-                        json_table=json_table)
-
-            # No gene counts are needed
-            elif form.download_select.data in ['Amino Acid Sequences', 'Nucleotide Sequences']:
-                # Fetch gene ids
-                all_ids = list(df.index)
-
-                if form.download_select.data == 'Amino Acid Sequences':
-                    seqs, msg = _extract_sequences(all_ids, AA_SEQUENCES)
-                else:
-                    seqs, msg = _extract_sequences(all_ids, NUC_SEQUENCES)
-
-                if seqs is None:
-                    json_table = _prepare_json_table(table, sample_sets)
-                    flash(msg, category="error")
-                    return render_template('blast_page.html',
-                        form=form,
-                        samples=[],
-                        table={},
-                        sample_scilifelab_codes=[])
-                else:
-                    r = make_response(seqs)
-                    r.headers["Content-Disposition"] = "attachment; filename=blast_hits.fa"
-                    r.headers["Content-Type"] = "text/plain"
-                    return r
-
-            elif form.download_select.data == 'BLAST tabular':
-                r = make_response(df.to_csv(sep='\t'))
-                if form.blast_algorithm.data == 'blastp':
-                    r.headers["content-disposition"] = "attachment; filename=blastp_hits.tsv"
-                else:
-                    r.headers["content-disposition"] = "attachment; filename=blastn_hits.tsv"
-                r.headers["Content-Type"] = "text/plain"
-                return r
+    if job['status'] == 'running':
+        return _empty_blast_page(form, job_id=job_id)
 
+    if job['status'] == 'failed':
         msg = "Error, the {} query was not successful.".format(form.blast_algorithm.data)
         flash(msg, category="error")
 
         # Logging the error
-        print("BLAST ERROR, cmd: {}".format(cmd))
-        print("BLAST ERROR, returncode: {}".format(returncode))
-        print("BLAST ERROR, output: {}".format(blast_stdout))
-        print("BLAST ERROR, stderr: {}".format(stderr))
+        print("BLAST ERROR, job: {}".format(job_id))
+        print("BLAST ERROR, cmd: {}".format(job['cmd']))
+        print("BLAST ERROR, returncode: {}".format(job.get('returncode')))
+        print("BLAST ERROR, stderr: {}".format(job.get('stderr', job.get('error'))))
+        return _empty_blast_page(form)
 
-    # else: commented out since also returncode != 0 leads here
-    return render_template('blast_page.html',
-        form=form,
-        samples=[],
-        table={},
-        general_information_property_names=GENERAL_INFORMATION_PROPERTY_NAMES,
-        measured_parameters_property_names=MEASURED_PARAMETERS_PROPERTY_NAMES,
-        idable_property_to_unit=IDABLE_PROPERTY_TO_UNIT,
-        properties_to_skip=PROPERTIES_TO_SKIP,
-        sample_scilifelab_codes=[])
+    df = BLAST_JOBS.hits(job_id)
+
+    # Filter on identity and alignment length
+    df = df[df['pident'] >= form.min_identity.data]
+    df = df[df['length'] >= form.min_aln_length.data]
+
+    # Fetch counts for the matching genes
+    if len(df) == 0:
+        msg = "No hits were found in the BLAST search"
+        flash(msg, category="error")
+        return _empty_blast_page(form)
+
+    # If gene counts are requested
+    if not form.submit_download.data or form.download_select.data == 'Gene Counts':
+        sample_set_names = form.select_sample_groups.data
+        if len(sample_set_names) > 0:
+            sample_sets = SampleSet.query.filter(SampleSet.name.in_(sample_set_names)).all()
+            samples = Sample.all_from_sample_sets(sample_set_names)
+        else:
+            sample_sets = SampleSet.all_public()
+            sample_set_names = [s.name for s in sample_sets]
+            samples = Sample.all_from_sample_sets(sample_set_names)
+
+        # Only the counts for the shown sample sets are needed
+        _, table = Gene.rpkm_table(list(df.index),
+                sample_set_ids=[sample_set.id for sample_set in sample_sets])
+
+        def _prepare_json_table(table, sample_sets):
+            json_table = {}
+            sample_descriptors = _sample_descriptors(sample_sets)
+            for gene, sample_d in table.items():
+                json_table[gene.name] = _prepare_json_table_row(sample_d, sample_sets, sample_descriptors=sample_descriptors)
+
+            return json_table
+
+        json_table = _prepare_json_table(table, sample_sets)
+
+        # Update table with blast info
+        for gene, sample_d in table.items():
+            table[gene]['e_value'] = df.loc[gene.name]['evalue']
+            table[gene]['identity'] = df.loc[gene.name]['pident']
+            table[gene]['alignment_length'] = df.loc[gene.name]['length']
+
+        if form.submit_download.data:
+            return _streamed_download(table_to_csv(table, samples), "gene_counts.csv", "text/plain")
+        else:
+            return render_template('blast_page.html',
+                form=form,
+                samples=samples,
+                table=table,
+                sample_scilifelab_codes = [s.scilifelab_code for s in samples],
+                sample_sets=sample_set_names,
+                general_information_property_names=GENERAL_INFORMATION_PROPERTY_NAMES,
+                measured_parameters_property_names=MEASURED_PARAMETERS_PROPERTY_NAMES,
+                idable_property_to_unit=IDABLE_PROPERTY_TO_UNIT,
+                properties_to_skip=PROPERTIES_TO_SKIP,
+                json_table=json_table)
+
+    # No gene counts are needed
+    elif form.download_select.data in ['Amino Acid Sequences', 'Nucleotide Sequences']:
+        # Fetch gene ids
+        all_ids = list(df.index)
+
+        if form.download_select.data == 'Amino Acid Sequences':
+            seqs, msg = _extract_sequences(all_ids, AA_SEQUENCES)
+        else:
+            seqs, msg = _extract_sequences(all_ids, NUC_SEQUENCES)
+
+        if seqs is None:
+            flash(msg, category="error")
+            return _empty_blast_page(form)
+        else:
+            return _streamed_download(seqs, "blast_hits.fa", "text/plain")
+
+    else:
+        r = make_response(df.to_csv(sep='\t'))
+        if form.blast_algorithm.data == 'blastp':
+            r.headers["content-disposition"] = "attachment; filename=blastp_hits.tsv"
+        else:
+            r.headers["content-disposition"] = "attachment; filename=blastn_hits.tsv"
+        r.headers["Content-Type"] = "text/plain"
+        return r
 
 
 @app.route('/functional_table', methods=['GET', 'POST'])
@@ -488,6 +607,7 @@ def functional_table():
                     ('pfam', 'Pfam'),
                     ('tigrfam', 'TigrFam'),
                     ('eggnog', 'EggNOG'),
+                    ('dbcan', 'dbCAN'),
                     ('all', 'All')
                 ]
 
@@ -517,7 +637,7 @@ def functional_table():
 
         sample_set_names = form.select_sample_groups.data
         if len(sample_set_names) > 0:
-            sample_sets = SampleSet.query.filter(SampleSet.name.in_(sample_set_names))
+            sample_sets = SampleSet.query.filter(SampleSet.name.in_(sample_set_names)).all()
             samples = [sample.scilifelab_code for sample in Sample.all_from_sample_sets(sample_set_names)]
         else:
             sample_sets = SampleSet.all_public()
@@ -531,14 +651,11 @@ def functional_table():
         if len(type_identifiers) == 0:
             msg = "Warning, the query was not performed since it did not result in any hit. Try writing a more general query."
             flash(msg, category="error")
-        elif len(type_identifiers) > 200:
+        elif len(type_identifiers) > 200 and not download_action:
+            # Downloads are streamed, but the page can only show so much
             msg = "Warning, the query was not performed since it resulted in more than 200 hits. Try writing a more specific query."
             flash(msg, category="error")
             type_identifiers = []
-        elif len(type_identifiers) > 20 and download_action and download_select == 'Gene Counts':
-            msg = "Warning, the Gene Counts download was not performed since it resulted in more than 20 annotations. Try writing a more specific query."
-            flash(msg, category="error")
-            type_identifiers = []
 
     else:
         function_class=None
@@ -568,8 +685,9 @@ def functional_table():
 
     def _prepare_json_table(table, sample_sets):
         json_table = {}
+        sample_descriptors = _sample_descriptors(sample_sets)
         for annotation, sample_d in table.items():
-            json_table[annotation.type_identifier] = _prepare_json_table_row(sample_d, sample_sets)
+            json_table[annotation.type_identifier] = _prepare_json_table_row(sample_d, sample_sets, sample_descriptors=sample_descriptors)
         return json_table
 
     # This section is not independent from the section above
@@ -577,76 +695,43 @@ def functional_table():
         if download_select == 'Gene List':
             # Fetch all contributing genes for all the annotations in the table
             annotation_ids = [annotation.id for annotation, sample in table.items()]
-            genes_per_annotation = Annotation.genes_per_annotation(annotation_ids)
-            csv_output = '\n'.join(
-                    [','.join([gene.name, annotation.type_identifier]) \
-                            for gene, annotation in genes_per_annotation])
-            r = make_response(csv_output)
-            r.headers["Content-Disposition"] = "attachment; filename=gene_list.csv"
-            r.headers["Content-Type"] = "text/csv"
-            return r
+            gene_list = (','.join([gene_name, type_identifier]) + '\n' \
+                    for gene_name, type_identifier in Annotation.gene_names_per_annotation(annotation_ids))
+            return _streamed_download(gene_list, "gene_list.csv", "text/csv")
 
         elif download_select == 'Gene Counts':
             annotation_ids = [annotation.id for annotation, sample in table.items()]
-            genes_per_annotation = Annotation.genes_per_annotation(annotation_ids)
+            samples = Gene.samples_with_counts_for_annotations(annotation_ids)
+            tables = Gene.rpkm_table_pages(annotation_ids)
+            return _streamed_download(paged_table_to_csv(tables, samples, blast=False), "gene_counts.csv", "text/csv")
 
-            all_gene_names = []
-            for gene, annotation in genes_per_annotation:
-                all_gene_names.append(gene.name)
-                #[gene.name for gene in genes]
+        elif download_select == 'Annotation Counts':
+            def _annotation_counts(table, samples):
+                yield 'annotation_id' + ',' + \
+                        ','.join([sample.scilifelab_code for sample in samples]) + '\n'
+                for annotation, sample_d in table.items():
+                    yield annotation.type_identifier + ',' + \
+                            ','.join([format_rpkm(sample_d[sample]) for sample in samples]) + '\n'
 
-            samples, table = Gene.rpkm_table(all_gene_names)
-            csv_output = table_to_csv(table, samples, blast=False)
+            return _streamed_download(_annotation_counts(table, samples), "annotation_counts.csv", "text/csv")
 
-            r = make_response(csv_output)
-            r.headers["Content-Disposition"] = "attachment; filename=gene_counts.csv"
-            r.headers["Content-Type"] = "text/csv"
-            return r
+        elif download_select in ['Amino Acid Sequences', 'Nucleotide Sequences']:
+            annotation_ids = [annotation.id for annotation, sample in table.items()]
+            all_gene_ids = set(gene_name for gene_name, type_identifier in \
+                    Annotation.gene_names_per_annotation(annotation_ids))
 
-        elif download_select == 'Annotation Counts':
-            csv_output = 'annotation_id' + ',' + \
-            ','.join([sample.scilifelab_code for sample in samples]) \
-            + '\n'
-            csv_output += '\n'.join(
-                    [annotation.type_identifier + ',' + ','.join([sample_d[sample] for sample in samples]) for annotation, sample_d in table.items()])
-            r = make_response(csv_output)
-            r.headers["Content-Disposition"] = "attachment; filename=annotation_counts.csv"
-            r.headers["Content-Type"] = "text/csv"
-            return r
-
-        elif download_select == 'Amino Acid Sequences':
-            annotations = [annotation for annotation, sample in table.items()]
-            all_gene_ids = set()
-            for annotation in annotations:
-                gene_ids = set([gene.name for gene in annotation.genes])
-                all_gene_ids |= gene_ids
-
-            seqs, msg = _extract_sequences(all_gene_ids, AA_SEQUENCES)
-            if seqs is None:
-                json_table = _prepare_json_table(table, sample_sets)
-                flash(msg, category="error")
+            if download_select == 'Amino Acid Sequences':
+                seqs, msg = _extract_sequences(all_gene_ids, AA_SEQUENCES)
+                filename = "proteins_aa.fa"
             else:
-                r = make_response(seqs)
-                r.headers["Content-Disposition"] = "attachment; filename=proteins_aa.fa"
-                r.headers["Content-Type"] = "text/plain"
-                return r
-
-        elif download_select == 'Nucleotide Sequences':
-            annotations = [annotation for annotation, sample in table.items()]
-            all_gene_ids = set()
-            for annotation in annotations:
-                gene_ids = set([gene.name for gene in annotation.genes])
-                all_gene_ids |= gene_ids
-
-            seqs, msg = _extract_sequences(all_gene_ids, NUC_SEQUENCES)
+                seqs, msg = _extract_sequences(all_gene_ids, NUC_SEQUENCES)
+                filename = "proteins_nuc.fa"
+
             if seqs is None:
                 json_table = _prepare_json_table(table, sample_sets)
                 flash(msg, category="error")
             else:
-                r = make_response(seqs)
-                r.headers["Content-Disposition"] = "attachment; filename=proteins_nuc.fa"
-                r.headers["Content-Type"] = "text/plain"
-                return r
+                return _streamed_download(seqs, filename, "text/plain")
     else:
         # Wait to prepare the json table until it's certain that it's necessary
         json_table = _prepare_json_table(table, sample_sets)
@@ -668,39 +753,27 @@ def functional_table():
         )
 
 def _extract_sequences(all_ids, sequence_file):
-    """ Will run cdbyank on the sequence file to extract
-    all sequences in all_ids as fasta"""
+    """ Will look up all sequences in all_ids in the sequence
+    file and return a generator of their fasta records"""
 
-    index_file = sequence_file + '.cidx'
-
-    with subprocess.Popen(['cdbyank', index_file], stdout=subprocess.PIPE,
-            stdin=subprocess.PIPE, stderr=subprocess.PIPE) as process:
-        cdbyank_stdout, stderr = process.communicate(input='\n'.join(all_ids).encode())
-    seqs = cdbyank_stdout.decode()
-    if len(seqs) == 0 or seqs[0] != '>':
+    store = SEQUENCE_STORES[sequence_file]
+    locations, missing = store.locate(all_ids)
+    if len(locations) == 0:
         msg = "Error! The sequence extraction was not possible. We're sorry for the inconvenience."
         print("ERROR IN SEQUENCE EXTRACTION")
-        print(stderr.decode())
+        print("None of the {} sequences were found in {}".format(len(all_ids), sequence_file))
         return None, msg
     else:
-        return seqs, None
+        if missing:
+            print("WARNING: {} sequences were not found in {}".format(len(missing), sequence_file))
+        return store.read(locations), None
 
 def _search_query(search_string, function_class):
-    """ adding % signs before and after will create a substring search
+    """ A substring search, served by the trigram indexes on annotation
 
     It will be case insensitive but will only match exactly whats in search_string
     """
-    search_string = '%'+search_string+'%'
-    q = Annotation.query.filter(
-            sqlalchemy.or_(
-                Annotation.type_identifier.ilike(search_string),
-                Annotation.description.ilike(search_string)
-            )
-        )
-    if function_class != 'all':
-        q = q.filter(Annotation.annotation_type == function_class)
-
-    return q
+    return annotation_search_query(search_string, function_class)
 
 @app.route('/ajax/search_annotations', methods=['GET'])
 def suggestions():
@@ -708,35 +781,21 @@ def suggestions():
     function_class = request.args.get('function_class', '')
     annotations = []
     nr_annotations_total = 0
+    nr_annotations_exact = True
     if text_input != '':
-        q = _search_query(text_input, function_class)
-        nr_annotations_total = q.count()
-        annotations = q.limit(10).all()
-    return render_template('search_annotations.html', annotations=annotations, nr_annotations_total=nr_annotations_total, nr_annotations_shown = len(annotations))
-
-
-def _search_query_taxon(search_string):
-    """ adding % signs before and after will create a substring search
-
-    It will be case insensitive but will only match exactly whats in search_string
-    """
-    search_string = '%'+search_string+'%'
-    q = Taxon.query.filter(
-                Taxon.full_taxonomy.ilike(search_string)
-        )
+        annotations, nr_annotations_total, nr_annotations_exact = search_annotations(text_input, function_class)
+    return render_template('search_annotations.html', annotations=annotations, nr_annotations_total=nr_annotations_total, nr_annotations_exact=nr_annotations_exact, nr_annotations_shown = len(annotations))
 
-    return q
 
 @app.route('/ajax/search_taxonomy', methods=['GET'])
 def taxon_suggestions():
     text_input = request.args.get('text_input', '')
     taxons = []
     nr_taxons_total = 0
+    nr_taxons_exact = True
     if text_input != '':
-        q = _search_query_taxon(text_input)
-        nr_taxons_total = q.count()
-        taxons = q.limit(20).all()
-    return render_template('search_taxonomy.html', taxons=taxons, nr_taxons_total=nr_taxons_total, nr_taxons_shown = len(taxons))
+        taxons, nr_taxons_total, nr_taxons_exact = search_taxa(text_input)
+    return render_template('search_taxonomy.html', taxons=taxons, nr_taxons_total=nr_taxons_total, nr_taxons_exact=nr_taxons_exact, nr_taxons_shown = len(taxons))
 
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,233 @@
+"""Running BLAST searches for the web server.
+
+All searches go through a BlastRunner which runs at most `max_workers`
+blast processes at the same time and queues at most `max_queued` more,
+so that a burst of searches cannot occupy every web worker. Finished
+results are cached, keyed by the complete blast command (algorithm,
+e-value, database and output format) and a hash of the query sequence,
+and identical searches that are already running share the same process.
+
+BlastJobs runs searches in the background, so that a web request only
+submits a search and later polls for its result.
+"""
+import collections
+import concurrent.futures
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+
+import pandas as pd
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+BlastResult = collections.namedtuple('BlastResult', ['returncode', 'stdout', 'stderr'])
+
+
+class BlastQueueFull(Exception):
+    """Raised when a search is submitted while all workers and queue slots are taken"""
+    pass
+
+
+def normalize_query(query):
+    """Removes surrounding white space and windows line endings so that
+    identical sequences share cache entries."""
+    return '\n'.join(line.strip() for line in query.strip().splitlines()) + '\n'
+
+
+def query_key(cmd, query):
+    return (tuple(cmd), hashlib.sha256(query.encode()).hexdigest())
+
+
+class ResultCache(object):
+    """A LRU cache where entries also expire after `ttl` seconds"""
+
+    def __init__(self, max_size=256, ttl=24*3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        if key not in self._entries:
+            return None
+        created, value = self._entries[key]
+        if time.time() - created > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class BlastRunner(object):
+    def __init__(self, max_workers=2, max_queued=8, cache_size=256, cache_ttl=24*3600):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+        self._cache = ResultCache(cache_size, cache_ttl)
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def submit(self, cmd, query):
+        """Returns a future with the BlastResult for running cmd on query.
+
+        Raises BlastQueueFull if no worker or queue slot is available."""
+        query = normalize_query(query)
+        key = query_key(cmd, query)
+
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                future = concurrent.futures.Future()
+                future.set_result(cached)
+                return future
+
+            if key in self._running:
+                return self._running[key]
+
+            if not self._slots.acquire(blocking=False):
+                raise BlastQueueFull()
+
+            future = self._executor.submit(self._run, cmd, query)
+            self._running[key] = future
+
+        future.add_done_callback(lambda f: self._finished(key, f))
+        return future
+
+    def run(self, cmd, query, timeout=None):
+        """Same as submit, but waits for and returns the BlastResult"""
+        return self.submit(cmd, query).result(timeout)
+
+    def _run(self, cmd, query):
+        process = subprocess.run(cmd, input=query.encode(),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return BlastResult(process.returncode, process.stdout, process.stderr)
+
+    def _finished(self, key, future):
+        with self._lock:
+            self._slots.release()
+            del self._running[key]
+            if not future.cancelled() and future.exception() is None:
+                result = future.result()
+                # Failed searches are not cached so that they can be retried
+                if result.returncode == 0:
+                    self._cache.put(key, result)
+
+
+class BlastJobs(object):
+    """BLAST searches run in the background and stored in a spool directory.
+
+    Every job gets a directory named by its job id, holding job.json with
+    the command, the submitted form data and the status of the job, and,
+    when the search has finished, hits.tsv with the parsed hit table.
+    Since the state is kept on disk, any web server process sharing the
+    spool directory can answer for a job. Jobs older than `max_age`
+    seconds are removed when new jobs are submitted. A job still running
+    after `max_running` seconds is reported as failed, since the process
+    running it has most likely been restarted or killed.
+    """
+
+    def __init__(self, runner, spool_dir, max_age=24*3600, max_running=3600):
+        self.runner = runner
+        self.spool_dir = spool_dir
+        self.max_age = max_age
+        self.max_running = max_running
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def submit(self, cmd, query, names, form_data):
+        """Starts cmd on query and returns the job id.
+
+        `names` are the columns of the tabular blast output, the first two
+        being the query and subject ids. Raises BlastQueueFull if the
+        runner has no room for the search."""
+        self.remove_old_jobs()
+        future = self.runner.submit(cmd, query)
+
+        job_id = uuid.uuid4().hex
+        job = {'status': 'running',
+                'submitted': time.time(),
+                'started_at': time.time(),
+                'cmd': list(cmd),
+                'names': list(names),
+                'form': form_data}
+        os.makedirs(self._job_dir(job_id))
+        self._write_job(job_id, job)
+
+        future.add_done_callback(lambda f: self._finished(job_id, job, f))
+        return job_id
+
+    def status(self, job_id):
+        """Returns the job.json content of the job, or None if there is no such job"""
+        if not JOB_ID_PATTERN.match(job_id):
+            return None
+        try:
+            with open(os.path.join(self._job_dir(job_id), 'job.json')) as job_fh:
+                job = json.load(job_fh)
+        except FileNotFoundError:
+            return None
+
+        started_at = job.get('started_at', job['submitted'])
+        if job['status'] == 'running' and time.time() - started_at > self.max_running:
+            job['status'] = 'failed'
+            job['error'] = "The job was still running after {} seconds".format(self.max_running)
+            self._write_job(job_id, job)
+        return job
+
+    def hits(self, job_id):
+        """The hit table of a finished job, indexed by subject id"""
+        df = pd.read_csv(os.path.join(self._job_dir(job_id), 'hits.tsv'), sep='\t', index_col=0)
+        df.index = df.index.astype(str)
+        return df
+
+    def remove_old_jobs(self):
+        now = time.time()
+        for job_id in os.listdir(self.spool_dir):
+            job_dir = self._job_dir(job_id)
+            if JOB_ID_PATTERN.match(job_id) and now - os.path.getmtime(job_dir) > self.max_age:
+                shutil.rmtree(job_dir, ignore_errors=True)
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.spool_dir, job_id)
+
+    def _write_job(self, job_id, job):
+        # Written to a temporary file first so that readers never see half a file
+        job_path = os.path.join(self._job_dir(job_id), 'job.json')
+        with open(job_path + '.tmp', 'w') as job_fh:
+            json.dump(job, job_fh)
+        os.replace(job_path + '.tmp', job_path)
+
+    def _finished(self, job_id, job, future):
+        job = dict(job)
+        try:
+            result = future.result()
+            job['returncode'] = result.returncode
+            job['stderr'] = result.stderr.decode(errors='replace')
+            if result.returncode != 0:
+                job['status'] = 'failed'
+            else:
+                if result.stdout.strip():
+                    with io.StringIO(result.stdout.decode()) as stdout_buf:
+                        df = pd.read_csv(stdout_buf, sep='\t', index_col=1, header=None, names=job['names'])
+                else:
+                    # A search without hits gives no output at all
+                    df = pd.DataFrame(columns=job['names']).set_index(job['names'][1])
+                df.to_csv(os.path.join(self._job_dir(job_id), 'hits.tsv'), sep='\t')
+                job['status'] = 'finished'
+                job['total_hits'] = len(df)
+        except Exception as e:
+            job['status'] = 'failed'
+            job['error'] = str(e)
+        self._write_job(job_id, job)
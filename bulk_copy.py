@@ -0,0 +1,194 @@
+"""Bulk loading into postgres with COPY FROM STDIN.
+
+The rows are formatted as csv a chunk at a time and streamed to the
+server over the connection of the session, so no temporary file is
+written and the database does not need to be able to read the loading
+host's file system. The copy runs in the session's transaction.
+
+For initial builds, defer_indexes and restore_indexes let the loaders
+fill the big tables without indexes and build them once at the end.
+"""
+import concurrent.futures
+import io
+import logging
+
+import sqlalchemy
+
+CHUNK_SIZE = 100000
+
+
+class ChunkReader(object):
+    """A read-only file object over an iterable of strings, consumed as
+    the reader asks for more data."""
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._current = io.StringIO()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self._current.read() + ''.join(self._chunks)
+        data = self._current.read(size)
+        while len(data) < size:
+            try:
+                self._current = io.StringIO(next(self._chunks))
+            except StopIteration:
+                break
+            data += self._current.read(size - len(data))
+        return data
+
+    def readline(self, size=-1):
+        line = self._current.readline(size)
+        while not line.endswith('\n'):
+            try:
+                self._current = io.StringIO(next(self._chunks))
+            except StopIteration:
+                break
+            line += self._current.readline()
+        return line
+
+
+def dataframe_chunks(df, chunk_size=CHUNK_SIZE):
+    """Yields df as csv text without header or index, chunk_size rows at a time.
+
+    Missing values become empty fields, which COPY reads as NULL."""
+    for start in range(0, len(df), chunk_size):
+        yield df.iloc[start:start + chunk_size].to_csv(index=False, header=False)
+
+
+def _dbapi_connection(session):
+    # Either a session or a connection of its own, e.g. in another process
+    if isinstance(session, sqlalchemy.engine.Connection):
+        return session.connection
+    return session.connection().connection
+
+
+def copy_rows(session, table, columns, chunks):
+    """Copies csv formatted rows into table, over the connection of
+    session, which can also be a Connection.
+
+    chunks is an iterable of strings, each holding zero or more
+    complete csv lines with the values for columns."""
+    sql = "COPY {} ({}) FROM STDIN WITH CSV".format(table, ', '.join(columns))
+    cursor = _dbapi_connection(session).cursor()
+    try:
+        cursor.copy_expert(sql, ChunkReader(chunks))
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def copy_dataframe(session, df, table, columns=None, chunk_size=CHUNK_SIZE):
+    """Copies the rows of df into table and returns the number of rows copied.
+
+    columns are the columns of df to copy, in the order given, and
+    default to all columns. The table columns are expected to have the
+    same names."""
+    if columns is None:
+        columns = df.columns.tolist()
+    return copy_rows(session, table, columns, dataframe_chunks(df[columns], chunk_size))
+
+
+def copy_dataframe_returning(session, df, table, columns, key_column, returning='id'):
+    """Copies the rows of df into table through a temporary staging table
+    and returns a dict from key_column to the returning column (the id)
+    of the inserted rows.
+
+    This gives the ids of new rows without reading the whole table back."""
+    staging_table = 'staging_{}'.format(table)
+    session.execute("CREATE TEMPORARY TABLE {} AS SELECT {} FROM {} WITH NO DATA;".format(
+        staging_table, ', '.join(columns), table))
+    copy_dataframe(session, df, staging_table, columns)
+    rows = session.execute("INSERT INTO {0} ({1}) SELECT {1} FROM {2} RETURNING {3}, {4};".format(
+        table, ', '.join(columns), staging_table, key_column, returning)).fetchall()
+    session.execute("DROP TABLE {};".format(staging_table))
+    return dict(rows)
+
+
+# The tables filled by the loaders, which are worth loading without indexes
+BULK_LOAD_TABLES = ['gene', 'gene_annotation', 'gene_count']
+
+
+def defer_indexes(session, tables, commit=True):
+    """Drops the unique and foreign key constraints and the secondary
+    indexes of tables and returns what was dropped, to be given to
+    restore_indexes once the tables are loaded.
+
+    Building an index once over a loaded table is much faster than
+    maintaining it for every copied row. Primary keys are kept since the
+    foreign keys of other tables depend on them. The drop is committed
+    unless commit is False, for callers that store the definitions in
+    the same transaction. The definitions are also logged so that they
+    can be recreated by hand should the load fail."""
+    deferred = []
+    for table in tables:
+        # Unique constraints are recreated before the foreign keys
+        constraints = session.execute(sqlalchemy.text(
+                "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE conrelid = CAST(:table AS regclass) AND contype IN ('u', 'f') "
+                "ORDER BY contype DESC, conname"), {'table': table}).fetchall()
+        for name, definition in constraints:
+            deferred.append((table, 'constraint', name,
+                'ALTER TABLE {} ADD CONSTRAINT {} {}'.format(table, name, definition)))
+
+        indexes = session.execute(sqlalchemy.text(
+                "SELECT index_class.relname, pg_get_indexdef(pg_index.indexrelid) FROM pg_index "
+                "JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid "
+                "WHERE pg_index.indrelid = CAST(:table AS regclass) AND NOT pg_index.indisprimary "
+                "AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE pg_constraint.conindid = pg_index.indexrelid) "
+                "ORDER BY index_class.relname"), {'table': table}).fetchall()
+        for name, definition in indexes:
+            # Indexes on partitioned tables are reported as ON ONLY, which
+            # would leave out the partitions
+            deferred.append((table, 'index', name, definition.replace(' ON ONLY ', ' ON ')))
+
+    for table, kind, name, definition in reversed(deferred):
+        logging.info("Dropping {} {} on {}: {}".format(kind, name, table, definition))
+        if kind == 'constraint':
+            session.execute("ALTER TABLE {} DROP CONSTRAINT {};".format(table, name))
+        else:
+            session.execute("DROP INDEX {};".format(name))
+    if commit:
+        session.commit()
+    return deferred
+
+
+def _index_exists(session, table, kind, name):
+    if kind == 'constraint':
+        return session.execute(sqlalchemy.text(
+                "SELECT 1 FROM pg_constraint WHERE conrelid = CAST(:table AS regclass) AND conname = :name"),
+                {'table': table, 'name': name}).first() is not None
+    return session.execute(sqlalchemy.text("SELECT to_regclass(:name)"), {'name': name}).scalar() is not None
+
+
+def restore_indexes(session, deferred, workers=4):
+    """Recreates the constraints and indexes dropped by defer_indexes and
+    analyzes the tables.
+
+    The indexes and unique constraints are built concurrently on
+    separate connections, up to workers at a time, followed by the
+    foreign keys, which check their rows against the rebuilt tables.
+    Those that already exist are skipped, so that a restore that failed
+    part of the way can be rerun."""
+    session.commit()
+    engine = session.get_bind()
+    missing = [(table, kind, name, definition) for table, kind, name, definition in deferred
+            if not _index_exists(session, table, kind, name)]
+
+    def build(definition):
+        with engine.begin() as connection:
+            connection.execute("SET LOCAL max_parallel_maintenance_workers = {};".format(int(workers)))
+            connection.execute(definition)
+
+    foreign_keys = [definition for _, kind, _, definition in missing
+            if kind == 'constraint' and 'FOREIGN KEY' in definition]
+    others = [definition for _, _, _, definition in missing
+            if definition not in foreign_keys]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for definitions in [others, foreign_keys]:
+            for definition in definitions:
+                logging.info("Building: {}".format(definition))
+            list(executor.map(build, definitions))
+
+    for table in sorted(set(table for table, _, _, _ in deferred)):
+        session.execute("ANALYZE {};".format(table))
+    session.commit()
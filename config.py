@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 class Config(object):
     DEBUG = False
@@ -10,6 +11,26 @@ class Config(object):
         raise Exception('The variable BARM_SECRET_KEY is not set')
     SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL']
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Serve the functional table from an in-memory copy of rpkm_table
+    RPKM_MATRIX_ENGINE = bool(os.environ.get('BARM_RPKM_MATRIX_ENGINE'))
+    # Seconds before the in-memory copy is reloaded from the database
+    RPKM_MATRIX_MAX_AGE = int(os.environ.get('BARM_RPKM_MATRIX_MAX_AGE', 3600))
+    # Seconds before the cached sample information of the json tables is reloaded
+    SAMPLE_DESCRIPTORS_MAX_AGE = int(os.environ.get('BARM_SAMPLE_DESCRIPTORS_MAX_AGE', 3600))
+    # Read gene counts from gene_count_vector instead of gene_count
+    GENE_COUNT_VECTORS = bool(os.environ.get('BARM_GENE_COUNT_VECTORS'))
+    # Number of simultaneous blast processes and searches allowed to wait for one
+    BLAST_WORKERS = int(os.environ.get('BARM_BLAST_WORKERS', 2))
+    BLAST_MAX_QUEUED = int(os.environ.get('BARM_BLAST_MAX_QUEUED', 8))
+    # Number of blast results cached and for how many seconds
+    BLAST_CACHE_SIZE = int(os.environ.get('BARM_BLAST_CACHE_SIZE', 256))
+    BLAST_CACHE_TTL = int(os.environ.get('BARM_BLAST_CACHE_TTL', 24*3600))
+    # Where background blast jobs keep their results, and for how many seconds
+    BLAST_SPOOL_DIR = os.environ.get('BARM_BLAST_SPOOL_DIR',
+            os.path.join(tempfile.gettempdir(), 'barm_blast_jobs'))
+    BLAST_JOB_MAX_AGE = int(os.environ.get('BARM_BLAST_JOB_MAX_AGE', 24*3600))
+    # Seconds after which a job still marked as running is considered lost
+    BLAST_JOB_MAX_RUNNING = int(os.environ.get('BARM_BLAST_JOB_MAX_RUNNING', 3600))
 
 class ProductionConfig(Config):
     DEBUG = False
@@ -0,0 +1,117 @@
+"""Streaming ingest of gene count matrices such as all_genes.tpm.tsv.gz.
+
+A matrix has one row per gene, a gene_length column and one column per
+sample. It is read a chunk of genes at a time and each chunk is turned
+into long format gene_count rows before the next one is read, so memory
+use is bounded by the chunk size rather than by the number of genes.
+The reading and formatting is done in a separate thread, to overlap
+with the copy into postgres.
+"""
+import logging
+import queue
+import threading
+
+import pandas as pd
+
+import bulk_copy
+from models import GeneCount, GeneCountVector
+
+CHUNK_SIZE = 50000
+PREFETCH_CHUNKS = 2
+
+
+def prefetch(iterable, size=PREFETCH_CHUNKS):
+    """Iterates over iterable in a background thread, staying at most
+    size items ahead of the consumer. Exceptions are raised in the
+    consumer."""
+    items = queue.Queue(maxsize=size)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except Exception as e:
+            items.put((None, e))
+        else:
+            items.put((done, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
+
+
+def sample_names(path):
+    """The sample columns of the matrix in path"""
+    header = pd.read_table(path, index_col=0, nrows=0)
+    return [column for column in header.columns if column != 'gene_length']
+
+
+def wide_chunks(path, gene_ids, sample_ids, chunk_size=CHUNK_SIZE, stats=None):
+    """Yields the counts in path as data frames with gene ids as index
+    and sample ids as columns, for at most chunk_size genes at a time.
+
+    gene_ids maps gene names to ids and genes missing from it are
+    skipped. sample_ids maps the sample names to ids. If stats is given
+    it is updated with the number of genes read and kept."""
+    for chunk in pd.read_table(path, index_col=0, chunksize=chunk_size):
+        nr_genes = len(chunk)
+        chunk = chunk[chunk.index.isin(gene_ids.keys())]
+        chunk = chunk.drop(columns=['gene_length'], errors='ignore').rename(columns=sample_ids)
+        chunk.index = chunk.index.map(gene_ids)
+        chunk.index.name = 'gene_id'
+        if stats is not None:
+            stats['genes'] = stats.get('genes', 0) + nr_genes
+            stats['kept_genes'] = stats.get('kept_genes', 0) + len(chunk)
+        yield chunk
+
+
+def gene_count_rows(chunks, sample_set_ids):
+    """Yields csv lines for gene_count (gene_id, sample_id, rpkm,
+    sample_set_id), one string per wide chunk. Missing counts are not
+    stored."""
+    for chunk in chunks:
+        long_chunk = chunk.stack().reset_index()
+        long_chunk.columns = ['gene_id', 'sample_id', 'rpkm']
+        long_chunk['sample_set_id'] = long_chunk['sample_id'].map(sample_set_ids)
+        yield long_chunk.to_csv(index=False, header=False)
+
+
+def _sample_ids(path, samples):
+    names = sample_names(path)
+    missing = [name for name in names if name not in samples]
+    if missing:
+        raise ValueError("Samples missing from the database: {}".format(', '.join(missing)))
+    return dict((name, samples[name].id) for name in names)
+
+
+def copy_gene_counts(session, path, gene_ids, samples, chunk_size=CHUNK_SIZE):
+    """Copies the counts in path into gene_count.
+
+    gene_ids maps gene names to ids, counts for other genes are skipped.
+    samples maps sample names to Sample objects and must contain every
+    sample in the matrix. The partitions for the sample sets are
+    created as needed. Returns the number of rows copied."""
+    sample_ids = _sample_ids(path, samples)
+    sample_set_ids = dict((samples[name].id, samples[name].sample_set_id or 0) for name in sample_ids)
+    for sample_set_id in set(sample_set_ids.values()):
+        GeneCount.create_partition(sample_set_id)
+
+    stats = {}
+    rows = gene_count_rows(wide_chunks(path, gene_ids, sample_ids, chunk_size, stats), sample_set_ids)
+    nr_rows = bulk_copy.copy_rows(session, 'gene_count',
+            ['gene_id', 'sample_id', 'rpkm', 'sample_set_id'], prefetch(rows))
+    logging.info("{} out of {} are annotated genes".format(stats.get('kept_genes', 0), stats.get('genes', 0)))
+    return nr_rows
+
+
+def copy_gene_count_vectors(path, gene_ids, samples, chunk_size=CHUNK_SIZE):
+    """Same as copy_gene_counts, but adds the counts to the gene count vectors"""
+    sample_ids = _sample_ids(path, samples)
+    chunks = prefetch(wide_chunks(path, gene_ids, sample_ids, chunk_size))
+    GeneCountVector.add_counts(list(sample_ids.values()), chunks)
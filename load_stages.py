@@ -0,0 +1,50 @@
+"""Resumable loading in named stages.
+
+A loader such as populate_db is split into stages that are run in order.
+Each stage runs in a transaction of its own and records its completion
+in load_stage as part of that transaction, so a stage either completes
+and is recorded or leaves nothing behind. When the loader is rerun after
+a failure, the recorded stages are skipped and the load resumes from the
+stage that failed.
+
+Stages that commit part of their work before they complete, such as the
+parallel annotation copy, have to be safe to rerun over that work.
+"""
+import logging
+import time
+
+from models import LoadStage
+
+
+def run_stages(session, pipeline, stages, restart=False):
+    """Runs stages, a list of (name, function), in order and returns the
+    LoadStage of every stage, by name.
+
+    A function is called without arguments once the stages before it
+    have completed. Whatever it returns is stored as the details of its
+    stage and must be serializable as json. Stages already completed for
+    pipeline are skipped, unless restart is set, which forgets them."""
+    if restart:
+        logging.info("Restarting {} from the first stage".format(pipeline))
+        LoadStage.query.filter_by(pipeline=pipeline).delete()
+        session.commit()
+
+    completed = LoadStage.completed(pipeline)
+    for name, function in stages:
+        if name in completed:
+            logging.info("Skipping stage {}, completed at {}".format(name, completed[name].completed_at))
+            continue
+
+        logging.info("Starting stage {}".format(name))
+        start = time.time()
+        try:
+            details = function()
+            completed[name] = LoadStage(pipeline, name, time.time() - start, details)
+            session.add(completed[name])
+            session.commit()
+        except:
+            session.rollback()
+            logging.error("Stage {} failed, rerun to resume from it".format(name))
+            raise
+        logging.info("Completed stage {} in {:.1f}s".format(name, completed[name].seconds))
+    return completed
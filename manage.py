@@ -36,19 +36,23 @@ class CreateAndPopulateDB(Command):
             Option('--db', dest='db', help='Database name'),
             Option('--data', dest='data', help='Data from data/ dir to be loaded into the database'),
             Option('--sample_set', dest='sample_set', help='Sample set from where sample info and quantification data should be loaded'),
-            Option('--root_path', dest='root_path', help='Root path to where data dir is located, needed for populate script')
+            Option('--root_path', dest='root_path', help='Root path to where data dir is located, needed for populate script'),
+            Option('--bulk_load', dest='bulk_load', action='store_true', help='Load without indexes and constraints and build them afterwards'),
+            Option('--resume', dest='resume', action='store_true', help='Keep the db and resume the load from the stage where it failed')
             )
 
-    def run(self, db, data, sample_set, root_path):
+    def run(self, db, data, sample_set, root_path, bulk_load, resume):
         assert os.environ['DATABASE_URL'].endswith(db)
-        _drop_and_recreate_db(db)
-        print("Upgrade")
-        check_call(["python", "manage.py", "db", "upgrade"])
-        print("Migrate")
-        check_call(["python", "manage.py", "db", "migrate"])
-        print("Upgrade")
-        check_call(["python", "manage.py", "db", "upgrade"])
+        if not resume:
+            _drop_and_recreate_db(db)
+            print("Upgrade")
+            check_call(["python", "manage.py", "db", "upgrade"])
+            print("Migrate")
+            check_call(["python", "manage.py", "db", "migrate"])
+            print("Upgrade")
+            check_call(["python", "manage.py", "db", "upgrade"])
         print("Populate db")
+        bulk_load_args = ["--bulk_load"] if bulk_load else []
         check_call(["time", "python", "populate_db.py", \
             "--sample_info",  "data/{0}/{1}/sample_info.csv".format(data, sample_set), \
             "--pfam_annotation_info", "data/{}/annotation_info/all_pfam_annotation_info.tsv".format(data), \
@@ -64,8 +68,7 @@ class CreateAndPopulateDB(Command):
             "--gene_counts", "data/{}/{}/all_genes.tpm.tsv.gz".format(data, sample_set), \
             "--metadata_reference", "data/{}/metadata_reference.tsv".format(data), \
             "--reference_assembly", "megahit_coassembly.0", \
-            "--tmp_file", "{}/data/{}/tmp_file.csv".format(root_path, data), \
-            "--taxonomy_per_gene", "{}/data/{}/lca_megan.tsv".format(root_path, data)])
+            "--taxonomy_per_gene", "{}/data/{}/lca_megan.tsv".format(root_path, data)] + bulk_load_args)
 
 class AddSampleSetCounts(Command):
     "Populates a db with new sample set counts"
@@ -84,8 +87,7 @@ class AddSampleSetCounts(Command):
         check_call(["time", "python", "add_sample_set_to_db.py", \
             "--sample_info",  "data/{0}/{1}/sample_info.csv".format(data, sample_set), \
             "--gene_counts", "data/{}/{}/all_genes.tpm.tsv.gz".format(data, sample_set), \
-            "--metadata_reference", "data/{}/metadata_reference.tsv".format(data), \
-            "--tmp_file", "{}/data/{}/tmp_file.csv".format(root_path, data)])
+            "--metadata_reference", "data/{}/metadata_reference.tsv".format(data)])
 
 manager.add_command('create_db', CreateAndPopulateDB)
 manager.add_command('create_empty', CreateEmpty)
@@ -30,10 +30,17 @@ SOFTWARE.
 
 # Many thanks to Mike Bayer (@zzzeek) for his help.
 
+import concurrent.futures
+import logging
+import time
+
 from sqlalchemy.ext import compiler
 from sqlalchemy.schema import DDLElement
 from app import db
 
+# The tables and views each materialized view is selected from, see create_mat_view
+MAT_VIEW_DEPENDENCIES = {}
+
 
 class CreateMaterializedView(DDLElement):
     def __init__(self, name, selectable):
@@ -51,7 +58,8 @@ def compile(element, compiler, **kw):
         )
 
 
-def create_mat_view(name, selectable, metadata=db.metadata):
+def create_mat_view(name, selectable, metadata=db.metadata, depends_on=()):
+    MAT_VIEW_DEPENDENCIES[name] = list(depends_on)
     _mt = db.MetaData() # temp metadata just for initial Table object creation
     t = db.Table(name, _mt) # the actual mat view class is bound to db.metadata
     for c in selectable.c:
@@ -73,21 +81,77 @@ def create_mat_view(name, selectable, metadata=db.metadata):
     return t
 
 
-def refresh_mat_view(name, concurrently):
-    # since session.execute() bypasses autoflush, must manually flush in order
-    # to include newly-created/modified objects in the refresh
-    db.session.flush()
+def refresh_mat_view(name, concurrently, connection=None):
+    if connection is None:
+        # since session.execute() bypasses autoflush, must manually flush in order
+        # to include newly-created/modified objects in the refresh
+        db.session.flush()
+        connection = db.session
     _con = 'CONCURRENTLY ' if concurrently else ''
-    db.session.execute('REFRESH MATERIALIZED VIEW ' + _con + name)
+    connection.execute('REFRESH MATERIALIZED VIEW ' + _con + name)
+
+
+def mat_view_names():
+    return db.inspect(db.engine).get_view_names()
+
+
+def refresh_in_order(refreshers, dependencies=None, max_workers=1):
+    '''Runs refreshers, a dict from table or view name to a function that
+    refreshes it given a connection, with each one started only after the
+    ones it depends on have finished. dependencies maps names to the
+    names they depend on; dependencies without a refresher are ignored.
+
+    With max_workers 1 everything runs in order in the current session.
+    Otherwise independent refreshers run concurrently, each on a
+    connection and in a transaction of its own, so that a full refresh
+    takes about as long as the slowest chain of dependent views.
+
+    Returns a dict from name to the seconds taken and the resulting
+    number of rows, which are also logged.'''
+    dependencies = dict((name, [dependency for dependency in (dependencies or {}).get(name, [])
+        if dependency in refreshers]) for name in refreshers)
+    stats = {}
+
+    def run(name, connection):
+        start = time.time()
+        refreshers[name](connection)
+        nr_rows = connection.execute('SELECT count(*) FROM ' + name).scalar()
+        seconds = time.time() - start
+        logging.info("Refreshed {} in {:.1f}s, {} rows".format(name, seconds, nr_rows))
+        return seconds, nr_rows
+
+    def run_on_own_connection(name):
+        with db.engine.begin() as connection:
+            return run(name, connection)
+
+    waiting = set(refreshers)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or running:
+            ready = sorted(name for name in waiting
+                    if all(dependency in stats for dependency in dependencies[name]))
+            if not ready and not running:
+                raise ValueError("Circular dependencies between: {}".format(', '.join(sorted(waiting))))
+            for name in ready:
+                waiting.remove(name)
+                if max_workers == 1:
+                    stats[name] = run(name, db.session)
+                else:
+                    running[executor.submit(run_on_own_connection, name)] = name
+            if running:
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    stats[running.pop(future)] = future.result()
+    return stats
 
 
 def refresh_all_mat_views(concurrently=True):
-    '''Refreshes all materialized views. Currently, views are refreshed in
-    non-deterministic order, so view definitions can't depend on each other.'''
-    # TODO use `include='materialized'` once https://bitbucket.org/zzzeek/sqlalchemy/issues/3588/ lands
-    mat_views = db.inspect(db.engine).get_view_names()
-    for v in mat_views:
-        refresh_mat_view(v, concurrently)
+    '''Refreshes all materialized views in the current session, each one
+    after the views it depends on.'''
+    db.session.flush()
+    refreshers = dict((name, lambda connection, name=name: refresh_mat_view(name, concurrently, connection))
+            for name in mat_view_names())
+    return refresh_in_order(refreshers, MAT_VIEW_DEPENDENCIES)
 
 
 class MaterializedView(db.Model):
@@ -0,0 +1,27 @@
+"""Trigram indexes for the annotation search
+
+Revision ID: 4b6c1e8f2a7d
+Revises: dfdba5c8095d
+Create Date: 2026-10-18 10:12:31.502113
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b6c1e8f2a7d'
+down_revision = 'dfdba5c8095d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('annotation_type_identifier_trgm_idx', 'annotation', ['type_identifier'], unique=False,
+            postgresql_using='gin', postgresql_ops={'type_identifier': 'gin_trgm_ops'})
+    op.create_index('annotation_description_trgm_idx', 'annotation', ['description'], unique=False,
+            postgresql_using='gin', postgresql_ops={'description': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('annotation_description_trgm_idx', table_name='annotation')
+    op.drop_index('annotation_type_identifier_trgm_idx', table_name='annotation')
@@ -0,0 +1,36 @@
+"""Gene counts stored as one vector per gene
+
+Revision ID: 5e2b7c9a4f13
+Revises: 9d3f5a1c7e20
+Create Date: 2026-10-18 14:21:05.310442
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e2b7c9a4f13'
+down_revision = '9d3f5a1c7e20'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.create_table('gene_count_vector_sample',
+    sa.Column('position', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('sample_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['sample_id'], ['sample.id'], ),
+    sa.PrimaryKeyConstraint('position'),
+    sa.UniqueConstraint('sample_id')
+    )
+    op.create_table('gene_count_vector',
+    sa.Column('gene_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('rpkms', postgresql.ARRAY(sa.REAL()), nullable=True),
+    sa.ForeignKeyConstraint(['gene_id'], ['gene.id'], ),
+    sa.PrimaryKeyConstraint('gene_id')
+    )
+
+
+def downgrade():
+    op.drop_table('gene_count_vector')
+    op.drop_table('gene_count_vector_sample')
@@ -0,0 +1,31 @@
+"""load_stage, the completed stages of the loaders
+
+Revision ID: 6d1b8e3f0c52
+Revises: a4e7d2c19b38
+Create Date: 2026-10-18 19:12:37.518204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6d1b8e3f0c52'
+down_revision = 'a4e7d2c19b38'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('load_stage',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('pipeline', sa.String(), nullable=False),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('completed_at', sa.DateTime(), server_default=sa.text('now()'), nullable=True),
+        sa.Column('seconds', sa.Float(), nullable=True),
+        sa.Column('details', sa.JSON(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('pipeline', 'name', name='load_stage_unique')
+    )
+
+
+def downgrade():
+    op.drop_table('load_stage')
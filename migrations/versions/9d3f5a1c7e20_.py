@@ -0,0 +1,24 @@
+"""Trigram index for the taxonomy search
+
+Revision ID: 9d3f5a1c7e20
+Revises: 4b6c1e8f2a7d
+Create Date: 2026-10-18 11:02:47.918204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9d3f5a1c7e20'
+down_revision = '4b6c1e8f2a7d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('taxon_full_taxonomy_trgm_idx', 'taxon', ['full_taxonomy'], unique=False,
+            postgresql_using='gin', postgresql_ops={'full_taxonomy': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('taxon_full_taxonomy_trgm_idx', table_name='taxon')
@@ -0,0 +1,114 @@
+"""rpkm_table and taxon_rpkm_table as incrementally maintained tables
+
+The two materialized views become ordinary tables that the loaders
+update for the samples they load. taxon_level_rpkm_table stays a
+materialized view, now built from taxon_rpkm_table.
+
+Revision ID: a4e7d2c19b38
+Revises: c81f4d2e6a95
+Create Date: 2026-10-18 16:40:12.904127
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a4e7d2c19b38'
+down_revision = 'c81f4d2e6a95'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+TAXON_LEVELS = ['superkingdom', 'phylum', 'taxclass', 'order', 'family', 'genus', 'species']
+
+RPKM_TABLE_QUERY = ("SELECT annotation.id AS annotation_id, annotation.annotation_type AS annotation_type, "
+        "sample.id AS sample_id, sample.scilifelab_code AS sample_scilifelab_code, sum(gene_count.rpkm) AS rpkm "
+        "FROM sample JOIN gene_count ON sample.id = gene_count.sample_id "
+        "JOIN gene ON gene.id = gene_count.gene_id "
+        "JOIN gene_annotation ON gene.id = gene_annotation.gene_id "
+        "JOIN annotation ON annotation.id = gene_annotation.annotation_id "
+        "GROUP BY annotation.id, sample.id")
+
+TAXON_RPKM_TABLE_QUERY = ("SELECT taxon.id AS taxon_id, sample.id AS sample_id, "
+        "sample.scilifelab_code AS sample_scilifelab_code, sum(gene_count.rpkm) AS rpkm "
+        "FROM sample JOIN gene_count ON sample.id = gene_count.sample_id "
+        "JOIN gene ON gene.id = gene_count.gene_id "
+        "JOIN taxon ON taxon.id = gene.taxon_id "
+        "GROUP BY taxon.id, sample.id")
+
+
+def _taxon_level_query(source, sample_id, sample_scilifelab_code, rpkm, group_by_sample):
+    return " UNION ALL ".join(
+            "SELECT '{0}' AS level, taxon.up_to_{0} AS complete_taxonomy, "
+            "NOT taxon.up_to_{0} LIKE '%;;' AS classified, {2} AS sample_id, "
+            "{3} AS sample_scilifelab_code, sum({4}) AS rpkm "
+            "FROM {1} GROUP BY taxon.up_to_{0}, {5}".format(
+                level, source, sample_id, sample_scilifelab_code, rpkm, group_by_sample)
+            for level in TAXON_LEVELS)
+
+
+def _create_taxon_level_view(query):
+    op.execute("CREATE MATERIALIZED VIEW taxon_level_rpkm_table AS {}".format(query))
+    op.execute("CREATE UNIQUE INDEX taxon_level_rpkm_table_mv_id_idx ON taxon_level_rpkm_table "
+            "(level, complete_taxonomy, sample_id)")
+
+
+def _has_taxon_level_view():
+    return op.get_bind().execute("SELECT 1 FROM pg_matviews WHERE schemaname = current_schema() "
+            "AND matviewname = 'taxon_level_rpkm_table'").first() is not None
+
+
+def upgrade():
+    had_taxon_level_view = _has_taxon_level_view()
+    op.execute('DROP MATERIALIZED VIEW IF EXISTS taxon_level_rpkm_table')
+    op.execute('DROP MATERIALIZED VIEW IF EXISTS taxon_rpkm_table')
+    op.execute('DROP MATERIALIZED VIEW IF EXISTS rpkm_table')
+
+    op.create_table('rpkm_table',
+    sa.Column('annotation_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('annotation_type', sa.String(), nullable=True),
+    sa.Column('sample_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('sample_scilifelab_code', sa.String(length=11), nullable=True),
+    sa.Column('rpkm', sa.Float(), nullable=True),
+    sa.PrimaryKeyConstraint('annotation_id', 'sample_id')
+    )
+    op.create_index(op.f('ix_rpkm_table_sample_id'), 'rpkm_table', ['sample_id'], unique=False)
+    op.create_table('taxon_rpkm_table',
+    sa.Column('taxon_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('sample_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('sample_scilifelab_code', sa.String(length=11), nullable=True),
+    sa.Column('rpkm', sa.Float(), nullable=True),
+    sa.PrimaryKeyConstraint('taxon_id', 'sample_id')
+    )
+    op.create_index(op.f('ix_taxon_rpkm_table_sample_id'), 'taxon_rpkm_table', ['sample_id'], unique=False)
+
+    op.execute("INSERT INTO rpkm_table (annotation_id, annotation_type, sample_id, sample_scilifelab_code, rpkm) "
+            + RPKM_TABLE_QUERY)
+    op.execute("INSERT INTO taxon_rpkm_table (taxon_id, sample_id, sample_scilifelab_code, rpkm) "
+            + TAXON_RPKM_TABLE_QUERY)
+
+    if had_taxon_level_view:
+        _create_taxon_level_view(_taxon_level_query(
+            "taxon_rpkm_table JOIN taxon ON taxon_rpkm_table.taxon_id = taxon.id",
+            "taxon_rpkm_table.sample_id", "taxon_rpkm_table.sample_scilifelab_code",
+            "taxon_rpkm_table.rpkm",
+            "taxon_rpkm_table.sample_id, taxon_rpkm_table.sample_scilifelab_code"))
+
+
+def downgrade():
+    had_taxon_level_view = _has_taxon_level_view()
+    op.execute('DROP MATERIALIZED VIEW IF EXISTS taxon_level_rpkm_table')
+    op.drop_index(op.f('ix_taxon_rpkm_table_sample_id'), table_name='taxon_rpkm_table')
+    op.drop_table('taxon_rpkm_table')
+    op.drop_index(op.f('ix_rpkm_table_sample_id'), table_name='rpkm_table')
+    op.drop_table('rpkm_table')
+
+    op.execute("CREATE MATERIALIZED VIEW rpkm_table AS " + RPKM_TABLE_QUERY)
+    op.execute("CREATE UNIQUE INDEX rpkm_table_mv_id_idx ON rpkm_table (annotation_id, sample_id)")
+    op.execute("CREATE MATERIALIZED VIEW taxon_rpkm_table AS " + TAXON_RPKM_TABLE_QUERY)
+    op.execute("CREATE UNIQUE INDEX taxon_rpkm_table_mv_id_idx ON taxon_rpkm_table (taxon_id, sample_id)")
+
+    if had_taxon_level_view:
+        _create_taxon_level_view(_taxon_level_query(
+            "sample JOIN gene_count ON sample.id = gene_count.sample_id "
+            "JOIN gene ON gene.id = gene_count.gene_id JOIN taxon ON taxon.id = gene.taxon_id",
+            "sample.id", "sample.scilifelab_code", "gene_count.rpkm", "sample.id"))
@@ -0,0 +1,73 @@
+"""taxon_level_rpkm_table as an incrementally maintained table
+
+Like rpkm_table and taxon_rpkm_table, the materialized view becomes an
+ordinary table that the loaders update for the samples they load,
+instead of a view refreshed over every sample.
+
+Revision ID: b7d2e9f4a1c3
+Revises: f1c4b7e2d9a6
+Create Date: 2026-10-18 22:14:48.306915
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2e9f4a1c3'
+down_revision = 'f1c4b7e2d9a6'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+TAXON_LEVELS = ['superkingdom', 'phylum', 'taxclass', 'order', 'family', 'genus', 'species']
+
+
+def _taxon_level_query():
+    selects = []
+    for i, level in enumerate(TAXON_LEVELS):
+        if i == 0:
+            parent_column = "CAST(NULL AS VARCHAR)"
+            group_by_parent = ""
+        else:
+            parent_column = "taxon.up_to_{}".format(TAXON_LEVELS[i-1])
+            group_by_parent = ", " + parent_column
+        selects.append("SELECT '{0}' AS level, taxon.up_to_{0} AS complete_taxonomy, "
+                "{1} AS parent_taxonomy, NOT taxon.up_to_{0} LIKE '%;;' AS classified, "
+                "taxon_rpkm_table.sample_id AS sample_id, "
+                "taxon_rpkm_table.sample_scilifelab_code AS sample_scilifelab_code, "
+                "sum(taxon_rpkm_table.rpkm) AS rpkm "
+                "FROM taxon_rpkm_table JOIN taxon ON taxon_rpkm_table.taxon_id = taxon.id "
+                "GROUP BY taxon.up_to_{0}, taxon_rpkm_table.sample_id, "
+                "taxon_rpkm_table.sample_scilifelab_code{2}".format(level, parent_column, group_by_parent))
+    return " UNION ALL ".join(selects)
+
+
+def upgrade():
+    op.execute('DROP MATERIALIZED VIEW IF EXISTS taxon_level_rpkm_table')
+
+    op.create_table('taxon_level_rpkm_table',
+    sa.Column('level', sa.String(), nullable=False),
+    sa.Column('complete_taxonomy', sa.String(), nullable=False),
+    sa.Column('sample_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('parent_taxonomy', sa.String(), nullable=True),
+    sa.Column('classified', sa.Boolean(), nullable=True),
+    sa.Column('sample_scilifelab_code', sa.String(length=11), nullable=True),
+    sa.Column('rpkm', sa.Float(), nullable=True),
+    sa.PrimaryKeyConstraint('level', 'complete_taxonomy', 'sample_id')
+    )
+    op.create_index(op.f('ix_taxon_level_rpkm_table_sample_id'), 'taxon_level_rpkm_table', ['sample_id'], unique=False)
+    op.create_index('taxon_level_rpkm_table_parent_idx', 'taxon_level_rpkm_table', ['level', 'parent_taxonomy'], unique=False)
+
+    op.execute("INSERT INTO taxon_level_rpkm_table (level, complete_taxonomy, parent_taxonomy, classified, "
+            "sample_id, sample_scilifelab_code, rpkm) " + _taxon_level_query())
+
+
+def downgrade():
+    op.drop_index('taxon_level_rpkm_table_parent_idx', table_name='taxon_level_rpkm_table')
+    op.drop_index(op.f('ix_taxon_level_rpkm_table_sample_id'), table_name='taxon_level_rpkm_table')
+    op.drop_table('taxon_level_rpkm_table')
+
+    op.execute("CREATE MATERIALIZED VIEW taxon_level_rpkm_table AS " + _taxon_level_query())
+    op.execute("CREATE UNIQUE INDEX taxon_level_rpkm_table_mv_id_idx ON taxon_level_rpkm_table "
+            "(level, complete_taxonomy, sample_id)")
+    op.execute("CREATE INDEX taxon_level_rpkm_table_parent_idx ON taxon_level_rpkm_table "
+            "(level, parent_taxonomy)")
@@ -0,0 +1,96 @@
+"""Partition gene_count by sample set
+
+gene_count is rebuilt as a table partitioned by LIST (sample_set_id),
+with one partition per existing sample set and a default partition.
+The materialized views reading gene_count are dropped together with the
+old table and recreated from their previous definitions.
+
+Revision ID: c81f4d2e6a95
+Revises: 5e2b7c9a4f13
+Create Date: 2026-10-18 15:02:33.517804
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c81f4d2e6a95'
+down_revision = '5e2b7c9a4f13'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def _saved_mat_views(conn):
+    views = conn.execute("SELECT matviewname, definition FROM pg_matviews "
+            "WHERE schemaname = current_schema()").fetchall()
+    indexes = conn.execute("SELECT tablename, indexdef FROM pg_indexes "
+            "WHERE schemaname = current_schema() AND tablename IN "
+            "(SELECT matviewname FROM pg_matviews WHERE schemaname = current_schema())").fetchall()
+    return views, indexes
+
+
+def _recreate_mat_views(conn, views, indexes, old_table, new_table):
+    existing = set(name for name, in conn.execute("SELECT matviewname FROM pg_matviews "
+            "WHERE schemaname = current_schema()").fetchall())
+    for name, definition in views:
+        if name in existing:
+            continue
+        definition = definition.replace(old_table, new_table)
+        op.execute('CREATE MATERIALIZED VIEW {} AS {}'.format(name, definition))
+        for table_name, indexdef in indexes:
+            if table_name == name:
+                op.execute(indexdef)
+
+
+def _replace_gene_count(partitioned):
+    conn = op.get_bind()
+    views, indexes = _saved_mat_views(conn)
+
+    op.execute('ALTER TABLE gene_count RENAME TO gene_count_old')
+    op.execute('ALTER TABLE gene_count_old RENAME CONSTRAINT gene_count_pkey TO gene_count_old_pkey')
+    op.execute('ALTER TABLE gene_count_old RENAME CONSTRAINT genecount_unique TO genecount_old_unique')
+    op.execute('ALTER INDEX ix_gene_count_gene_id RENAME TO ix_gene_count_old_gene_id')
+    op.execute('ALTER INDEX ix_gene_count_sample_id RENAME TO ix_gene_count_old_sample_id')
+    op.execute('ALTER SEQUENCE gene_count_id_seq RENAME TO gene_count_old_id_seq')
+
+    if partitioned:
+        op.execute('CREATE TABLE gene_count ('
+                'id SERIAL NOT NULL, '
+                'sample_set_id INTEGER NOT NULL, '
+                'sample_id INTEGER NOT NULL REFERENCES sample (id), '
+                'gene_id INTEGER NOT NULL REFERENCES gene (id), '
+                'rpkm FLOAT, '
+                'PRIMARY KEY (id, sample_set_id), '
+                'CONSTRAINT genecount_unique UNIQUE (sample_set_id, sample_id, gene_id)'
+                ') PARTITION BY LIST (sample_set_id)')
+        op.execute('CREATE TABLE gene_count_default PARTITION OF gene_count DEFAULT')
+        for sample_set_id, in conn.execute('SELECT id FROM sample_set').fetchall():
+            op.execute('CREATE TABLE gene_count_{0} PARTITION OF gene_count FOR VALUES IN ({0})'.format(int(sample_set_id)))
+        op.execute('INSERT INTO gene_count (id, sample_set_id, sample_id, gene_id, rpkm) '
+                'SELECT gene_count_old.id, coalesce(sample.sample_set_id, 0), gene_count_old.sample_id, '
+                'gene_count_old.gene_id, gene_count_old.rpkm '
+                'FROM gene_count_old JOIN sample ON sample.id = gene_count_old.sample_id')
+    else:
+        op.execute('CREATE TABLE gene_count ('
+                'id SERIAL NOT NULL, '
+                'sample_id INTEGER NOT NULL REFERENCES sample (id), '
+                'gene_id INTEGER NOT NULL REFERENCES gene (id), '
+                'rpkm FLOAT, '
+                'PRIMARY KEY (id), '
+                'CONSTRAINT genecount_unique UNIQUE (sample_id, gene_id))')
+        op.execute('INSERT INTO gene_count (id, sample_id, gene_id, rpkm) '
+                'SELECT id, sample_id, gene_id, rpkm FROM gene_count_old')
+
+    op.execute('CREATE INDEX ix_gene_count_gene_id ON gene_count (gene_id)')
+    op.execute('CREATE INDEX ix_gene_count_sample_id ON gene_count (sample_id)')
+    op.execute("SELECT setval('gene_count_id_seq', coalesce((SELECT max(id) FROM gene_count), 0) + 1, false)")
+
+    op.execute('DROP TABLE gene_count_old CASCADE')
+    _recreate_mat_views(conn, views, indexes, 'gene_count_old', 'gene_count')
+
+
+def upgrade():
+    _replace_gene_count(partitioned=True)
+
+
+def downgrade():
+    _replace_gene_count(partitioned=False)
@@ -0,0 +1,30 @@
+"""dbcan, carbohydrate-active enzyme annotations
+
+Revision ID: e3a9c5d7b214
+Revises: 6d1b8e3f0c52
+Create Date: 2026-10-18 20:03:51.772046
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e3a9c5d7b214'
+down_revision = '6d1b8e3f0c52'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('dbcan',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('cazy_class', sa.String(), nullable=True),
+        sa.Column('ncbi_cdd', sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(['id'], ['annotation.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_dbcan_cazy_class'), 'dbcan', ['cazy_class'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_dbcan_cazy_class'), table_name='dbcan')
+    op.drop_table('dbcan')
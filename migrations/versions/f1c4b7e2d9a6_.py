@@ -0,0 +1,67 @@
+"""parent_taxonomy in taxon_level_rpkm_table
+
+The complete taxonomy one level up is kept next to every row and
+indexed, so that the children of the taxa in the taxonomy table are
+found with an index lookup instead of prefix matches.
+
+Revision ID: f1c4b7e2d9a6
+Revises: e3a9c5d7b214
+Create Date: 2026-10-18 21:36:05.184420
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f1c4b7e2d9a6'
+down_revision = 'e3a9c5d7b214'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+TAXON_LEVELS = ['superkingdom', 'phylum', 'taxclass', 'order', 'family', 'genus', 'species']
+
+
+def _taxon_level_query(with_parent):
+    selects = []
+    for i, level in enumerate(TAXON_LEVELS):
+        parent_column = ''
+        group_by_parent = ''
+        if with_parent:
+            if i == 0:
+                parent_column = "CAST(NULL AS VARCHAR) AS parent_taxonomy, "
+            else:
+                parent_column = "taxon.up_to_{} AS parent_taxonomy, ".format(TAXON_LEVELS[i-1])
+                group_by_parent = ", taxon.up_to_{}".format(TAXON_LEVELS[i-1])
+        selects.append("SELECT '{0}' AS level, taxon.up_to_{0} AS complete_taxonomy, {1}"
+                "NOT taxon.up_to_{0} LIKE '%;;' AS classified, taxon_rpkm_table.sample_id AS sample_id, "
+                "taxon_rpkm_table.sample_scilifelab_code AS sample_scilifelab_code, "
+                "sum(taxon_rpkm_table.rpkm) AS rpkm "
+                "FROM taxon_rpkm_table JOIN taxon ON taxon_rpkm_table.taxon_id = taxon.id "
+                "GROUP BY taxon.up_to_{0}, taxon_rpkm_table.sample_id, "
+                "taxon_rpkm_table.sample_scilifelab_code{2}".format(level, parent_column, group_by_parent))
+    return " UNION ALL ".join(selects)
+
+
+def _has_taxon_level_view():
+    return op.get_bind().execute("SELECT 1 FROM pg_matviews WHERE schemaname = current_schema() "
+            "AND matviewname = 'taxon_level_rpkm_table'").first() is not None
+
+
+def _recreate_taxon_level_view(with_parent):
+    if not _has_taxon_level_view():
+        return
+    op.execute('DROP MATERIALIZED VIEW taxon_level_rpkm_table')
+    op.execute("CREATE MATERIALIZED VIEW taxon_level_rpkm_table AS {}".format(_taxon_level_query(with_parent)))
+    op.execute("CREATE UNIQUE INDEX taxon_level_rpkm_table_mv_id_idx ON taxon_level_rpkm_table "
+            "(level, complete_taxonomy, sample_id)")
+    if with_parent:
+        op.execute("CREATE INDEX taxon_level_rpkm_table_parent_idx ON taxon_level_rpkm_table "
+                "(level, parent_taxonomy)")
+
+
+def upgrade():
+    _recreate_taxon_level_view(True)
+
+
+def downgrade():
+    _recreate_taxon_level_view(False)
@@ -1,11 +1,37 @@
-from app import db
+from app import db, app
 import sqlalchemy
 from sqlalchemy import not_, inspect
-from materialized_view_factory import MaterializedView, create_mat_view
+from sqlalchemy.dialects.postgresql import array_agg, aggregate_order_by, ARRAY
+from materialized_view_factory import refresh_mat_view, refresh_in_order, mat_view_names, \
+        MAT_VIEW_DEPENDENCIES
+import rpkm_matrix
+import bulk_copy
 import collections
 import re
+import numpy as np
+import pandas as pd
 from flask_dance.consumer.storage.sqla import OAuthConsumerMixin
 
+# Needed for the trigram indexes used by the search
+db.event.listen(db.metadata, 'before_create', db.DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+
+# Value lists longer than this are sent to postgres as a single array
+IN_LIST_ARRAY_THRESHOLD = 100
+
+def in_list(column, values):
+    """ A filter for column being one of values.
+
+    Short lists become an ordinary IN (...) with one parameter per value.
+    Longer lists, e.g. thousands of gene names from a BLAST search, are
+    sent as a single array parameter and unnested in postgres, which keeps
+    the statement short and lets postgres use a hashed semi join.
+    """
+    values = list(values)
+    if len(values) <= IN_LIST_ARRAY_THRESHOLD:
+        return column.in_(values)
+    values_array = sqlalchemy.literal(values, type_=ARRAY(column.type))
+    return column.in_(sqlalchemy.select([sqlalchemy.func.unnest(values_array)]))
+
 user_to_sampleset = db.Table('user_to_sampleset',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
     db.Column('sample_set_id', db.Integer, db.ForeignKey('sample_set.id'))
@@ -169,6 +195,31 @@ class SampleProperty(db.Model):
     def __repr__(self):
         return '<SampleProperty {}>'.format(self.id)
 
+    @classmethod
+    def copy_properties(cls, session, properties):
+        """Adds the properties in the data frame properties, with name,
+        value, unit and sample_id columns, in one copy and returns the
+        number of properties added."""
+        properties = properties[['name', 'value', 'unit', 'sample_id']].copy()
+        properties['value'] = properties['value'].map(cls.property_text)
+        return bulk_copy.copy_dataframe(session, properties, cls.__tablename__)
+
+    @staticmethod
+    def property_text(value):
+        """The value as text the way the database casts a float to varchar,
+        so missing measurements become NaN and 10.0 becomes 10."""
+        if value is None:
+            return None
+        if isinstance(value, (float, np.floating)):
+            value = float(value)
+            if value != value:
+                return 'NaN'
+            if value in (float('inf'), float('-inf')):
+                return 'Infinity' if value > 0 else '-Infinity'
+            text = repr(value)
+            return text[:-2] if text.endswith('.0') else text
+        return str(value)
+
     @classmethod
     def idable_property_name_(self, property_name):
         """A function to transform property name to \
@@ -232,6 +283,27 @@ class GeneAnnotation(db.Model):
         self.annotation_source = annotation_source
         self.e_value = e_value
 
+GeneSummary = collections.namedtuple('GeneSummary', ['id', 'name'])
+
+class AnnotationSummary(collections.namedtuple('AnnotationSummary',
+        ['annotation_type', 'type_identifier', 'description'])):
+    """ The parts of an annotation shown in the gene tables, without
+    loading the Annotation object. The external link and pretty name are
+    taken from the Annotation subclass for the annotation type."""
+    __slots__ = ()
+
+    @property
+    def _annotation_class(self):
+        return Annotation.__mapper__.polymorphic_map[self.annotation_type].class_
+
+    @property
+    def external_link(self):
+        return self._annotation_class.external_link.fget(self)
+
+    @property
+    def pretty_name(self):
+        return self._annotation_class.pretty_name.fget(self)
+
 class Gene(db.Model):
     __tablename__ = 'gene'
     __table_args__ = (
@@ -277,53 +349,88 @@ class Gene(db.Model):
     @classmethod
     def get_genes(self, gene_id_list):
         genes = db.session.query(Gene.name).\
-                filter(Gene.name.in_(gene_id_list)).all()
+                filter(in_list(Gene.name, gene_id_list)).all()
         return genes
 
     @classmethod
-    def rpkm_table(self, gene_name_list, samples=None):
-        q = db.session.query(Gene.name, Gene, Sample, GeneCount.rpkm).\
-                join(GeneCount).\
-                filter(Sample.id == GeneCount.sample_id).\
-                join(Sample).\
-                filter(Gene.name.in_(gene_name_list)).\
-                filter(GeneCount.gene_id == Gene.id).\
-                order_by(Gene.name, Sample.scilifelab_code)
-
-        table_items = q.all()
+    def rpkm_table(self, gene_name_list, samples=None, sample_set_ids=None):
+        """ The rpkm values, annotations and taxonomy for the genes in
+        gene_name_list, fetched as one row per gene. If sample_set_ids is
+        given, only counts from samples in those sample sets are included,
+        which lets postgres skip the partitions of all other sample sets.
+
+        The counts and annotations are aggregated into arrays ordered by
+        sample id and annotation id respectively, so that no Gene or
+        Annotation objects are loaded. The genes in the table are
+        GeneSummary tuples and the annotations AnnotationSummary tuples.
+        """
+        gene_ids = db.session.query(Gene.id).\
+                filter(in_list(Gene.name, gene_name_list))
+
+        if app.config.get('GENE_COUNT_VECTORS'):
+            counts = GeneCountVector.counts_subquery(gene_ids, sample_set_ids)
+        else:
+            counts = db.session.query(
+                        GeneCount.gene_id.label('gene_id'),
+                        array_agg(aggregate_order_by(GeneCount.sample_id, GeneCount.sample_id)).label('sample_ids'),
+                        array_agg(aggregate_order_by(GeneCount.rpkm, GeneCount.sample_id)).label('rpkms')).\
+                    filter(GeneCount.gene_id.in_(gene_ids))
+            if sample_set_ids is not None:
+                counts = counts.filter(GeneCount.sample_set_id.in_(sample_set_ids))
+            counts = counts.group_by(GeneCount.gene_id).subquery()
+
+        annotations = db.session.query(
+                    GeneAnnotation.gene_id.label('gene_id'),
+                    array_agg(aggregate_order_by(Annotation.annotation_type, Annotation.id)).label('annotation_types'),
+                    array_agg(aggregate_order_by(Annotation.type_identifier, Annotation.id)).label('type_identifiers'),
+                    array_agg(aggregate_order_by(Annotation.description, Annotation.id)).label('descriptions')).\
+                join(Annotation, Annotation.id == GeneAnnotation.annotation_id).\
+                filter(GeneAnnotation.gene_id.in_(gene_ids)).\
+                group_by(GeneAnnotation.gene_id).\
+                subquery()
+
+        q = db.session.query(Gene.id, Gene.name, Taxon.full_taxonomy,
+                    counts.c.sample_ids, counts.c.rpkms,
+                    annotations.c.annotation_types, annotations.c.type_identifiers,
+                    annotations.c.descriptions).\
+                join(counts, counts.c.gene_id == Gene.id).\
+                outerjoin(annotations, annotations.c.gene_id == Gene.id).\
+                outerjoin(Taxon, Taxon.id == Gene.taxon_id).\
+                filter(in_list(Gene.name, gene_name_list))
+
+        gene_rows = q.all()
+
+        # The samples are the only objects loaded, since they are
+        # used as keys together with the sample sets
+        all_sample_ids = set()
+        for gene_row in gene_rows:
+            all_sample_ids.update(gene_row.sample_ids)
+        id_to_sample = {}
+        if all_sample_ids:
+            id_to_sample = {sample.id: sample for sample in
+                    Sample.query.filter(Sample.id.in_(all_sample_ids)).all()}
 
-        samples = set()
         unsorted_table = {}
-        gene_name_to_gene = {} # Translate name to database object
-        for gene_name, gene, sample, count in table_items:
-            if gene not in unsorted_table:
-                unsorted_table[gene] = {}
-                gene_name_to_gene[gene_name] = gene
-            unsorted_table[gene][sample] = "{0:.4f}".format(count)
-            samples.add(sample)
+        gene_name_to_gene = {} # Translate name to table key
+        for gene_id, gene_name, full_taxonomy, sample_ids, rpkms, \
+                annotation_types, type_identifiers, descriptions in gene_rows:
+            gene = GeneSummary(gene_id, gene_name)
+            gene_name_to_gene[gene_name] = gene
 
+            sample_d = {id_to_sample[sample_id]: "{0:.4f}".format(rpkm)
+                    for sample_id, rpkm in zip(sample_ids, rpkms)}
 
-        annotation_items = db.session.query(Gene, Annotation).\
-                join(GeneAnnotation).\
-                filter(Annotation.id == GeneAnnotation.annotation_id).\
-                filter(Gene.id == GeneAnnotation.gene_id).\
-                filter(Gene.name.in_(gene_name_list)).all()
-
-        for gene, annotation in annotation_items:
-            if gene in unsorted_table:
-                if 'annotations' not in unsorted_table[gene]:
-                    unsorted_table[gene]['annotations'] = collections.defaultdict(list)
-                unsorted_table[gene]['annotations'][annotation.pretty_name].append(annotation)
+            if type_identifiers:
+                sample_d['annotations'] = collections.defaultdict(list)
+                for annotation in map(AnnotationSummary, annotation_types, type_identifiers, descriptions):
+                    sample_d['annotations'][annotation.pretty_name].append(annotation)
 
-        taxon_items = db.session.query(Gene, Taxon).\
-                filter(Taxon.id == Gene.taxon_id).\
-                filter(Gene.name.in_(gene_name_list)).all()
+            if full_taxonomy is not None:
+                sample_d['taxonomy'] = full_taxonomy
 
-        for gene, taxon in taxon_items:
-            if gene in unsorted_table:
-                unsorted_table[gene]['taxonomy'] = taxon.full_taxonomy
+            unsorted_table[gene] = sample_d
 
-        samples = sorted(list(samples), key=lambda x: x.scilifelab_code)
+        samples = sorted(id_to_sample.values(), key=lambda x: x.scilifelab_code)
 
         table = collections.OrderedDict()
         for gene_name in gene_name_list:
@@ -333,12 +440,58 @@ class Gene(db.Model):
 
         return samples, table
 
+    @classmethod
+    def samples_with_counts_for_annotations(self, annotation_ids):
+        """ All samples with a count for any gene with one of the annotations"""
+        has_count = db.session.query(GeneCount.id).\
+                join(GeneAnnotation, GeneAnnotation.gene_id == GeneCount.gene_id).\
+                filter(GeneCount.sample_id == Sample.id).\
+                filter(in_list(GeneAnnotation.annotation_id, annotation_ids)).\
+                exists()
+        return Sample.query.filter(has_count).order_by(Sample.scilifelab_code).all()
+
+    @classmethod
+    def rpkm_table_pages(self, annotation_ids, page_size=1000):
+        """ Yields the rpkm table, as returned by rpkm_table, for all genes
+        with any of the annotations, page_size genes at a time.
+
+        The genes are paged by id (keyset pagination), so that each page
+        is a separate small query and only one page is held in memory.
+        Sample objects are shared with the rest of the session, so the
+        samples from samples_with_counts_for_annotations can be used as keys."""
+        annotated_gene_ids = db.session.query(GeneAnnotation.gene_id).\
+                filter(in_list(GeneAnnotation.annotation_id, annotation_ids))
+        q = db.session.query(Gene.id, Gene.name).\
+                filter(Gene.id.in_(annotated_gene_ids)).\
+                order_by(Gene.id)
+
+        last_id = None
+        while True:
+            q_page = q
+            if last_id is not None:
+                q_page = q_page.filter(Gene.id > last_id)
+            page = q_page.limit(page_size).all()
+            if len(page) == 0:
+                break
+            last_id = page[-1][0]
+
+            _, table = self.rpkm_table([gene_name for gene_id, gene_name in page])
+            yield table
+
 class GeneCount(db.Model):
+    """ gene_count is partitioned by sample set, with one partition per
+    sample set (see create_partition) and a default partition for counts
+    from sample sets without one. Counts for samples without a sample set
+    get sample_set_id 0."""
     __tablename__ = 'gene_count'
     __table_args__ = (
-        db.UniqueConstraint('sample_id', 'gene_id', name='genecount_unique'),
+        db.UniqueConstraint('sample_set_id', 'sample_id', 'gene_id', name='genecount_unique'),
+        {'postgresql_partition_by': 'LIST (sample_set_id)'}
         )
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # Part of the primary key since postgres requires the partition key to be
+    # included in every unique constraint of a partitioned table
+    sample_set_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
     sample_id = db.Column(db.Integer, db.ForeignKey('sample.id'),
             nullable=False, index=True)
     sample = db.relationship('Sample',
@@ -356,8 +509,175 @@ class GeneCount(db.Model):
         self.sample = sample
         self.rpkm = rpkm
 
+    @classmethod
+    def partition_name(self, sample_set_id):
+        return 'gene_count_{}'.format(int(sample_set_id))
+
+    @classmethod
+    def create_partition(self, sample_set_id):
+        """ Creates the partition holding the counts for the sample set,
+        unless it already exists"""
+        db.session.execute("CREATE TABLE IF NOT EXISTS {} PARTITION OF gene_count FOR VALUES IN ({});".format(
+            self.partition_name(sample_set_id), int(sample_set_id)))
+
+    @classmethod
+    def drop_partition(self, sample_set_id):
+        """ Removes all counts for the sample set at once by dropping its partition"""
+        partition_name = self.partition_name(sample_set_id)
+        exists = db.session.execute("SELECT to_regclass(:name)", {'name': partition_name}).scalar()
+        if exists is not None:
+            db.session.execute("ALTER TABLE gene_count DETACH PARTITION {};".format(partition_name))
+            db.session.execute("DROP TABLE {};".format(partition_name))
+
+@db.event.listens_for(GeneCount, 'before_insert')
+def _set_gene_count_sample_set(mapper, connection, gene_count):
+    if gene_count.sample_set_id is None:
+        sample = gene_count.sample
+        if sample is not None and sample.sample_set_id is not None:
+            gene_count.sample_set_id = sample.sample_set_id
+        else:
+            gene_count.sample_set_id = 0
+
+db.event.listen(GeneCount.__table__, 'after_create',
+        db.DDL('CREATE TABLE gene_count_default PARTITION OF gene_count DEFAULT'))
+
+class GeneCountVectorSample(db.Model):
+    """ The position of a sample in the gene count vectors.
+
+    Positions start at 1, as postgres array subscripts do."""
+    __tablename__ = 'gene_count_vector_sample'
+    position = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    sample_id = db.Column(db.Integer, db.ForeignKey('sample.id'),
+            nullable=False, unique=True)
+    sample = db.relationship('Sample')
+
+    def __init__(self, position, sample_id):
+        self.position = position
+        self.sample_id = sample_id
+
+    @classmethod
+    def add_samples(self, sample_ids):
+        """ Gives the samples the positions following the last used one
+        and returns a dict from sample id to position."""
+        already_added = db.session.query(self.sample_id).\
+                filter(self.sample_id.in_(sample_ids)).all()
+        assert len(already_added) == 0, "The samples already have gene count vectors"
+
+        last_position = db.session.query(sqlalchemy.func.max(self.position)).scalar() or 0
+        positions = {}
+        for i, sample_id in enumerate(sample_ids):
+            positions[sample_id] = last_position + i + 1
+            db.session.add(self(positions[sample_id], sample_id))
+        db.session.flush()
+        return positions
+
+    @classmethod
+    def in_use(self):
+        """ Whether any gene counts are stored as vectors"""
+        return db.session.query(self.position).first() is not None
+
+class GeneCountVector(db.Model):
+    """ The gene counts for one gene as a single array, ordered by
+    GeneCountVectorSample.position. Samples without a count are NULL.
+
+    This is a compact alternative to gene_count, which has one row (and
+    index entries) per gene and sample."""
+    __tablename__ = 'gene_count_vector'
+    gene_id = db.Column(db.Integer, db.ForeignKey('gene.id'), primary_key=True,
+            autoincrement=False)
+    gene = db.relationship('Gene')
+    rpkms = db.Column(ARRAY(db.REAL))
+
+    def __init__(self, gene, rpkms):
+        self.gene = gene
+        self.rpkms = rpkms
+
+    @classmethod
+    def add_counts(self, sample_ids, counts):
+        """ Adds the counts for new samples.
+
+        counts is an iterable of data frames with gene ids as index and
+        sample_ids among the columns, so that the counts can be streamed
+        a chunk of genes at a time. The samples are placed after all
+        samples already stored, in the order of sample_ids."""
+        sample_ids = [int(sample_id) for sample_id in sample_ids]
+        positions = GeneCountVectorSample.add_samples(sample_ids)
+        first_position = positions[sample_ids[0]]
+
+        # Each row is written as: gene_id,"{rpkm,rpkm,...}"
+        def vector_chunks():
+            for chunk in counts:
+                rpkm_lines = chunk[sample_ids].to_csv(index=False, header=False, na_rep='NULL').splitlines()
+                yield ''.join('{},"{{{}}}"\n'.format(gene_id, rpkm_line)
+                        for gene_id, rpkm_line in zip(chunk.index, rpkm_lines))
+
+        # Dropped at the end, or with the transaction if anything fails before that
+        db.session.execute("CREATE TEMPORARY TABLE new_gene_count_vector (gene_id integer, rpkms real[]) ON COMMIT DROP;")
+        bulk_copy.copy_rows(db.session, 'new_gene_count_vector', ['gene_id', 'rpkms'], vector_chunks())
+
+        # Genes with earlier counts get the new counts appended, padded
+        # with NULL for any samples they have no counts for
+        db.session.execute(sqlalchemy.text(
+            "UPDATE gene_count_vector SET rpkms = gene_count_vector.rpkms[1:(:first_position - 1)] || "
+            "array_fill(NULL::real, ARRAY[greatest(:first_position - 1 - coalesce(array_length(gene_count_vector.rpkms, 1), 0), 0)]) || "
+            "new_gene_count_vector.rpkms "
+            "FROM new_gene_count_vector WHERE gene_count_vector.gene_id = new_gene_count_vector.gene_id;"),
+            {'first_position': first_position})
+        db.session.execute(sqlalchemy.text(
+            "INSERT INTO gene_count_vector (gene_id, rpkms) "
+            "SELECT gene_id, array_fill(NULL::real, ARRAY[:first_position - 1]) || rpkms "
+            "FROM new_gene_count_vector WHERE NOT EXISTS "
+            "(SELECT 1 FROM gene_count_vector WHERE gene_count_vector.gene_id = new_gene_count_vector.gene_id);"),
+            {'first_position': first_position})
+        db.session.execute("DROP TABLE new_gene_count_vector;")
+
+    @classmethod
+    def add_genes(self, gene_ids):
+        """ Adds vectors for the genes among gene_ids that have counts in
+        gene_count but no vector yet, e.g. genes new to the database,
+        with their counts placed at the positions of the samples already
+        stored. Returns the number of vectors added."""
+        gene_ids = [int(gene_id) for gene_id in gene_ids]
+        last_position = db.session.query(sqlalchemy.func.max(GeneCountVectorSample.position)).scalar()
+        if not gene_ids or last_position is None:
+            return 0
+        db.session.flush()
+        result = db.session.execute(sqlalchemy.text(
+            "INSERT INTO gene_count_vector (gene_id, rpkms) "
+            "SELECT gene.id, array_agg(gene_count.rpkm ORDER BY vector_position.position) "
+            "FROM gene CROSS JOIN generate_series(1, :last_position) AS vector_position(position) "
+            "LEFT JOIN gene_count_vector_sample ON gene_count_vector_sample.position = vector_position.position "
+            "LEFT JOIN gene_count ON gene_count.gene_id = gene.id "
+            "AND gene_count.sample_id = gene_count_vector_sample.sample_id "
+            "WHERE gene.id = ANY(:gene_ids) AND NOT EXISTS "
+            "(SELECT 1 FROM gene_count_vector WHERE gene_count_vector.gene_id = gene.id) "
+            "GROUP BY gene.id HAVING count(gene_count.rpkm) > 0;"),
+            {'last_position': last_position, 'gene_ids': gene_ids})
+        return result.rowcount
+
+    @classmethod
+    def counts_subquery(self, gene_ids, sample_set_ids=None):
+        """ Same as the aggregated gene counts used by Gene.rpkm_table,
+        one row per gene with its sample ids and rpkm values as arrays
+        ordered by sample id, but read from the vectors."""
+        rpkm = self.rpkms[GeneCountVectorSample.position]
+        q = db.session.query(
+                    self.gene_id.label('gene_id'),
+                    array_agg(aggregate_order_by(GeneCountVectorSample.sample_id, GeneCountVectorSample.sample_id)).label('sample_ids'),
+                    array_agg(aggregate_order_by(rpkm, GeneCountVectorSample.sample_id)).label('rpkms')).\
+                filter(self.gene_id.in_(gene_ids)).\
+                filter(rpkm.isnot(None))
+        if sample_set_ids is not None:
+            q = q.join(Sample, Sample.id == GeneCountVectorSample.sample_id).\
+                    filter(Sample.sample_set_id.in_(sample_set_ids))
+        return q.group_by(self.gene_id).subquery()
+
 class Taxon(db.Model):
     __tablename__ = 'taxon'
+    __table_args__ = (
+        db.Index('taxon_full_taxonomy_trgm_idx', 'full_taxonomy',
+            postgresql_using='gin', postgresql_ops={'full_taxonomy': 'gin_trgm_ops'}),
+        )
     id = db.Column(db.Integer, primary_key=True, index=True)
 
     up_to_superkingdom = db.Column(db.String, index=True)
@@ -454,40 +774,55 @@ class Taxon(db.Model):
 
     @classmethod
     def rpkm_table_row(self, level="superkingdom", complete_taxonomy=None):
-        filter_level = "up_to_" + level
-        q_first = db.session.query(Sample, sqlalchemy.func.sum(TaxonRpkmTable.rpkm)).\
-                filter(TaxonRpkmTable.taxon_id == Taxon.id).\
-                group_by(getattr(Taxon, filter_level)).\
-                group_by(Sample.id).\
-                filter(Sample.id == TaxonRpkmTable.sample_id).\
-                filter(getattr(Taxon, filter_level) == complete_taxonomy)
+        return self.rpkm_table_rows(level, [complete_taxonomy])[complete_taxonomy]
+
+    @classmethod
+    def rpkm_table_rows(self, level="superkingdom", complete_taxonomies=None):
+        """Fetches the table rows for all complete_taxonomies at the given level
+        with a single query. Rows are returned in the order given."""
+        q = db.session.query(TaxonLevelRpkmTable.complete_taxonomy, Sample, TaxonLevelRpkmTable.rpkm).\
+                filter(Sample.id == TaxonLevelRpkmTable.sample_id).\
+                filter(TaxonLevelRpkmTable.level == level).\
+                filter(in_list(TaxonLevelRpkmTable.complete_taxonomy, complete_taxonomies))
 
-        table_row = dict(q_first.all())
-        return table_row
+        table_rows = collections.OrderedDict(
+                (complete_taxonomy, {}) for complete_taxonomy in complete_taxonomies)
+        for complete_taxonomy, sample, rpkm in q.all():
+            table_rows[complete_taxonomy][sample] = rpkm
+        return table_rows
 
 
     @classmethod
     def rpkm_table(self, level="superkingdom", top_level_complete_values=None, top_level=None, samples=None, limit=20):
-        filter_level = "up_to_" + level
-        q_first = db.session.query(getattr(Taxon, filter_level), sqlalchemy.func.sum(TaxonRpkmTable.rpkm)).\
-                filter(TaxonRpkmTable.taxon_id == Taxon.id).\
-                group_by(getattr(Taxon, filter_level)).\
-                order_by(sqlalchemy.func.sum(TaxonRpkmTable.rpkm).desc())
+        q_first = db.session.query(TaxonLevelRpkmTable.complete_taxonomy, sqlalchemy.func.sum(TaxonLevelRpkmTable.rpkm)).\
+                filter(TaxonLevelRpkmTable.level == level).\
+                group_by(TaxonLevelRpkmTable.complete_taxonomy).\
+                order_by(sqlalchemy.func.sum(TaxonLevelRpkmTable.rpkm).desc())
 
         if top_level is not None:
-            filter_top_level = "up_to_" + top_level
-            q_first = q_first.filter(getattr(Taxon, filter_top_level).in_(top_level_complete_values))
+            level_index = self.level_order.index(level)
+            top_level_index = self.level_order.index(top_level)
+            if top_level_index == level_index:
+                q_first = q_first.filter(in_list(TaxonLevelRpkmTable.complete_taxonomy, top_level_complete_values))
+            elif top_level_index == level_index - 1:
+                q_first = q_first.filter(in_list(TaxonLevelRpkmTable.parent_taxonomy, top_level_complete_values))
+            else:
+                # The parents further down the tree are looked up in taxon
+                parent_column = getattr(Taxon, "up_to_" + self.level_order[level_index - 1])
+                parents = db.session.query(parent_column).\
+                        filter(in_list(getattr(Taxon, "up_to_" + top_level), top_level_complete_values)).\
+                        distinct()
+                q_first = q_first.filter(TaxonLevelRpkmTable.parent_taxonomy.in_(parents))
 
         if samples is not None:
             q_first = q_first.\
-                        filter(TaxonRpkmTable.sample_scilifelab_code.in_(samples))
+                        filter(TaxonLevelRpkmTable.sample_scilifelab_code.in_(samples))
 
         # We want to filter away taxons only classified
         # more than one level up
         q_first = q_first.\
-                filter(not_(getattr(Taxon, filter_level).like("%;;")))
+                filter(TaxonLevelRpkmTable.classified == True)
 
-        q_first = q_first.group_by(getattr(Taxon, filter_level))
         if limit:
             q_first = q_first.limit(limit)
 
@@ -496,14 +831,10 @@ class Taxon(db.Model):
         for level_val, count in taxon_counts:
             taxon_level_vals.append(level_val)
 
-        wanted_taxa = db.session.query(Taxon.id).filter(getattr(Taxon, filter_level).in_(taxon_level_vals))
-
-        q = db.session.query(Sample, getattr(Taxon, filter_level), sqlalchemy.func.sum(TaxonRpkmTable.rpkm)).\
-                group_by(Sample).\
-                filter(TaxonRpkmTable.taxon_id == Taxon.id).\
-                filter(TaxonRpkmTable.sample_id == Sample.id).\
-                filter(TaxonRpkmTable.taxon_id.in_(wanted_taxa)).\
-                group_by(getattr(Taxon, filter_level))
+        q = db.session.query(Sample, TaxonLevelRpkmTable.complete_taxonomy, TaxonLevelRpkmTable.rpkm).\
+                filter(TaxonLevelRpkmTable.sample_id == Sample.id).\
+                filter(TaxonLevelRpkmTable.level == level).\
+                filter(in_list(TaxonLevelRpkmTable.complete_taxonomy, taxon_level_vals))
 
         if samples is None:
             samples = Sample.query.all()
@@ -511,7 +842,7 @@ class Taxon(db.Model):
             q = q.filter(Sample.scilifelab_code.in_(samples))
             samples = Sample.query.filter(Sample.scilifelab_code.in_(samples)).all()
 
-        q = q.order_by(sqlalchemy.func.sum(TaxonRpkmTable.rpkm))
+        q = q.order_by(TaxonLevelRpkmTable.rpkm)
 
         unsorted_rows = {}
         for sample, level_val, rpkm in q.all():
@@ -549,16 +880,125 @@ class Taxon(db.Model):
 
         return { sample: rpkm_sum for sample, rpkm_sum in q.all() }
 
-class TaxonRpkmTable(MaterializedView):
-    # A materialized view that improve the performance
+class AggregateTable(db.Model):
+    """ A table with the gene counts summed per sample, kept up to date
+    by the loaders instead of being refreshed as a whole like a
+    materialized view. Loading gene counts for some samples then only
+    costs as much as those samples' counts.
+
+    Subclasses give the summing query as creation_query, which selects
+    the columns of the table by name and has the gene count's sample_id
+    available to filter on, or override _filtered_query and
+    update_samples when it is summed from another table."""
+    __abstract__ = True
+
+    @classmethod
+    def _filtered_query(self, query_column, ids):
+        return self.creation_query.where(in_list(query_column, ids))
+
+    @classmethod
+    def _replace(self, table_column, query_column, ids):
+        ids = list(ids)
+        if not ids:
+            return
+        db.session.flush()
+        db.session.execute(self.__table__.delete().where(in_list(table_column, ids)))
+        query = self._filtered_query(query_column, ids)
+        db.session.execute(self.__table__.insert().from_select(
+            [column.name for column in self.creation_query.c], query))
+        self._changed()
+
+    @classmethod
+    def _changed(self):
+        """ Called after rows of the table were replaced or deleted"""
+        pass
+
+    @classmethod
+    def update_samples(self, sample_ids):
+        """ Recomputes the rows for sample_ids from their gene counts"""
+        self._replace(self.__table__.c.sample_id, GeneCount.sample_id, sample_ids)
+
+    @classmethod
+    def delete_samples(self, sample_ids):
+        sample_ids = list(sample_ids)
+        if sample_ids:
+            db.session.execute(self.__table__.delete().where(in_list(self.__table__.c.sample_id, sample_ids)))
+            self._changed()
+
+    @classmethod
+    def rebuild(self, connection=None):
+        """ Recomputes the whole table, in the session unless a connection is given"""
+        if connection is None:
+            db.session.flush()
+            connection = db.session
+        connection.execute(self.__table__.delete())
+        connection.execute(self.__table__.insert().from_select(
+            [column.name for column in self.creation_query.c], self.creation_query))
+        self._changed()
+
+class TaxonRpkmTable(AggregateTable):
+    # The rpkm summed per taxon and sample
+    __tablename__ = 'taxon_rpkm_table'
+    taxon_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    sample_id = db.Column(db.Integer, primary_key=True, autoincrement=False, index=True)
+    sample_scilifelab_code = db.Column(db.String(11))
+    rpkm = db.Column(db.Float)
 
     creation_query = db.select([Taxon.id.label('taxon_id'), Sample.id.label('sample_id'), Sample.scilifelab_code.label('sample_scilifelab_code'), sqlalchemy.func.sum(GeneCount.rpkm).label('rpkm')]).\
                     select_from(db.join(Sample, GeneCount).join(Gene).join(Taxon)).\
                     group_by(Taxon.id, Sample.id)
 
-    __table__ = create_mat_view("taxon_rpkm_table", creation_query)
+def _taxon_level_rpkm_query(level):
+    level_column = getattr(Taxon, "up_to_" + level)
+    # The complete taxonomy one level up, none for the top level
+    level_index = Taxon.level_order.index(level)
+    group_by = [level_column, TaxonRpkmTable.sample_id, TaxonRpkmTable.sample_scilifelab_code]
+    if level_index == 0:
+        parent_column = sqlalchemy.cast(sqlalchemy.null(), db.String)
+    else:
+        parent_column = getattr(Taxon, "up_to_" + Taxon.level_order[level_index - 1])
+        group_by.append(parent_column)
+    return db.select([sqlalchemy.literal(level).label('level'), level_column.label('complete_taxonomy'), parent_column.label('parent_taxonomy'), not_(level_column.like("%;;")).label('classified'), TaxonRpkmTable.sample_id.label('sample_id'), TaxonRpkmTable.sample_scilifelab_code.label('sample_scilifelab_code'), sqlalchemy.func.sum(TaxonRpkmTable.rpkm).label('rpkm')]).\
+                    select_from(db.join(TaxonRpkmTable, Taxon, TaxonRpkmTable.taxon_id == Taxon.id)).\
+                    group_by(*group_by)
+
+class TaxonLevelRpkmTable(AggregateTable):
+    # The rpkm summed per sample for each complete taxonomy at each
+    # taxonomic level, so that rows in the taxonomy table can be fetched
+    # without grouping over all taxa.
+    # parent_taxonomy, the complete taxonomy one level up, finds the
+    # children of a taxon with an index lookup.
+    # Summed from taxon_rpkm_table, which is much smaller than gene_count
+    # and has to be up to date for the samples first
+    __tablename__ = 'taxon_level_rpkm_table'
+    level = db.Column(db.String, primary_key=True)
+    complete_taxonomy = db.Column(db.String, primary_key=True)
+    sample_id = db.Column(db.Integer, primary_key=True, autoincrement=False, index=True)
+    parent_taxonomy = db.Column(db.String)
+    classified = db.Column(db.Boolean)
+    sample_scilifelab_code = db.Column(db.String(11))
+    rpkm = db.Column(db.Float)
+
+    __table_args__ = (
+            db.Index('taxon_level_rpkm_table_parent_idx', 'level', 'parent_taxonomy'),
+        )
+
+    creation_query = sqlalchemy.union_all(*[_taxon_level_rpkm_query(level) for level in Taxon.level_order])
+
+    @classmethod
+    def _filtered_query(self, query_column, ids):
+        return sqlalchemy.union_all(*[_taxon_level_rpkm_query(level).where(in_list(query_column, ids))
+            for level in Taxon.level_order])
+
+    @classmethod
+    def update_samples(self, sample_ids):
+        """ Recomputes the rows for sample_ids from taxon_rpkm_table"""
+        self._replace(self.__table__.c.sample_id, TaxonRpkmTable.sample_id, sample_ids)
 
-db.Index('taxon_rpkm_table_mv_id_idx', TaxonRpkmTable.taxon_id, TaxonRpkmTable.sample_id, unique=True)
+# The aggregate tables summed from other aggregate tables
+AGGREGATE_DEPENDENCIES = {
+        TaxonLevelRpkmTable.__tablename__: [TaxonRpkmTable.__tablename__]
+    }
 
 class AnnotationSource(db.Model):
     __tablename__ = 'annotation_source'
@@ -579,6 +1019,10 @@ class Annotation(db.Model):
     __tablename__ = 'annotation'
     __table_args__ = (
         db.UniqueConstraint('annotation_type', 'type_identifier', name='annotation_unique'),
+        db.Index('annotation_type_identifier_trgm_idx', 'type_identifier',
+            postgresql_using='gin', postgresql_ops={'type_identifier': 'gin_trgm_ops'}),
+        db.Index('annotation_description_trgm_idx', 'description',
+            postgresql_using='gin', postgresql_ops={'description': 'gin_trgm_ops'}),
         )
     id = db.Column(db.Integer, primary_key=True)
 
@@ -599,11 +1043,25 @@ class Annotation(db.Model):
         q = db.session.query(Gene, Annotation).\
                 join(GeneAnnotation.gene).\
                 join(GeneAnnotation.annotation).\
-                filter(GeneAnnotation.annotation_id.in_(annotation_ids))
+                filter(in_list(GeneAnnotation.annotation_id, annotation_ids))
         return q.all()
 
+    @classmethod
+    def gene_names_per_annotation(self, annotation_ids, batch_size=1000):
+        """ Yields (gene name, type identifier) for the annotations,
+        fetched in batches from a server side cursor."""
+        q = db.session.query(Gene.name, Annotation.type_identifier).\
+                join(GeneAnnotation, GeneAnnotation.gene_id == Gene.id).\
+                join(Annotation, Annotation.id == GeneAnnotation.annotation_id).\
+                filter(in_list(GeneAnnotation.annotation_id, annotation_ids))
+        return q.yield_per(batch_size)
+
     @classmethod
     def rpkm_table(self, samples=None, function_class=None, limit=20, type_identifiers=None):
+        if app.config.get('RPKM_MATRIX_ENGINE'):
+            return self.rpkm_table_from_matrix(samples=samples, function_class=function_class,
+                    limit=limit, type_identifiers=type_identifiers)
+
         q_first = db.session.query(RpkmTable.annotation_id)
 
         if function_class is not None:
@@ -611,7 +1069,7 @@ class Annotation(db.Model):
 
         if type_identifiers is not None:
             annotation_ids_from_type_ids = db.session.query(Annotation.id).\
-                        filter(Annotation.type_identifier.in_(type_identifiers)).all()
+                        filter(in_list(Annotation.type_identifier, type_identifiers))
             q_first = q_first.\
                          filter(RpkmTable.annotation_id.in_(annotation_ids_from_type_ids))
 
@@ -631,7 +1089,7 @@ class Annotation(db.Model):
             return [], {}
 
         q = db.session.query(RpkmTable).\
-                filter(RpkmTable.annotation_id.in_(annotation_ids))
+                filter(in_list(RpkmTable.annotation_id, annotation_ids))
 
         if samples is not None:
             q = q.filter(RpkmTable.sample_scilifelab_code.in_(samples))
@@ -649,10 +1107,10 @@ class Annotation(db.Model):
             samples.add(sample)
             fetched_annotations[annotation.id] = annotation
             if annotation in rows_unordered:
-                rows_unordered[annotation][sample] = "{0:.4f}".format(rpkm_sum)
+                rows_unordered[annotation][sample] = rpkm_sum
             else:
                 rows_unordered[annotation] = collections.OrderedDict()
-                rows_unordered[annotation][sample] = "{0:.4f}".format(rpkm_sum)
+                rows_unordered[annotation][sample] = rpkm_sum
 
         rows = collections.OrderedDict()
 
@@ -662,6 +1120,31 @@ class Annotation(db.Model):
 
         return list(samples), rows
 
+    @classmethod
+    def rpkm_table_from_matrix(self, samples=None, function_class=None, limit=20, type_identifiers=None):
+        """Same as rpkm_table but computed from the in-memory rpkm matrix,
+        only the resulting annotations and samples are fetched from the database."""
+        annotation_ids, sample_ids, values = RpkmTable.matrix().select(samples=samples,
+                function_class=function_class, limit=limit, type_identifiers=type_identifiers)
+
+        if not len(annotation_ids):
+            return [], {}
+
+        fetched_annotations = dict((annotation.id, annotation) for annotation in
+                Annotation.query.filter(in_list(Annotation.id, annotation_ids.tolist())).all())
+        fetched_samples = dict((sample.id, sample) for sample in
+                Sample.query.filter(Sample.id.in_(sample_ids.tolist())).all())
+
+        rows = collections.OrderedDict()
+        for annotation_id, row_values in zip(annotation_ids, values):
+            row = collections.OrderedDict()
+            for sample_id, rpkm_sum in zip(sample_ids, row_values):
+                if not np.isnan(rpkm_sum):
+                    row[fetched_samples[sample_id]] = float(rpkm_sum)
+            rows[fetched_annotations[annotation_id]] = row
+
+        return list(fetched_samples.values()), rows
+
     @classmethod
     def rpkm_table_for_taxonomy(self, type_identifiers, samples=None, limit=20):
         q = db.session.query(GeneCount).join(Gene).filter(GeneCount.gene_id == Gene.id).join(GeneAnnotation).filter(Gene.id == GeneAnnotation.gene_id).filter(GeneAnnotation.annotation_id==pfam1.id).join(Taxon).filter(Gene.taxon_id == Taxon.id).filter(Taxon.up_to_phylum == 'Bacteria;Cyanobacteria')
@@ -696,6 +1179,24 @@ class Annotation(db.Model):
         else:
             return self.description
 
+    @classmethod
+    def copy_catalogue(cls, session, annotations, columns=()):
+        """Adds the annotations of this type in the data frame annotations,
+        with type_identifier and description columns as well as the given
+        columns of the table of the subclass, and returns a dict from type
+        identifier to the new annotation ids.
+
+        Both tables are filled with one copy each, rather than with two
+        inserts per annotation object."""
+        columns = list(columns)
+        annotations = annotations.assign(type_identifier=annotations['type_identifier'].astype(str),
+                annotation_type=cls.__mapper__.polymorphic_identity)
+        annotation_ids = bulk_copy.copy_dataframe_returning(session, annotations, Annotation.__tablename__,
+                ['annotation_type', 'type_identifier', 'description'], 'type_identifier')
+        subtype_rows = annotations[columns].assign(id=annotations['type_identifier'].map(annotation_ids))
+        bulk_copy.copy_dataframe(session, subtype_rows, cls.__tablename__, ['id'] + columns)
+        return annotation_ids
+
     __mapper_args__ = {
 
             'polymorphic_identity': 'annotation',
@@ -706,17 +1207,76 @@ class Annotation(db.Model):
         self.type_identifier = type_identifier
         self.description = description
 
-class RpkmTable(MaterializedView):
-    # A materialized view that improve the performance
+class RpkmTable(AggregateTable):
+    # The rpkm summed per annotation and sample
+    __tablename__ = 'rpkm_table'
+    annotation_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    annotation_type = db.Column(db.String)
+    sample_id = db.Column(db.Integer, primary_key=True, autoincrement=False, index=True)
+    sample_scilifelab_code = db.Column(db.String(11))
+    rpkm = db.Column(db.Float)
 
     creation_query = db.select([Annotation.id.label('annotation_id'), Annotation.annotation_type.label('annotation_type'), Sample.id.label('sample_id'), Sample.scilifelab_code.label('sample_scilifelab_code'), sqlalchemy.func.sum(GeneCount.rpkm).label('rpkm')]).\
                     select_from(db.join(Sample, GeneCount).join(Gene).join(GeneAnnotation).join(Annotation)).\
                     group_by(Annotation.id, Sample.id)
 
-    __table__ = create_mat_view("rpkm_table", creation_query)
+    @classmethod
+    def update_annotations(self, annotation_ids):
+        """ Recomputes the rows for annotation_ids, e.g. after genes were annotated with them"""
+        self._replace(self.annotation_id, Annotation.id, annotation_ids)
 
+    @classmethod
+    def _changed(self):
+        # The in-memory copy is reloaded on its next use
+        rpkm_matrix.clear_matrix()
 
-db.Index('rpkm_table_mv_id_idx', RpkmTable.annotation_id, RpkmTable.sample_id, unique=True)
+    @classmethod
+    def matrix(self):
+        """The whole table loaded as an annotation x sample matrix, see rpkm_matrix.py"""
+        def load_view():
+            q = db.session.query(RpkmTable.annotation_id,
+                    Annotation.type_identifier,
+                    RpkmTable.annotation_type,
+                    RpkmTable.sample_id,
+                    RpkmTable.sample_scilifelab_code,
+                    RpkmTable.rpkm).\
+                    filter(Annotation.id == RpkmTable.annotation_id)
+            return pd.DataFrame(q.all(), columns=rpkm_matrix.MATRIX_COLUMNS)
+
+        return rpkm_matrix.get_matrix(load_view, app.config.get('RPKM_MATRIX_MAX_AGE'))
+
+def update_sample_aggregates(sample_ids):
+    """ Brings the rpkm tables up to date after the gene counts for
+    sample_ids were added or replaced, only recomputing the rows of
+    those samples"""
+    RpkmTable.update_samples(sample_ids)
+    TaxonRpkmTable.update_samples(sample_ids)
+    TaxonLevelRpkmTable.update_samples(sample_ids)
+
+def rebuild_aggregates(max_workers=1):
+    """ Recomputes the rpkm tables from scratch and refreshes the views
+    built on them, e.g. after an update failed halfway. With max_workers
+    above 1 the tables and views that do not depend on each other are
+    rebuilt concurrently, each on a connection of its own. Returns the
+    seconds taken and number of rows for each table and view."""
+    refreshers = {
+            RpkmTable.__tablename__: RpkmTable.rebuild,
+            TaxonRpkmTable.__tablename__: TaxonRpkmTable.rebuild,
+            TaxonLevelRpkmTable.__tablename__: TaxonLevelRpkmTable.rebuild
+        }
+    for name in mat_view_names():
+        refreshers[name] = lambda connection, name=name: refresh_mat_view(name, True, connection)
+    dependencies = dict(MAT_VIEW_DEPENDENCIES)
+    dependencies.update(AGGREGATE_DEPENDENCIES)
+    if max_workers == 1:
+        db.session.flush()
+    return refresh_in_order(refreshers, dependencies, max_workers)
+
+def delete_sample_aggregates(sample_ids):
+    """ Removes sample_ids from the rpkm tables, before the samples are deleted"""
+    RpkmTable.delete_samples(sample_ids)
+    TaxonRpkmTable.delete_samples(sample_ids)
+    TaxonLevelRpkmTable.delete_samples(sample_ids)
 
 eggnog_to_category = db.Table('eggnog_to_category',
     db.Column('eggnog_category_id', db.Integer, db.ForeignKey('eggnog_category.id')),
@@ -751,6 +1311,32 @@ class EggNOG(Annotation):
             'polymorphic_identity':'eggnog'
         }
 
+    @classmethod
+    def copy_catalogue(cls, session, annotations, columns=()):
+        """Same as Annotation.copy_catalogue, but also links the
+        annotations to the categories in the categories column, if given,
+        which must already be in the database."""
+        annotation_ids = super().copy_catalogue(session, annotations, columns)
+        if 'categories' in annotations.columns:
+            category_ids = dict( session.query(EggNOGCategory.category, EggNOGCategory.id).all() )
+            eggnog_ids = annotations['type_identifier'].astype(str).map(annotation_ids)
+            cls.copy_category_links(session, annotations.set_index(eggnog_ids)['categories'], category_ids)
+        return annotation_ids
+
+    @classmethod
+    def copy_category_links(cls, session, categories, category_ids):
+        """Links eggnog annotations to their categories in one copy.
+
+        categories is a series from eggnog id to a string of one letter
+        categories, category_ids maps each category to its id."""
+        categories = categories.map(list).explode().dropna()
+        unknown = set(categories) - set(category_ids)
+        if unknown:
+            raise ValueError("Unknown EggNOG categories: {}".format(', '.join(sorted(unknown))))
+        links = pd.DataFrame({'eggnog_id': categories.index,
+            'eggnog_category_id': categories.map(category_ids).values})
+        return bulk_copy.copy_dataframe(session, links, eggnog_to_category.name)
+
     @property
     def external_link(self):
         return "http://eggnogdb.embl.de/#/app/home"
@@ -823,6 +1409,33 @@ class TigrFam(Annotation):
         return "TIGRFAM"
 
 
+class DbCAN(Annotation):
+    # Carbohydrate-active enzyme families, as classified by CAZy
+    __tablename__ = 'dbcan'
+    id = db.Column(db.Integer, db.ForeignKey("annotation.id"),
+            primary_key=True)
+
+    cazy_class = db.Column(db.String, index=True)
+    ncbi_cdd = db.Column(db.String)
+
+    def __init__(self, type_identifier, cazy_class=None, ncbi_cdd=None, **kwargs):
+        super().__init__(type_identifier, **kwargs)
+        self.cazy_class = cazy_class
+        self.ncbi_cdd = ncbi_cdd
+
+    __mapper_args__ = {
+            'polymorphic_identity': 'dbcan'
+        }
+
+    @property
+    def external_link(self):
+        return "http://www.cazy.org/{}.html".format(self.type_identifier)
+
+    @property
+    def pretty_name(self):
+        return "dbCAN"
+
+
 class EcNumber(Annotation):
     __tablename__ = 'ecnumber'
     id = db.Column(db.Integer, db.ForeignKey("annotation.id"),
@@ -860,3 +1473,32 @@ class EcNumber(Annotation):
     @property
     def pretty_name(self):
         return "EC-number"
+
+class LoadStage(db.Model):
+    """ A completed stage of a loader such as populate_db. A loader that is
+    rerun after a failure skips its completed stages (see load_stages)."""
+    __tablename__ = 'load_stage'
+    __table_args__ = (
+        db.UniqueConstraint('pipeline', 'name', name='load_stage_unique'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    pipeline = db.Column(db.String, nullable=False)
+    name = db.Column(db.String, nullable=False)
+    completed_at = db.Column(db.DateTime, server_default=sqlalchemy.func.now())
+    seconds = db.Column(db.Float)
+    # Whatever the stage needs to hand over to a later run, as json
+    details = db.Column(db.JSON)
+
+    def __init__(self, pipeline, name, seconds=None, details=None):
+        self.pipeline = pipeline
+        self.name = name
+        self.seconds = seconds
+        self.details = details
+
+    def __repr__(self):
+        return '<LoadStage {} {}>'.format(self.pipeline, self.name)
+
+    @classmethod
+    def completed(self, pipeline):
+        """ The completed stages of pipeline, by name"""
+        return dict((stage.name, stage) for stage in self.query.filter_by(pipeline=pipeline).all())
@@ -7,10 +7,16 @@ import sys
 import logging
 import datetime
 
-from materialized_view_factory import refresh_all_mat_views
+from bulk_copy import copy_dataframe, copy_dataframe_returning, defer_indexes, restore_indexes, BULK_LOAD_TABLES
+from annotation_ingest import copy_gene_annotations, copy_gene_annotation_file
+import annotation_types
+from gene_count_ingest import copy_gene_counts, copy_gene_count_vectors
+from load_stages import run_stages
 
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
 
+PIPELINE = 'populate_db'
+
 def main(args):
     # Create materialized view that is not created by manage.py
     app.db.create_all()
@@ -22,165 +28,131 @@ def main(args):
     # Add all samples from the sample info file
     sample_info = pd.read_table(args.sample_info, sep=',', index_col=0)
 
-    logging.info("Creating sample sets")
-    # sample_set
-    sample_sets = {}
-    for sample_set_name, sample_set_df in sample_info.groupby('sample_set'):
-        if len(SampleSet.query.filter_by(name=sample_set_name).all()) == 0:
-            assert len(sample_set_df.public.unique() == 1)
-            public = sample_set_df.public.unique()[0]
-            sample_set = SampleSet(sample_set_name, public=public)
-        for sample_id, row in sample_set_df.iterrows():
-            sample_sets[sample_id] = sample_set
-
-    logging.info("Creating individual samples")
-    sample_properties = []
-    all_samples = {}
-    time_places = []
-    metadata_reference = pd.read_table(args.metadata_reference, index_col=0)
-    meta_categories = list(metadata_reference.index)
-    default_units = metadata_reference['Unit'].to_dict()
-    default_units['filter_lower'] = 'µm'
-    default_units['filter_upper'] = 'µm'
-    for sample_id, row in sample_info.iterrows():
-        samples_with_code = Sample.query.filter_by(scilifelab_code=str(sample_id)).all()
-        assert len(samples_with_code) == 0
-
-        meta_data = {}
-
-        for meta_category in meta_categories:
-            if meta_category == 'Collection date':
-                date = datetime.datetime.strptime(row[meta_category], '%y/%m/%d')
-            if meta_category == 'Collection time':
-                time = datetime.datetime.strptime(str(row[meta_category]), '%H:%M').time()
-            else:
-                meta_data[meta_category] = row[meta_category]
-
-        extra_categories = ['filter_lower', 'filter_upper']
-        for meta_category in extra_categories:
-            meta_data[meta_category] = row[meta_category]
-
-        time_place = TimePlace(datetime.datetime.combine(date, time), meta_data['Latitude'], meta_data['Longitude'])
-        time_places.append(time_place)
-
-        all_samples[str(sample_id)] = Sample(str(sample_id), sample_sets[sample_id], time_place)
+    # What the stages read from the database or from the input files,
+    # kept for the later stages of the same run
+    state = {}
 
-        for meta_category in meta_categories:
-            if meta_category in ['Latitude', 'Longitude', 'Collection date', 'Collection time']:
-                continue
-            if meta_data[meta_category] is not None:
-                sample_properties.append(SampleProperty(meta_category, meta_data[meta_category], default_units[meta_category], all_samples[str(sample_id)]))
+    def reference_assembly():
+        ref_assemblies = ReferenceAssembly.query.filter_by(name=str(args.reference_assembly)).all()
+        assert len(ref_assemblies) == 1
+        return ref_assemblies[0]
+
+    def all_samples():
+        if 'all_samples' not in state:
+            codes = [str(sample_id) for sample_id in sample_info.index]
+            state['all_samples'] = dict((sample.scilifelab_code, sample) for sample in
+                    Sample.query.filter(Sample.scilifelab_code.in_(codes)).all())
+        return state['all_samples']
+
+    def commited_genes():
+        if 'commited_genes' not in state:
+            state['commited_genes'] = dict( session.query(Gene.name, Gene.id).all() )
+        return state['commited_genes']
+
+    def add_samples():
+        logging.info("Creating sample sets")
+        # sample_set
+        sample_sets = {}
+        for sample_set_name, sample_set_df in sample_info.groupby('sample_set'):
+            if len(SampleSet.query.filter_by(name=sample_set_name).all()) == 0:
+                assert len(sample_set_df.public.unique() == 1)
+                public = sample_set_df.public.unique()[0]
+                sample_set = SampleSet(sample_set_name, public=public)
+            for sample_id, row in sample_set_df.iterrows():
+                sample_sets[sample_id] = sample_set
+
+        logging.info("Creating individual samples")
+        sample_properties = []
+        new_samples = {}
+        time_places = []
+        metadata_reference = pd.read_table(args.metadata_reference, index_col=0)
+        meta_categories = list(metadata_reference.index)
+        default_units = metadata_reference['Unit'].to_dict()
+        default_units['filter_lower'] = 'µm'
+        default_units['filter_upper'] = 'µm'
+        for sample_id, row in sample_info.iterrows():
+            samples_with_code = Sample.query.filter_by(scilifelab_code=str(sample_id)).all()
+            assert len(samples_with_code) == 0
+
+            meta_data = {}
+
+            for meta_category in meta_categories:
+                if meta_category == 'Collection date':
+                    date = datetime.datetime.strptime(row[meta_category], '%y/%m/%d')
+                if meta_category == 'Collection time':
+                    time = datetime.datetime.strptime(str(row[meta_category]), '%H:%M').time()
+                else:
+                    meta_data[meta_category] = row[meta_category]
 
-    session.add_all(list(sample_sets.values()) + list(all_samples.values()) + time_places + sample_properties)
+            extra_categories = ['filter_lower', 'filter_upper']
+            for meta_category in extra_categories:
+                meta_data[meta_category] = row[meta_category]
 
-    logging.info("Creating the reference assembly")
-    # create the reference assembly
-    ref_assemblies = ReferenceAssembly.query.filter_by(name=str(args.reference_assembly)).all()
-    if len(ref_assemblies) == 0:
-        ref_assembly = ReferenceAssembly(args.reference_assembly)
-    else:
-        assert len(ref_assemblies) == 1
-        ref_assembly = ref_assemblies[0]
-
-    session.add(ref_assembly)
-
-    logging.info("Adding annotation information")
-
-    all_annotations = {}
-    annotations = []
-    if args.pfam_annotation_info:
-        # Columns:Id,Name,Description
-        annotation_info = pd.read_table(args.pfam_annotation_info, index_col=0)
-
-        for ix, row in annotation_info.iterrows():
-            new_object = Pfam(type_identifier=ix, description=row['Description'])
-            annotations.append(new_object)
-
-        logging.info("Commiting all PFAM annotation info")
-        session.add_all(annotations)
-        session.commit()
-
-    categories = []
-    if args.eggnog_category_info:
-        categories_df = pd.read_table(args.eggnog_category_info, names=['category', 'description'])
-        for ix, row in categories_df.iterrows():
-            new_object = EggNOGCategory(row['category'], row['description'])
-            categories.append(new_object)
-        logging.info("Committing all EggNOG category info")
-        session.add_all(categories)
-        session.commit()
-
-    eggnog_categories = dict( (category.category, category) for category in session.query(EggNOGCategory).all() )
-
-    annotations = []
-    if args.eggnog_annotation_info:
-        # Id,Categories,Description
-        annotation_info = pd.read_table(args.eggnog_annotation_info, index_col=0)
-
-        for ix, row in annotation_info.iterrows():
-            categories = [eggnog_categories[category] for category in row['Categories']]
-            new_object = EggNOG(type_identifier=str(ix), categories=categories, description=row['Description'])
-            annotations.append(new_object)
-
-        logging.info("Commiting all EggNOG annotation info")
-        session.add_all(annotations)
-        session.commit()
-
-    def parse_ec_numbers(ecnumber):
-        assert len(ecnumber.split(".")) == 4
-        return_list = []
-        for number in ecnumber.split("."):
-            if number == '-':
-                return_list.append(None)
-            else:
-                return_list.append(number)
-        return tuple(return_list)
-
-    annotations = []
-    if args.ec_annotation_info:
-        # Columns:Id,Name,Description
-        annotation_info = pd.read_table(args.ec_annotation_info, index_col=0)
-
-        for ix, row in annotation_info.iterrows():
-            first, second, third, fourth = parse_ec_numbers(ix)
-            description = row.Description
-            new_object = EcNumber(type_identifier=str(ix), first_digit=first, second_digit=second, third_digit=third, fourth_digit=fourth, description=description)
-            annotations.append(new_object)
-
-        logging.info("Commiting all EC annotation info")
-        session.add_all(annotations)
-        session.commit()
-
-    annotations = []
-    if args.tigrfam_annotation_info:
-        # Columns:Id,Name,Description
-        annotation_info = pd.read_table(args.tigrfam_annotation_info, index_col=0)
-
-        for ix, row in annotation_info.iterrows():
-            new_object = TigrFam(type_identifier=str(ix), description= row['Description'])
-            annotations.append(new_object)
-
-        logging.info("Commiting all TigrFam annotation info")
-        session.add_all(annotations)
-        session.commit()
-
-    all_annotations = dict( (annotation.type_identifier, annotation) for annotation in session.query(Annotation).all() )
-
-    logging.info("Adding annotation source")
-    # Create annotation source
-    annotation_source_info = pd.read_table(args.annotation_source_info, sep=',', header=None, names=["annotation_type", "db_version", "algorithm", "algorithm_parameters"], index_col = 0)
-    all_annotation_sources = {}
-    for annotation_type, row in annotation_source_info.iterrows():
-        all_annotation_sources[annotation_type] = AnnotationSource(annotation_type, row.db_version, row.algorithm, row.algorithm_parameters)
-
-    session.add_all(list(all_annotation_sources.values()))
-
-
-    logging.info("Commiting everything except genes and gene counts")
-    session.commit()
-
-    def add_genes_with_taxonomy(taxonomy_per_gene, commited_genes):
-        gene_annotations = pd.read_table(taxonomy_per_gene, index_col=0)
+            time_place = TimePlace(datetime.datetime.combine(date, time), meta_data['Latitude'], meta_data['Longitude'])
+            time_places.append(time_place)
+
+            new_samples[str(sample_id)] = Sample(str(sample_id), sample_sets[sample_id], time_place)
+
+            for meta_category in meta_categories:
+                if meta_category in ['Latitude', 'Longitude', 'Collection date', 'Collection time']:
+                    continue
+                if meta_data[meta_category] is not None:
+                    sample_properties.append((meta_category, meta_data[meta_category], default_units[meta_category], str(sample_id)))
+
+        session.add_all(list(sample_sets.values()) + list(new_samples.values()) + time_places)
+        session.flush()
+
+        logging.info("Adding {} sample properties".format(len(sample_properties)))
+        sample_properties = pd.DataFrame(sample_properties, columns=['name', 'value', 'unit', 'scilifelab_code'])
+        sample_properties['sample_id'] = sample_properties['scilifelab_code'].map(
+                dict((code, sample.id) for code, sample in new_samples.items()))
+        SampleProperty.copy_properties(session, sample_properties)
+
+        logging.info("Creating the reference assembly")
+        # create the reference assembly
+        ref_assemblies = ReferenceAssembly.query.filter_by(name=str(args.reference_assembly)).all()
+        if len(ref_assemblies) == 0:
+            session.add(ReferenceAssembly(args.reference_assembly))
+        else:
+            assert len(ref_assemblies) == 1
+
+    def add_catalogues():
+        logging.info("Adding annotation information")
+
+        # The categories have to be there before the EggNOG annotations
+        if args.eggnog_category_info:
+            categories_df = pd.read_table(args.eggnog_category_info, names=['category', 'description'])
+            logging.info("Adding all EggNOG category info")
+            copy_dataframe(session, categories_df, EggNOGCategory.__tablename__)
+
+        for annotation_type, path in [
+                ("Pfam", args.pfam_annotation_info),
+                ("EggNOG", args.eggnog_annotation_info),
+                ("EC", args.ec_annotation_info),
+                ("TigrFam", args.tigrfam_annotation_info),
+                ("dbCAN", args.dbcan_annotation_info)]:
+            if path:
+                logging.info("Adding all {} annotation info".format(annotation_type))
+                annotation_ids = annotation_types.copy_catalogue(session, annotation_type, path)
+                logging.info("Added {} {} annotations".format(len(annotation_ids), annotation_type))
+
+        logging.info("Adding annotation source")
+        # Create annotation source
+        annotation_source_info = pd.read_table(args.annotation_source_info, sep=',', header=None, names=["annotation_type", "db_version", "algorithm", "algorithm_parameters"], index_col = 0)
+        for annotation_type, row in annotation_source_info.iterrows():
+            session.add(AnnotationSource(annotation_type, row.db_version, row.algorithm, row.algorithm_parameters))
+
+    def drop_indexes():
+        logging.info("Dropping indexes and constraints for the bulk load")
+        # Kept in the manifest, for the build_indexes stage of a later run,
+        # which is written in the transaction of the drop
+        return defer_indexes(session, BULK_LOAD_TABLES, commit=False)
+
+    def read_gene_taxonomy():
+        if 'annotated_genes' in state:
+            return state['annotated_genes'], state['all_taxas_to_be_created']
+
+        gene_annotations = pd.read_table(args.taxonomy_per_gene, index_col=0)
 
         gene_annotations['taxclass'] = gene_annotations['class']
 
@@ -210,8 +182,6 @@ def main(args):
 
             return new_taxa
 
-        added_taxa = {}
-        gene_to_taxa = {}
         annotated_genes = annotated_genes.fillna("")
         # The number of taxa is lower than the genes with taxonomic annotation
         annotated_genes['full_taxonomy'] = annotated_genes["superkingdom"] + ';' + \
@@ -230,122 +200,106 @@ def main(args):
             first_full_taxa_to_real_full_taxa[full_taxonomy] = taxa.full_taxonomy
             all_taxas_to_be_created[taxa.full_taxonomy] = taxa
 
-        annotated_genes['real_full_taxonomy'] = annotated_genes['full_taxonomy'].apply(lambda x: first_full_taxa_to_real_full_taxa[x])
+        annotated_genes['real_full_taxonomy'] = annotated_genes['full_taxonomy'].map(first_full_taxa_to_real_full_taxa)
+
+        state['annotated_genes'] = annotated_genes
+        state['all_taxas_to_be_created'] = all_taxas_to_be_created
+        return annotated_genes, all_taxas_to_be_created
 
-        logging.info("Commiting all taxa")
+    def add_taxa():
+        annotated_genes, all_taxas_to_be_created = read_gene_taxonomy()
+        logging.info("Adding all {} taxa".format(len(all_taxas_to_be_created)))
         session.add_all(all_taxas_to_be_created.values())
-        session.commit()
+
+    def add_genes_with_taxonomy():
+        annotated_genes, _ = read_gene_taxonomy()
 
         logging.info("Creating genes with taxon information")
 
         all_created_taxa = dict(session.query(Taxon.full_taxonomy, Taxon.id).all() )
 
-        annotated_genes['taxon_id'] = annotated_genes['real_full_taxonomy'].apply(lambda x: all_created_taxa[x])
+        annotated_genes['taxon_id'] = annotated_genes['real_full_taxonomy'].map(all_created_taxa)
         annotated_genes['name'] = annotated_genes.index
-        annotated_genes["reference_assembly_id"] = ref_assembly.id
-
-        with open(args.tmp_file, 'w') as gene_file:
-            annotated_genes[['name', 'reference_assembly_id', 'taxon_id']].to_csv(gene_file, index=False, header=None)
-        session.execute("COPY gene (name, reference_assembly_id, taxon_id) FROM '{}' WITH CSV;".format(args.tmp_file))
-        commited_genes.update(dict( session.query(Gene.name, Gene.id).all() ))
-        logging.info("{} genes present in database".format(len(commited_genes.keys())))
-
-        return commited_genes
-
-
-    commited_genes = {}
-    commited_genes = add_genes_with_taxonomy(args.taxonomy_per_gene, commited_genes)
-
-    logging.info("Processed {} genes for gene taxonomy, moving on to functional annotation".format(len(commited_genes.keys())))
-
-    def add_genes_with_annotation(annotation_type, gene_annotation_arg, commited_genes, all_annotations, annotation_source):
-        logging.info("Adding genes with {} annotations".format(annotation_type))
-        gene_annotations = pd.read_table(gene_annotation_arg, header=None, names=["name", "type_identifier", "e_value", "score"])
-
-        # Only add genes once
-        new_genes = gene_annotations[ ~ gene_annotations['name'].isin(commited_genes.keys()) ]
-
-        new_genes_uniq = pd.DataFrame([new_genes['name'].unique()])
-        new_genes_uniq = new_genes_uniq.transpose()
-        new_genes_uniq.columns = ['name']
-        new_genes_uniq["reference_assembly_id"] = ref_assembly.id
-
-        logging.info("Commiting all {} genes.".format(annotation_type))
-
-        with open(args.tmp_file, 'w') as gene_file:
-            new_genes_uniq[['name', 'reference_assembly_id']].to_csv(gene_file, index=False, header=None)
-        session.execute("COPY gene (name, reference_assembly_id) FROM '{}' WITH CSV;".format(args.tmp_file))
-
-        commited_genes.update(dict( session.query(Gene.name, Gene.id).all() ))
-        logging.info("{} genes present in database".format(len(commited_genes.keys())))
-
-        gene_annotations['gene_id'] = gene_annotations['name'].apply(lambda x: commited_genes[x])
-        gene_annotations['annotation_id'] = gene_annotations['type_identifier'].apply(lambda x: all_annotations[x].id)
-
-        annotation_source = all_annotation_sources[annotation_type]
-        gene_annotations['annotation_source_id'] = annotation_source.id
-
-        logging.info("Commiting all {} gene anntations".format(annotation_type))
-        with open(args.tmp_file, 'w') as gene_file:
-            gene_annotations[['gene_id', 'annotation_id', 'annotation_source_id', 'e_value']].to_csv(gene_file, index=False, header=None)
-        session.execute("COPY gene_annotation (gene_id, annotation_id, annotation_source_id, e_value) FROM '{}' WITH CSV;".format(args.tmp_file))
-        session.commit()
-        return commited_genes
-
-    if args.gene_annotations_cog:
-        commited_genes = add_genes_with_annotation("Cog", args.gene_annotations_cog, commited_genes, all_annotations, all_annotation_sources["Cog"])
-    if args.gene_annotations_pfam:
-        commited_genes = add_genes_with_annotation("Pfam", args.gene_annotations_pfam, commited_genes, all_annotations, all_annotation_sources["Pfam"])
-    if args.gene_annotations_tigrfam:
-        commited_genes = add_genes_with_annotation("TigrFam", args.gene_annotations_tigrfam, commited_genes, all_annotations, all_annotation_sources["TigrFam"])
-    if args.gene_annotations_eggnog:
-        commited_genes = add_genes_with_annotation("EggNOG", args.gene_annotations_eggnog, commited_genes, all_annotations, all_annotation_sources["EggNOG"])
-    if args.gene_annotations_ec:
-        commited_genes = add_genes_with_annotation("EC", args.gene_annotations_ec, commited_genes, all_annotations, all_annotation_sources["EC"])
-
-    logging.info("Processed {} genes in total, moving on to gene counts".format(len(commited_genes.keys())))
-
-    # Fetch each gene from the gene count file and create the corresponding gene count
-    logging.info("Starting with gene counts")
-    gene_counts = pd.read_table(args.gene_counts, index_col=0)
-    total_gene_count_len = len(gene_counts)
-    val_cols = gene_counts.columns
-    nr_columns = len(val_cols)
-
-    filtered_gene_counts = gene_counts[ gene_counts.index.isin(commited_genes.keys()) ].copy()
-    filtered_gene_counts['gene_name'] = filtered_gene_counts.index
-    filtered_gene_counts['gene_id'] = filtered_gene_counts['gene_name'].apply(lambda x: commited_genes[x])
-
-    all_sample_ids = dict((sample_name, sample.id) for sample_name, sample in all_samples.items())
-    filtered_gene_counts.rename(columns=all_sample_ids, inplace=True)
-
-    sample_id_cols = filtered_gene_counts.columns.tolist()
-    sample_id_cols.remove('gene_id')
-    sample_id_cols.remove('gene_name')
-    sample_id_cols.remove('gene_length')
-    tot_nr_samples = len(sample_id_cols)
-
-    filtered_gene_counts.index = filtered_gene_counts['gene_id']
-    filtered_gene_counts = pd.DataFrame(filtered_gene_counts[sample_id_cols].stack())
-    filtered_gene_counts.reset_index(inplace=True)
-    filtered_gene_counts.columns = ['gene_id', 'sample_id', 'rpkm']
-
-    logging.info("Start adding gene counts")
-
-    for i, sample_t in enumerate(filtered_gene_counts.groupby('sample_id')):
-        sample, sample_df = sample_t
-        with open(args.tmp_file, 'w') as gene_counts_file:
-            sample_df.to_csv(gene_counts_file, index=False, header=None)
-
-        logging.info("Adding gene counts from file. Sample {} ({}/{})".format(sample, i+1, tot_nr_samples))
-        session.execute("COPY gene_count (gene_id, sample_id, rpkm) FROM '{}' WITH CSV;".format(args.tmp_file))
-
-    logging.info("{} out of {} are annotated genes".format(len(filtered_gene_counts), total_gene_count_len))
-    session.commit()
-
-    logging.info("Refreshing materialized view")
-    refresh_all_mat_views()
-    session.commit()
+        annotated_genes["reference_assembly_id"] = reference_assembly().id
+
+        commited_genes().update(copy_dataframe_returning(session, annotated_genes, 'gene', ['name', 'reference_assembly_id', 'taxon_id'], 'name'))
+        logging.info("{} genes present in database".format(len(commited_genes().keys())))
+
+    def add_annotations():
+        annotation_files = [(annotation_type, path) for annotation_type, path in [
+                ("Cog", args.gene_annotations_cog),
+                ("Pfam", args.gene_annotations_pfam),
+                ("TigrFam", args.gene_annotations_tigrfam),
+                ("EggNOG", args.gene_annotations_eggnog),
+                ("EC", args.gene_annotations_ec),
+                ("dbCAN", args.gene_annotations_dbcan)] if path]
+
+        all_annotation_ids = dict( session.query(Annotation.type_identifier, Annotation.id).all() )
+        annotation_source_ids = dict( session.query(AnnotationSource.dbname, AnnotationSource.id).all() )
+        reference_assembly_id = reference_assembly().id
+
+        # The parallel copy commits each file on its own, so remove what
+        # a failed earlier run of this stage left behind
+        source_ids = [annotation_source_ids[annotation_type] for annotation_type, _ in annotation_files]
+        GeneAnnotation.query.filter(GeneAnnotation.annotation_source_id.in_(source_ids)).delete(synchronize_session=False)
+
+        if args.parallel_annotations:
+            copy_gene_annotations(session,
+                    [(annotation_type, path, annotation_source_ids[annotation_type]) for annotation_type, path in annotation_files],
+                    commited_genes(), all_annotation_ids, reference_assembly_id)
+        else:
+            for annotation_type, path in annotation_files:
+                logging.info("Adding genes with {} annotations".format(annotation_type))
+                copy_gene_annotation_file(session, path, commited_genes(), all_annotation_ids,
+                        annotation_source_ids[annotation_type], reference_assembly_id)
+
+        logging.info("Processed {} genes in total".format(len(commited_genes().keys())))
+
+    def add_gene_counts():
+        # Stream the gene count matrix into the database a chunk of genes at a time
+        logging.info("Starting with gene counts")
+        if args.gene_count_vectors:
+            logging.info("Adding gene count vectors")
+            copy_gene_count_vectors(args.gene_counts, commited_genes(), all_samples())
+
+        logging.info("Start adding gene counts")
+        nr_gene_counts = copy_gene_counts(session, args.gene_counts, commited_genes(), all_samples())
+        logging.info("Added {} gene counts".format(nr_gene_counts))
+
+    def build_indexes():
+        logging.info("Rebuilding indexes and constraints")
+        restore_indexes(session, LoadStage.completed(PIPELINE)['drop_indexes'].details)
+
+    def update_views():
+        logging.info("Updating the rpkm tables for the new samples")
+        update_sample_aggregates([sample.id for sample in all_samples().values()])
+
+    # The indexes dropped by an earlier bulk load run have to be rebuilt
+    # even if this run does not ask for a bulk load
+    completed = LoadStage.completed(PIPELINE)
+    indexes_dropped = 'drop_indexes' in completed and 'build_indexes' not in completed
+    if args.restart and indexes_dropped:
+        # Restarting would forget the definitions of the dropped indexes
+        logging.error("The indexes dropped by an earlier bulk load have not been rebuilt, "
+                "rerun without --restart to complete that load first")
+        sys.exit(-1)
+    bulk_load = args.bulk_load or indexes_dropped
+
+    stages = [
+            ('samples', add_samples),
+            ('catalogues', add_catalogues)]
+    if bulk_load:
+        stages.append(('drop_indexes', drop_indexes))
+    stages += [
+            ('taxa', add_taxa),
+            ('genes', add_genes_with_taxonomy),
+            ('annotations', add_annotations),
+            ('counts', add_gene_counts)]
+    if bulk_load:
+        stages.append(('build_indexes', build_indexes))
+    stages.append(('views', update_views))
+
+    run_stages(session, PIPELINE, stages, restart=args.restart)
     logging.info("Finished!")
 
 if __name__ == '__main__':
@@ -356,17 +310,22 @@ if __name__ == '__main__':
     parser.add_argument("--eggnog_category_info", help=("A tsv file with all the possible eggnog categories."))
     parser.add_argument("--pfam_annotation_info", help=("A tsv file with all the possible pfam annotations."))
     parser.add_argument("--tigrfam_annotation_info", help=("A tsv file with all the possible tigrfam annotations."))
+    parser.add_argument("--dbcan_annotation_info", help=("A tsv file with all the possible dbCAN annotations."))
     parser.add_argument("--annotation_source_info", help="A csv file with all the annotation source info.")
     parser.add_argument("--gene_annotations_cog", help="A tsv file with all the gene annotations")
     parser.add_argument("--gene_annotations_pfam", help="A tsv file with all the pfam gene annotations")
     parser.add_argument("--gene_annotations_tigrfam", help="A tsv file with all the tigrfam gene annotations")
     parser.add_argument("--gene_annotations_ec", help="A tsv file with all the ec gene annotations")
     parser.add_argument("--gene_annotations_eggnog", help="A tsv file with all the eggnog gene annotations")
+    parser.add_argument("--gene_annotations_dbcan", help="A tsv file with all the dbCAN gene annotations")
     parser.add_argument("--reference_assembly", help="Name of the reference assembly that the genes belong to")
     parser.add_argument("--gene_counts", help="A tsv file with each sample as a column containing all the gene counts")
     parser.add_argument("--taxonomy_per_gene", help="A tsv file with taxonomic annotation per gene")
     parser.add_argument("--metadata_reference", help="A tsv file with which metadata parameters that are supposed to be added")
-    parser.add_argument("--tmp_file", help="A file that will be used to import gene counts to postgres")
+    parser.add_argument("--gene_count_vectors", action="store_true", help="Also store the gene counts as one vector per gene")
+    parser.add_argument("--parallel_annotations", action="store_true", help="Parse and copy the gene annotation files in parallel, one process per file")
+    parser.add_argument("--bulk_load", action="store_true", help="Drop the indexes and constraints of the gene, gene annotation and gene count tables while loading and rebuild them afterwards")
+    parser.add_argument("--restart", action="store_true", help="Run all stages, also those completed by an earlier run against this database. Refused while indexes dropped by an earlier bulk load are still to be rebuilt")
     args = parser.parse_args()
 
     main(args)
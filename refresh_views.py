@@ -7,18 +7,20 @@ import sys
 import logging
 import datetime
 
-from materialized_view_factory import refresh_all_mat_views
-
-def main():
+def main(args):
     logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
     session = app.db.session()
 
-    logging.info("Refreshing materialized view")
-    refresh_all_mat_views()
+    logging.info("Rebuilding the rpkm tables and refreshing materialized views")
+    stats = rebuild_aggregates(max_workers=args.workers)
     session.commit()
+    for name, (seconds, nr_rows) in sorted(stats.items(), key=lambda item: -item[1][0]):
+        logging.info("{}: {:.1f}s, {} rows".format(name, seconds, nr_rows))
     logging.info("Finished!")
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="This will refresh the materialized views. Useful if data have been added but refreshing failed")
-    main()
+    parser = argparse.ArgumentParser(description="This will rebuild the rpkm tables and refresh the materialized views. Useful if data have been added but updating them failed")
+    parser.add_argument("--workers", type=int, default=4, help="The number of tables and views to rebuild at the same time, 1 rebuilds them one by one in a single transaction")
+    args = parser.parse_args()
+    main(args)
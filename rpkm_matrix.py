@@ -0,0 +1,122 @@
+"""An in-memory, column oriented copy of the rpkm_table.
+
+The table is loaded once into an annotation x sample NumPy matrix so that
+the functional table can be filtered, summed and sorted without any
+round trips to postgres. The loaded matrix is shared within the process
+and reloaded when it is older than the given max age.
+"""
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+# Columns expected in the long format data frame used to build the matrix
+MATRIX_COLUMNS = ['annotation_id', 'type_identifier', 'annotation_type',
+        'sample_id', 'sample_scilifelab_code', 'rpkm']
+
+_MATRIX = None
+_MATRIX_LOADED_AT = None
+_MATRIX_LOCK = threading.Lock()
+
+
+class RpkmMatrix(object):
+    """Annotation x sample matrix of summed rpkm values.
+
+    Rows are ordered by annotation id and columns by sample id. Cells for
+    which the table has no row are NaN.
+    """
+
+    def __init__(self, long_df):
+        annotations = long_df[['annotation_id', 'type_identifier', 'annotation_type']].\
+                drop_duplicates('annotation_id').\
+                sort_values('annotation_id')
+        samples = long_df[['sample_id', 'sample_scilifelab_code']].\
+                drop_duplicates('sample_id').\
+                sort_values('sample_id')
+
+        self.annotation_ids = annotations['annotation_id'].values
+        self.annotation_types = annotations['annotation_type'].values
+        self.sample_ids = samples['sample_id'].values
+        self.sample_codes = samples['sample_scilifelab_code'].values
+
+        # Translate type identifiers to row positions
+        self.type_identifier_index = dict(zip(annotations['type_identifier'], range(len(annotations))))
+
+        row_ix = pd.Index(self.annotation_ids).get_indexer(long_df['annotation_id'])
+        col_ix = pd.Index(self.sample_ids).get_indexer(long_df['sample_id'])
+
+        self.values = np.full((len(self.annotation_ids), len(self.sample_ids)), np.nan)
+        self.values[row_ix, col_ix] = long_df['rpkm'].values
+
+    def __len__(self):
+        return len(self.annotation_ids)
+
+    def select(self, samples=None, function_class=None, limit=20, type_identifiers=None):
+        """Returns the annotation ids, sample ids and rpkm values for the
+        top `limit` annotations, sorted by the rpkm sum over the selected
+        samples. Mirrors the filtering of Annotation.rpkm_table."""
+        row_mask = np.ones(len(self.annotation_ids), dtype=bool)
+
+        if function_class is not None:
+            row_mask &= (self.annotation_types == function_class)
+
+        if type_identifiers is not None:
+            type_rows = [self.type_identifier_index[type_identifier]
+                    for type_identifier in type_identifiers
+                    if type_identifier in self.type_identifier_index]
+            type_mask = np.zeros(len(self.annotation_ids), dtype=bool)
+            type_mask[type_rows] = True
+            row_mask &= type_mask
+
+        if samples is not None:
+            col_mask = np.isin(self.sample_codes, list(samples))
+        else:
+            col_mask = np.ones(len(self.sample_ids), dtype=bool)
+
+        rows = np.flatnonzero(row_mask)
+        cols = np.flatnonzero(col_mask)
+        sub_matrix = self.values[np.ix_(rows, cols)]
+
+        # Annotations without counts in any of the selected samples
+        # are not part of the table
+        present = ~np.isnan(sub_matrix).all(axis=1)
+        rows = rows[present]
+        sub_matrix = sub_matrix[present]
+
+        order = np.argsort(-np.nansum(sub_matrix, axis=1), kind='stable')
+        if limit is not None:
+            order = order[:limit]
+        rows = rows[order]
+        sub_matrix = sub_matrix[order]
+
+        # Only samples with counts for the remaining annotations are returned
+        present = ~np.isnan(sub_matrix).all(axis=0)
+        cols = cols[present]
+        sub_matrix = sub_matrix[:, present]
+
+        return self.annotation_ids[rows], self.sample_ids[cols], sub_matrix
+
+
+def get_matrix(loader, max_age=None):
+    """Returns the process wide matrix, building it from the data frame
+    returned by `loader` if it is missing or older than `max_age` seconds."""
+    global _MATRIX
+    global _MATRIX_LOADED_AT
+
+    with _MATRIX_LOCK:
+        if _MATRIX is None or \
+                (max_age is not None and time.time() - _MATRIX_LOADED_AT > max_age):
+            _MATRIX = RpkmMatrix(loader())
+            _MATRIX_LOADED_AT = time.time()
+        return _MATRIX
+
+
+def clear_matrix():
+    """Drops the cached matrix, e.g. after the rpkm table has been updated."""
+    global _MATRIX
+    global _MATRIX_LOADED_AT
+
+    with _MATRIX_LOCK:
+        _MATRIX = None
+        _MATRIX_LOADED_AT = None
@@ -0,0 +1,229 @@
+"""Substring search over the annotation catalogue and the taxonomy used
+for the typeahead.
+
+The searches are served by the trigram indexes on annotation and taxon
+(see the models and migrations 4b6c1e8f2a7d and 9d3f5a1c7e20). The
+results for recent search terms are kept in an in-process cache. Since
+every match for a term is also a match for any prefix of that term, the
+results for a term being typed can often be filtered from the cached
+results of a shorter one instead of searching the whole catalogue again.
+Only the ranking of those results for the longer term is left to the
+database, as a primary key lookup.
+"""
+import collections
+import threading
+import time
+
+import sqlalchemy
+
+from app import db
+from models import Annotation, Taxon, in_list
+
+# Number of matches kept per cached search term
+MAX_CACHED_RESULTS = 200
+# The total number of matches is not counted beyond this
+COUNT_CAP = 1000
+
+
+def escape_like(search_string):
+    """Makes % and _ match literally in a LIKE pattern"""
+    return search_string.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class SearchCache(object):
+    """LRU cache of search results keyed by (scope, search term).
+
+    Each entry holds at most max_results matches and whether those are all
+    the matches there are. Complete entries are used to answer searches for
+    any longer term starting with the cached term.
+    """
+
+    def __init__(self, max_terms=1000, max_age=3600):
+        self.max_terms = max_terms
+        self.max_age = max_age
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, scope, term, matches_term, rank):
+        """Returns (matches, total, complete) or None if nothing usable is cached.
+
+        matches_term(result, term) tells whether a cached result matches term
+        and rank(results) returns the results reused from a shorter term
+        ranked for this one."""
+        with self._lock:
+            now = time.time()
+            key = (scope, term)
+            if key in self._entries:
+                created, matches, total, complete = self._entries[key]
+                if now - created < self.max_age:
+                    self._entries.move_to_end(key)
+                    return matches, total, complete
+
+            # Look for the longest complete cached prefix of this term
+            cached_matches = None
+            for end in range(len(term) - 1, 0, -1):
+                prefix_key = (scope, term[:end])
+                if prefix_key not in self._entries:
+                    continue
+                created, matches, total, complete = self._entries[prefix_key]
+                if complete and now - created < self.max_age:
+                    self._entries.move_to_end(prefix_key)
+                    cached_matches = matches
+                    break
+
+        if cached_matches is None:
+            return None
+
+        matches = rank([match for match in cached_matches if matches_term(match, term)])
+        self.put(scope, term, matches, len(matches), True)
+        return matches, len(matches), True
+
+    def put(self, scope, term, matches, total, complete):
+        with self._lock:
+            self._entries[(scope, term)] = (time.time(), matches, total, complete)
+            self._entries.move_to_end((scope, term))
+            while len(self._entries) > self.max_terms:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+ANNOTATION_SEARCH_CACHE = SearchCache()
+TAXON_SEARCH_CACHE = SearchCache()
+
+
+def annotation_search_query(search_string, function_class, columns=None):
+    """Case insensitive substring search on type identifier and description.
+
+    Wildcards in search_string are matched literally."""
+    pattern = '%' + escape_like(search_string) + '%'
+    if columns is None:
+        q = Annotation.query
+    else:
+        q = db.session.query(*columns)
+
+    q = q.filter(
+            sqlalchemy.or_(
+                Annotation.type_identifier.ilike(pattern, escape='\\'),
+                Annotation.description.ilike(pattern, escape='\\')
+            )
+        )
+    if function_class != 'all':
+        q = q.filter(Annotation.annotation_type == function_class)
+
+    return q
+
+
+def ranked_annotations(q, search_string):
+    """Orders the matches with the best trigram similarity first"""
+    rank = sqlalchemy.func.greatest(
+            sqlalchemy.func.similarity(Annotation.type_identifier, search_string),
+            sqlalchemy.func.word_similarity(search_string,
+                sqlalchemy.func.coalesce(Annotation.description, '')))
+    return q.order_by(rank.desc(), Annotation.type_identifier)
+
+
+def capped_count(q, cap=COUNT_CAP):
+    """Counts the rows of q, but stops counting after cap + 1, so that
+    a count above cap tells that there are more than cap rows"""
+    return db.session.query(sqlalchemy.func.count()).\
+            select_from(q.order_by(None).limit(cap + 1).subquery()).scalar()
+
+
+def _annotation_matches(annotation, term):
+    return term in annotation.type_identifier.lower() or \
+            term in (annotation.description or '').lower()
+
+
+ANNOTATION_SEARCH_COLUMNS = [Annotation.id, Annotation.type_identifier, Annotation.description]
+
+
+def _rank_annotations(annotations, search_string):
+    if not annotations:
+        return annotations
+    q = db.session.query(*ANNOTATION_SEARCH_COLUMNS).\
+            filter(in_list(Annotation.id, [annotation.id for annotation in annotations]))
+    return ranked_annotations(q, search_string).all()
+
+
+def search_annotations(search_string, function_class, limit=10):
+    """Returns the `limit` best matching annotations, the total number of
+    matches and whether that total is exact. The total is capped at COUNT_CAP.
+
+    The annotations only have the id, type_identifier and description attributes."""
+    term = search_string.lower()
+    cached = ANNOTATION_SEARCH_CACHE.get(function_class, term, _annotation_matches,
+            lambda annotations: _rank_annotations(annotations, search_string))
+
+    if cached is None:
+        q = annotation_search_query(search_string, function_class, columns=ANNOTATION_SEARCH_COLUMNS)
+        matches = ranked_annotations(q, search_string).limit(MAX_CACHED_RESULTS + 1).all()
+        complete = len(matches) <= MAX_CACHED_RESULTS
+        matches = matches[:MAX_CACHED_RESULTS]
+        if complete:
+            total = len(matches)
+        else:
+            total = capped_count(q)
+        ANNOTATION_SEARCH_CACHE.put(function_class, term, matches, total, complete)
+    else:
+        matches, total, complete = cached
+
+    return matches[:limit], min(total, COUNT_CAP), complete or total <= COUNT_CAP
+
+
+def taxon_search_query(search_string, columns=None):
+    """Case insensitive substring search on the full taxonomy.
+
+    Wildcards in search_string are matched literally."""
+    pattern = '%' + escape_like(search_string) + '%'
+    if columns is None:
+        q = Taxon.query
+    else:
+        q = db.session.query(*columns)
+
+    return q.filter(Taxon.full_taxonomy.ilike(pattern, escape='\\'))
+
+
+def _taxon_matches(taxon, term):
+    return term in taxon.full_taxonomy.lower()
+
+
+def ranked_taxa(q, search_string):
+    """Orders the matches with the best trigram word similarity first"""
+    rank = sqlalchemy.func.word_similarity(search_string, Taxon.full_taxonomy)
+    return q.order_by(rank.desc(), Taxon.full_taxonomy)
+
+
+def _rank_taxa(taxa, search_string):
+    if not taxa:
+        return taxa
+    q = db.session.query(Taxon.id, Taxon.full_taxonomy).\
+            filter(in_list(Taxon.id, [taxon.id for taxon in taxa]))
+    return ranked_taxa(q, search_string).all()
+
+
+def search_taxa(search_string, limit=20):
+    """Returns the `limit` best matching taxa, the total number of matches
+    and whether that total is exact. The total is capped at COUNT_CAP.
+
+    The taxa only have the id and full_taxonomy attributes."""
+    term = search_string.lower()
+    cached = TAXON_SEARCH_CACHE.get(None, term, _taxon_matches,
+            lambda taxa: _rank_taxa(taxa, search_string))
+
+    if cached is None:
+        q = taxon_search_query(search_string, columns=[Taxon.id, Taxon.full_taxonomy])
+        matches = ranked_taxa(q, search_string).limit(MAX_CACHED_RESULTS + 1).all()
+        complete = len(matches) <= MAX_CACHED_RESULTS
+        matches = matches[:MAX_CACHED_RESULTS]
+        if complete:
+            total = len(matches)
+        else:
+            total = capped_count(q)
+        TAXON_SEARCH_CACHE.put(None, term, matches, total, complete)
+    else:
+        matches, total, complete = cached
+
+    return matches[:limit], min(total, COUNT_CAP), complete or total <= COUNT_CAP
@@ -0,0 +1,120 @@
+"""Random access to the records of a fasta file by sequence name.
+
+A SequenceStore memory maps the fasta file and keeps an index from
+sequence name to the byte offset and length of its record, so that
+sequences can be extracted without reading the file or starting another
+process. The index is built by a single scan of the file and saved next
+to it (<fasta>.offsets) for the next process to load, as long as that
+file is newer than the fasta file.
+"""
+import mmap
+import os
+import threading
+
+
+class SequenceStore(object):
+    def __init__(self, fasta_path):
+        self.fasta_path = fasta_path
+        self.index_path = fasta_path + '.offsets'
+        self._mmap = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        with self._lock:
+            if self._index is not None:
+                return
+            with open(self.fasta_path, 'rb') as fasta_fh:
+                mm = mmap.mmap(fasta_fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+            index = self._load_index()
+            if index is None:
+                index = build_index(mm)
+                self._save_index(index)
+
+            self._mmap = mm
+            self._index = index
+
+    def _load_index(self):
+        try:
+            if os.path.getmtime(self.index_path) < os.path.getmtime(self.fasta_path):
+                return None
+            index = {}
+            with open(self.index_path) as index_fh:
+                for line in index_fh:
+                    name, offset, length = line.rstrip('\n').split('\t')
+                    index[name] = (int(offset), int(length))
+            return index
+        except (OSError, ValueError):
+            return None
+
+    def _save_index(self, index):
+        # The index is only a cache, the store works fine without it
+        try:
+            with open(self.index_path + '.tmp', 'w') as index_fh:
+                for name, (offset, length) in index.items():
+                    index_fh.write('{}\t{}\t{}\n'.format(name, offset, length))
+            os.replace(self.index_path + '.tmp', self.index_path)
+        except OSError:
+            pass
+
+    def __len__(self):
+        self._open()
+        return len(self._index)
+
+    def __contains__(self, name):
+        self._open()
+        return name in self._index
+
+    def get(self, name):
+        """Returns the fasta record for name, or None if there is no such sequence"""
+        records, _ = self.get_many([name])
+        return records[0] if records else None
+
+    def get_many(self, names):
+        """Returns the fasta records for names and a list of the names not found.
+
+        The records are read in the order they appear in the file."""
+        locations, missing = self.locate(names)
+        return list(self.read(locations)), missing
+
+    def locate(self, names):
+        """Returns the (offset, length) of the records for names in file
+        order, and a list of the names not found."""
+        self._open()
+        found = set()
+        missing = []
+        for name in names:
+            if name in self._index:
+                found.add(self._index[name])
+            else:
+                missing.append(name)
+        return sorted(found), missing
+
+    def read(self, locations):
+        """Yields the fasta records at locations, as returned by locate"""
+        self._open()
+        for offset, length in locations:
+            record = self._mmap[offset:offset + length].decode()
+            if not record.endswith('\n'):
+                record += '\n'
+            yield record
+
+
+def build_index(mm):
+    """Maps each sequence name (the header up to the first white space)
+    to the byte offset and length of its record."""
+    index = {}
+    size = len(mm)
+    start = mm.find(b'>')
+    while start != -1:
+        header_end = mm.find(b'\n', start)
+        if header_end == -1:
+            header_end = size
+        header = mm[start + 1:header_end].split(None, 1)
+        next_start = mm.find(b'\n>', header_end)
+        end = size if next_start == -1 else next_start + 1
+        if header:
+            index[header[0].decode()] = (start, end - start)
+        start = -1 if next_start == -1 else next_start + 1
+    return index
@@ -12,10 +12,8 @@ time python populate_db.py --sample_info data/test/lmo/sample_info.csv \
     --reference_assembly "megahit_coassembly.0" \
     --gene_counts data/test/lmo/all_genes.tpm.tsv.gz \
     --metadata_reference data/test/metadata_reference.tsv \
-    --tmp_file /Users/johannesalneberg/repos/BARM_web_server/data/test/tmp_file.csv \
     --taxonomy_per_gene ~/repos/BARM_web_server/data/test/lca_megan.tsv
 
 time python add_sample_set_to_db.py --sample_info data/test/baltic_redox_cline_2014/sample_info.csv \
     --gene_counts data/test/baltic_redox_cline_2014/all_genes.tpm.tsv.gz \
-    --metadata_reference data/test/metadata_reference.tsv \
-    --tmp_file /Users/johannesalneberg/repos/BARM_web_server/data/test/tmp_file.csv
+    --metadata_reference data/test/metadata_reference.tsv
@@ -2,13 +2,29 @@ import unittest
 import app
 from models import Sample, SampleSet, TimePlace, SampleProperty, ReferenceAssembly, Gene, \
     GeneCount, AnnotationSource, Annotation, GeneAnnotation, Cog, Pfam, TigrFam, EcNumber, \
-    EggNOG, EggNOGCategory, RpkmTable, Taxon, TaxonRpkmTable, User
+    EggNOG, EggNOGCategory, RpkmTable, Taxon, TaxonRpkmTable, User, GeneCountVector, \
+    GeneCountVectorSample
 import sqlalchemy
 
 import itertools
 import datetime
-
-from materialized_view_factory import refresh_all_mat_views
+import os
+import tempfile
+import time
+from unittest import mock
+
+import models
+import materialized_view_factory
+import rpkm_matrix
+import search
+import blast
+import sequence_store
+import bulk_copy
+import gene_count_ingest
+import load_stages
+import annotation_ingest
+import annotation_types
+import pandas as pd
 
 class SampleTestCase(unittest.TestCase):
     """Test that a sample in the database has the correct relations"""
@@ -242,6 +258,20 @@ class SampleTestCase(unittest.TestCase):
             self.session.add(gene3)
             self.session.commit()
 
+    def test_in_list(self):
+        reference_assembly = ReferenceAssembly("version 1")
+        for i in range(300):
+            self.session.add(Gene("gene{}".format(i), reference_assembly))
+        self.session.commit()
+
+        for n_values in [0, 5, models.IN_LIST_ARRAY_THRESHOLD + 1, 1000]:
+            gene_names = ["gene{}".format(i) for i in range(n_values)]
+            genes = Gene.query.filter(models.in_list(Gene.name, gene_names)).all()
+            assert len(genes) == min(n_values, 300)
+            assert set(gene.name for gene in genes) <= set(gene_names)
+
+        assert len(Gene.get_genes(["gene{}".format(i) for i in range(150)])) == 150
+
     def test_gene_count(self):
         sample1 = Sample("P1993_101", None, None)
         reference_assembly = ReferenceAssembly("version 1")
@@ -276,6 +306,79 @@ class SampleTestCase(unittest.TestCase):
         self.session.commit()
         assert gene1.rpkm == {sample1: 0.001, sample2: 0.2}
 
+    def test_gene_rpkm_table(self):
+        annotation_source = AnnotationSource("Pfam", "v1.0", "rpsblast", "e_value=0.000001")
+        reference_assembly = ReferenceAssembly("version 1")
+        sample1 = Sample("P1993_101", None, None)
+        sample2 = Sample("P1993_102", None, None)
+        taxon = Taxon(superkingdom="Bacteria", phylum="Cyanobacteria")
+        gene1 = Gene("gene1", reference_assembly)
+        gene2 = Gene("gene2", reference_assembly)
+        gene3 = Gene("gene3", reference_assembly)
+        gene1.taxon = taxon
+        pfam1 = Pfam("pfam00001", description="A domain")
+        tigrfam1 = TigrFam("TIGR00001")
+        self.session.add(GeneCount(gene1, sample1, 0.1))
+        self.session.add(GeneCount(gene1, sample2, 0.25))
+        self.session.add(GeneCount(gene2, sample2, 1.5))
+        self.session.add(gene3)
+        self.session.add(GeneAnnotation(pfam1, gene1, annotation_source))
+        self.session.add(GeneAnnotation(tigrfam1, gene1, annotation_source))
+        self.session.add(GeneAnnotation(pfam1, gene2, annotation_source))
+        self.session.commit()
+
+        samples, table = Gene.rpkm_table(["gene2", "gene1", "gene3", "gene4"])
+        assert samples == [sample1, sample2]
+        assert [gene.name for gene in table.keys()] == ["gene2", "gene1"]
+
+        gene1_d = table[list(table.keys())[1]]
+        assert gene1_d[sample1] == "0.1000"
+        assert gene1_d[sample2] == "0.2500"
+        assert gene1_d['taxonomy'] == taxon.full_taxonomy
+        assert set(gene1_d['annotations'].keys()) == set(["Pfam", "TIGRFAM"])
+        pfam_summary = gene1_d['annotations']["Pfam"][0]
+        assert pfam_summary.type_identifier == "pfam00001"
+        assert pfam_summary.description == "A domain"
+        assert pfam_summary.external_link == pfam1.external_link
+
+        gene2_d = table[list(table.keys())[0]]
+        assert sample1 not in gene2_d
+        assert 'taxonomy' not in gene2_d
+
+    def test_gene_rpkm_table_pages(self):
+        annotation_source = AnnotationSource("Pfam", "v1.0", "rpsblast", "e_value=0.000001")
+        reference_assembly = ReferenceAssembly("version 1")
+        sample1 = Sample("P1993_101", None, None)
+        sample2 = Sample("P1993_102", None, None)
+        sample3 = Sample("P1993_103", None, None)
+        pfam1 = Pfam("PFAM0001")
+        pfam2 = Pfam("PFAM0002")
+        for i in range(25):
+            gene = Gene("gene{}".format(i), reference_assembly)
+            self.session.add(GeneCount(gene, sample1, 0.001*(i+1)))
+            if i % 3 == 0:
+                self.session.add(GeneCount(gene, sample2, 0.01*(i+1)))
+            self.session.add(GeneAnnotation(pfam1 if i % 2 else pfam2, gene, annotation_source))
+        self.session.add(sample3)
+        self.session.commit()
+
+        samples = Gene.samples_with_counts_for_annotations([pfam1.id])
+        assert samples == [sample1, sample2]
+
+        pages = list(Gene.rpkm_table_pages([pfam1.id, pfam2.id], page_size=10))
+        assert [len(page) for page in pages] == [10, 10, 5]
+
+        all_names = ["gene{}".format(i) for i in range(25)]
+        _, table = Gene.rpkm_table(all_names)
+        paged_table = {}
+        for page in pages:
+            paged_table.update(page)
+        assert paged_table == dict(table)
+
+        pages = list(Gene.rpkm_table_pages([pfam1.id], page_size=100))
+        assert len(pages) == 1
+        assert set(gene.name for gene in pages[0]) == set(["gene{}".format(i) for i in range(1, 25, 2)])
+
     def test_taxon(self):
         ref_assembly = ReferenceAssembly("Version 1")
         gene1 = Gene("gene1", ref_assembly)
@@ -300,19 +403,19 @@ class SampleTestCase(unittest.TestCase):
         assert taxon1.phylum == 'Proteobacteria'
         assert taxon1.taxclass == ''
         assert taxon1.full_taxonomy == 'Bacteria;Proteobacteria;;;;;;'
-        refresh_all_mat_views()
+        models.rebuild_aggregates()
 
         # Test sample count retreival
         sample2 = Sample("P1993_102", None, None)
         self.session.add(sample2)
         self.session.commit()
-        refresh_all_mat_views()
+        models.rebuild_aggregates()
         assert taxon1.rpkm == {sample1: 0.001}
 
         gene_count2 = GeneCount(gene1, sample2, 0.2)
         self.session.add(gene_count2)
         self.session.commit()
-        refresh_all_mat_views()
+        models.rebuild_aggregates()
         assert taxon1.rpkm == {sample1: 0.001, sample2: 0.2}
 
         gene2 = Gene("gene2", ref_assembly)
@@ -321,7 +424,7 @@ class SampleTestCase(unittest.TestCase):
         self.session.add(gene2)
         self.session.add(gene_count3)
         self.session.commit()
-        refresh_all_mat_views()
+        models.rebuild_aggregates()
 
         # taxon1.rpkm should still be the same since the new gene is not connected to taxon1
         assert taxon1.rpkm == {sample1: 0.001, sample2: 0.2}
@@ -331,7 +434,7 @@ class SampleTestCase(unittest.TestCase):
         self.session.add(taxon2)
         self.session.add(gene2)
         self.session.commit()
-        refresh_all_mat_views()
+        models.rebuild_aggregates()
 
         # Taxon2 should have gene_count3 stats only
         assert taxon2.rpkm == {sample2: 0.1}
@@ -356,7 +459,7 @@ class SampleTestCase(unittest.TestCase):
         self.session.add(gene4)
         self.session.add(gene_count5)
         self.session.commit()
-        refresh_all_mat_views()
+        models.rebuild_aggregates()
 
         # theoretical rpkm_table:
         # samples = [sample1, sample2]
@@ -376,6 +479,306 @@ class SampleTestCase(unittest.TestCase):
         assert rpkm_table[("Eukaryota;Chlorophyta")] == {sample2: 0.1}
         assert rpkm_table[("Eukaryota;Unnamed")] == {sample2: 0.003}
 
+        assert Taxon.rpkm_table_row(complete_taxonomy="Bacteria") == {sample1: 1.001, sample2: 0.2}
+        assert Taxon.rpkm_table_row(level="phylum", complete_taxonomy="Eukaryota;Chlorophyta") == {sample2: 0.1}
+        assert Taxon.rpkm_table_row(level="phylum", complete_taxonomy="Eukaryota;Missing") == {}
+
+        table_rows = Taxon.rpkm_table_rows(level="phylum", complete_taxonomies=["Eukaryota;Unnamed", "Eukaryota;Missing", "Bacteria;Proteobacteria"])
+        assert list(table_rows.keys()) == ["Eukaryota;Unnamed", "Eukaryota;Missing", "Bacteria;Proteobacteria"]
+        assert table_rows["Eukaryota;Unnamed"] == {sample2: 0.003}
+        assert table_rows["Eukaryota;Missing"] == {}
+        assert table_rows["Bacteria;Proteobacteria"] == {sample1: 1.001, sample2: 0.2}
+
+        # The children of a taxon are found through their parent taxonomy
+        samples, rpkm_table, complete_val_to_val = Taxon.rpkm_table(level='phylum',
+                top_level='superkingdom', top_level_complete_values=["Eukaryota"])
+        assert list(rpkm_table.keys()) == ["Eukaryota;Chlorophyta", "Eukaryota;Unnamed"]
+        samples, rpkm_table, complete_val_to_val = Taxon.rpkm_table(level='taxclass',
+                top_level='superkingdom', top_level_complete_values=["Eukaryota"])
+        assert list(rpkm_table.keys()) == ["Eukaryota;Chlorophyta;", "Eukaryota;Unnamed;Dinophyceae"]
+        parents = set(self.session.query(models.TaxonLevelRpkmTable.level, models.TaxonLevelRpkmTable.parent_taxonomy).\
+                filter(models.TaxonLevelRpkmTable.complete_taxonomy.startswith("Eukaryota;Unnamed")).all())
+        assert parents == set([("phylum", "Eukaryota"), ("taxclass", "Eukaryota;Unnamed")])
+
+    def test_gene_count_partition(self):
+        reference_assembly = ReferenceAssembly("version 1")
+        sample_set1 = SampleSet("set1", public=True)
+        sample_set2 = SampleSet("set2", public=True)
+        sample1 = Sample("P1993_101", sample_set1, None)
+        sample2 = Sample("P1993_102", sample_set2, None)
+        sample3 = Sample("P1993_103", None, None)
+        gene1 = Gene("gene1", reference_assembly)
+        gc1 = GeneCount(gene1, sample1, 0.1)
+        gc2 = GeneCount(gene1, sample2, 0.2)
+        gc3 = GeneCount(gene1, sample3, 0.3)
+        self.session.add_all([gc1, gc2, gc3])
+        self.session.commit()
+
+        assert gc1.sample_set_id == sample_set1.id
+        assert gc2.sample_set_id == sample_set2.id
+        assert gc3.sample_set_id == 0
+
+        samples, table = Gene.rpkm_table(["gene1"], sample_set_ids=[sample_set2.id])
+        assert samples == [sample2]
+        assert list(table.values())[0][sample2] == "0.2000"
+
+
+    def test_gene_count_vectors(self):
+        reference_assembly = ReferenceAssembly("version 1")
+        sample_sets = [SampleSet("set{}".format(i), public=True) for i in range(3)]
+        samples = [Sample("P1993_101", sample_sets[0], None), Sample("P1993_102", sample_sets[0], None),
+                Sample("P1993_103", sample_sets[1], None), Sample("P1993_104", sample_sets[2], None)]
+        genes = [Gene("gene{}".format(i), reference_assembly) for i in range(3)]
+        self.session.add_all(samples + genes)
+        self.session.commit()
+        s1, s2, s3, s4 = [sample.id for sample in samples]
+        g1, g2, g3 = [gene.id for gene in genes]
+
+        # Sample set 1 has no count for gene2 in its second sample,
+        # sample set 2 has no counts for gene2 and sample set 3 only for gene2
+        counts = [
+            pd.DataFrame({s1: [0.5, 0.25], s2: [1.0, float('nan')]}, index=[g1, g2]),
+            pd.DataFrame({s3: [2.0, 4.0]}, index=[g1, g3]),
+            pd.DataFrame({s4: [8.0]}, index=[g2])]
+        for chunk in counts:
+            sample_ids = chunk.columns.tolist()
+            GeneCountVector.add_counts(sample_ids, iter([chunk]))
+            for sample_id in sample_ids:
+                sample = Sample.query.get(sample_id)
+                for gene_id, rpkm in chunk[sample_id].dropna().items():
+                    self.session.add(GeneCount(Gene.query.get(int(gene_id)), sample, rpkm))
+        self.session.commit()
+
+        positions = dict(self.session.query(GeneCountVectorSample.sample_id, GeneCountVectorSample.position).all())
+        assert positions == {s1: 1, s2: 2, s3: 3, s4: 4}
+
+        vectors = dict(self.session.query(GeneCountVector.gene_id, GeneCountVector.rpkms).all())
+        assert vectors[g1] == [0.5, 1.0, 2.0]
+        # Padded with NULL for the sample set without counts for gene2
+        assert vectors[g2] == [0.25, None, None, 8.0]
+        assert vectors[g3] == [None, None, 4.0]
+
+        # Every count in gene_count is in the vectors, and no other
+        nr_counts = 0
+        for gene_count in GeneCount.query.all():
+            assert vectors[gene_count.gene_id][positions[gene_count.sample_id] - 1] == gene_count.rpkm
+            nr_counts += 1
+        assert nr_counts == sum(1 for vector in vectors.values() for rpkm in vector if rpkm is not None)
+
+        subquery = GeneCountVector.counts_subquery([g1, g2, g3])
+        rows = dict((gene_id, (sample_ids, rpkms)) for gene_id, sample_ids, rpkms in self.session.query(subquery).all())
+        assert rows == {g1: ([s1, s2, s3], [0.5, 1.0, 2.0]), g2: ([s1, s4], [0.25, 8.0]), g3: ([s3], [4.0])}
+        subquery = GeneCountVector.counts_subquery([g1, g2, g3], [sample_sets[2].id])
+        assert [tuple(row) for row in self.session.query(subquery).all()] == [(g2, [s4], [8.0])]
+
+        gene_names = [gene.name for gene in genes]
+        _, table = Gene.rpkm_table(gene_names)
+        use_vectors = app.app.config.get('GENE_COUNT_VECTORS')
+        app.app.config['GENE_COUNT_VECTORS'] = True
+        try:
+            _, vector_table = Gene.rpkm_table(gene_names)
+        finally:
+            app.app.config['GENE_COUNT_VECTORS'] = use_vectors
+        assert vector_table == table
+
+        # Genes added later, with counts only in gene_count, get vectors
+        # over the positions already in use
+        new_genes = [Gene("gene3", reference_assembly), Gene("gene4", reference_assembly)]
+        self.session.add_all(new_genes)
+        self.session.add(GeneCount(new_genes[0], samples[1], 16.0))
+        self.session.add(GeneCount(new_genes[0], samples[3], 32.0))
+        self.session.commit()
+        g4, g5 = [gene.id for gene in new_genes]
+        assert GeneCountVectorSample.in_use()
+        assert GeneCountVector.add_genes([g1, g4, g5]) == 1
+        self.session.commit()
+
+        vectors = dict(self.session.query(GeneCountVector.gene_id, GeneCountVector.rpkms).all())
+        assert vectors[g1] == [0.5, 1.0, 2.0]
+        assert vectors[g4] == [None, 16.0, None, 32.0]
+        assert g5 not in vectors
+
+    def test_bulk_copy(self):
+        reference_assembly = ReferenceAssembly("version 1")
+        self.session.add(reference_assembly)
+        self.session.commit()
+
+        genes = pd.DataFrame({'name': ["gene{}".format(i) for i in range(10)],
+            'reference_assembly_id': reference_assembly.id})
+        assert bulk_copy.copy_dataframe(self.session, genes, 'gene', chunk_size=3) == 10
+
+        assert len(Gene.query.all()) == 10
+        gene = Gene.query.filter_by(name="gene7").first()
+        assert gene.reference_assembly is reference_assembly
+        assert gene.taxon_id is None
+
+        new_genes = pd.DataFrame({'name': ["gene10", "gene11"],
+            'reference_assembly_id': reference_assembly.id})
+        gene_ids = bulk_copy.copy_dataframe_returning(self.session, new_genes, 'gene',
+                ['name', 'reference_assembly_id'], 'name')
+        assert set(gene_ids.keys()) == set(["gene10", "gene11"])
+        assert Gene.query.filter_by(name="gene11").first().id == gene_ids["gene11"]
+        assert len(Gene.query.all()) == 12
+
+    def test_gene_count_ingest(self):
+        reference_assembly = ReferenceAssembly("version 1")
+        sample_set = SampleSet("set1", public=True)
+        sample1 = Sample("P1993_101", sample_set, None)
+        sample2 = Sample("P1993_102", None, None)
+        genes = [Gene("gene{}".format(i), reference_assembly) for i in range(5)]
+        self.session.add_all([sample1, sample2] + genes)
+        self.session.commit()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            matrix_path = os.path.join(tmp_dir, "all_genes.tpm.tsv")
+            with open(matrix_path, 'w') as matrix_fh:
+                matrix_fh.write("gene\tgene_length\tP1993_101\tP1993_102\n")
+                for i in range(6):
+                    matrix_fh.write("gene{0}\t100\t{1}\t0.5\n".format(i, i))
+
+            gene_ids = dict((gene.name, gene.id) for gene in genes)
+            samples = {"P1993_101": sample1, "P1993_102": sample2}
+            nr_rows = gene_count_ingest.copy_gene_counts(self.session, matrix_path, gene_ids, samples, chunk_size=2)
+            assert nr_rows == 10
+
+            gene_count = GeneCount.query.filter_by(gene_id=genes[3].id, sample_id=sample1.id).first()
+            assert gene_count.rpkm == 3
+            assert gene_count.sample_set_id == sample_set.id
+            assert GeneCount.query.filter_by(sample_id=sample2.id).first().sample_set_id == 0
+
+            # Every sample in the matrix has to be in the database
+            with self.assertRaises(ValueError):
+                gene_count_ingest.copy_gene_counts(self.session, matrix_path, gene_ids, {"P1993_101": sample1})
+
+    def test_copy_catalogue(self):
+        pfams = pd.DataFrame({'type_identifier': ["pfam00001", "pfam00002"],
+            'description': ["A domain", None]})
+        pfam_ids = Pfam.copy_catalogue(self.session, pfams)
+        assert set(pfam_ids.keys()) == set(["pfam00001", "pfam00002"])
+
+        pfam1 = Annotation.query.filter_by(type_identifier="pfam00001").first()
+        assert isinstance(pfam1, Pfam)
+        assert pfam1.id == pfam_ids["pfam00001"]
+        assert pfam1.description == "A domain"
+        assert Pfam.query.filter_by(type_identifier="pfam00002").first().description is None
+
+        ec_numbers = pd.DataFrame({'type_identifier': ["2.1.1.206"], 'description': ["An enzyme"],
+            'first_digit': [2], 'second_digit': [1], 'third_digit': [1], 'fourth_digit': pd.array([None], dtype='Int64')})
+        EcNumber.copy_catalogue(self.session, ec_numbers,
+                ['first_digit', 'second_digit', 'third_digit', 'fourth_digit'])
+        ec_number = EcNumber.query.first()
+        assert ec_number.third_digit == 1
+        assert ec_number.fourth_digit is None
+
+        eggnog_category_H = EggNOGCategory("H", "Coenzyme transport and metabolism")
+        eggnog_category_G = EggNOGCategory("G", "Carbohydrate transport and metabolism")
+        self.session.add_all([eggnog_category_H, eggnog_category_G])
+        self.session.flush()
+        category_ids = {"H": eggnog_category_H.id, "G": eggnog_category_G.id}
+
+        eggnogs = pd.DataFrame({'type_identifier': ["COG0006", "ENOG410ZWUW"], 'description': ["", ""]})
+        eggnog_ids = EggNOG.copy_catalogue(self.session, eggnogs)
+        categories = pd.Series(["HG", ""], index=[eggnog_ids["COG0006"], eggnog_ids["ENOG410ZWUW"]])
+        assert EggNOG.copy_category_links(self.session, categories, category_ids) == 2
+        self.session.commit()
+
+        eggnog = EggNOG.query.filter_by(type_identifier="COG0006").first()
+        assert set(eggnog.categories) == set([eggnog_category_H, eggnog_category_G])
+        assert EggNOG.query.filter_by(type_identifier="ENOG410ZWUW").first().categories == []
+
+        with self.assertRaises(ValueError):
+            EggNOG.copy_category_links(self.session, pd.Series(["X"], index=[eggnog.id]), category_ids)
+
+    def test_annotation_type_import(self):
+        reference_assembly = ReferenceAssembly("version 1")
+        gene1 = Gene("gene1", reference_assembly)
+        annotation_source = AnnotationSource("dbCAN", "5", "hmmscan", "hmmscan-parser.sh")
+        self.session.add_all([gene1, annotation_source])
+        self.session.commit()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            info_path = os.path.join(tmp_dir, "all_dbCAN_annotation_info.tsv")
+            with open(info_path, 'w') as info_fh:
+                info_fh.write("Id\tncbi-cdd\tcazy-class\tcazy-note\tcazy-activities\n")
+                info_fh.write("CBM13\tpfam00652\tCBM\tA note\tBinds galactose\n")
+                info_fh.write("GH13\t\tGH\tOnly a note\t\n")
+            dbcan_ids = annotation_types.copy_catalogue(self.session, "dbCAN", info_path)
+            assert set(dbcan_ids.keys()) == set(["CBM13", "GH13"])
+
+            cbm13 = Annotation.query.filter_by(type_identifier="CBM13").first()
+            assert isinstance(cbm13, models.DbCAN)
+            assert cbm13.cazy_class == "CBM"
+            assert cbm13.ncbi_cdd == "pfam00652"
+            assert cbm13.description == "Binds galactose"
+            assert models.DbCAN.query.filter_by(type_identifier="GH13").first().description == "Only a note"
+
+            gene_annotation_path = os.path.join(tmp_dir, "all.dbCAN.standardized.tsv")
+            with open(gene_annotation_path, 'w') as gene_annotation_fh:
+                gene_annotation_fh.write("gene1\tCBM13\t2.9e-37\t123.5\n")
+                gene_annotation_fh.write("gene2\tCBM13\t2.4e-50\t165.0\n")
+                gene_annotation_fh.write("gene2\tGH13\t2e-32\t108.1\n")
+                # Not in the annotation info file, as AA6 in data/stage
+                gene_annotation_fh.write("gene2\tAA6\t1.1e-20\t70.2\n")
+                gene_annotation_fh.write("gene3\tAA6\t1.1e-20\t70.2\n")
+            gene_ids = {"gene1": gene1.id}
+            new_gene_names = annotation_ingest.copy_gene_annotation_file(self.session, gene_annotation_path,
+                    gene_ids, dbcan_ids, annotation_source.id, reference_assembly.id)
+            self.session.commit()
+
+        assert new_gene_names == ["gene2"]
+        gene2 = Gene.query.filter_by(name="gene2").first()
+        assert gene_ids["gene2"] == gene2.id
+        assert gene2.reference_assembly is reference_assembly
+        assert set(ga.annotation.type_identifier for ga in gene2.gene_annotations) == set(["CBM13", "GH13"])
+        assert len(cbm13.genes) == 2
+        assert Gene.query.filter_by(name="gene3").first() is None
+        assert len(GeneAnnotation.query.all()) == 3
+
+        with self.assertRaises(ValueError):
+            annotation_types.annotation_type("Unknown")
+
+    def test_gene_annotation_unknown_identifiers(self):
+        reference_assembly = ReferenceAssembly("version 1")
+        annotation_source = AnnotationSource("Pfam", "v1.0", "rpsblast", "e_value=0.000001")
+        pfam1 = Pfam("pfam00001")
+        self.session.add_all([reference_assembly, annotation_source, pfam1])
+        self.session.commit()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gene_annotation_path = os.path.join(tmp_dir, "all.pfam.standardized.tsv")
+            with open(gene_annotation_path, 'w') as gene_annotation_fh:
+                gene_annotation_fh.write("gene1\tpfam00001\t2.9e-37\t123.5\n")
+                gene_annotation_fh.write("gene1\tpfam99999\t2.4e-50\t165.0\n")
+                gene_annotation_fh.write("gene2\tpfam99999\t2e-32\t108.1\n")
+
+            assert list(annotation_ingest.gene_names(gene_annotation_path, {"pfam00001": pfam1.id})) == ["gene1"]
+
+            gene_ids = {}
+            new_gene_names = annotation_ingest.copy_gene_annotation_file(self.session, gene_annotation_path,
+                    gene_ids, {"pfam00001": pfam1.id}, annotation_source.id, reference_assembly.id)
+            self.session.commit()
+
+        # Only the known annotation is stored, and gene2 has no annotations at all
+        assert new_gene_names == ["gene1"]
+        assert Gene.query.filter_by(name="gene2").first() is None
+        gene_annotations = GeneAnnotation.query.all()
+        assert len(gene_annotations) == 1
+        assert gene_annotations[0].annotation is pfam1
+        assert gene_annotations[0].gene_id == gene_ids["gene1"]
+
+    def test_copy_sample_properties(self):
+        sample1 = Sample("P1993_101", None, None)
+        self.session.add(sample1)
+        self.session.flush()
+
+        properties = pd.DataFrame({'name': ["Salinity", "O2", "Depth"], 'value': [6.7, float('nan'), 10.0],
+            'unit': ["psu", "µmol/l", "m"], 'sample_id': sample1.id})
+        assert SampleProperty.copy_properties(self.session, properties) == 3
+        self.session.commit()
+
+        # Integer valued floats are stored without a trailing .0, as the database casts them
+        values = dict((prop.name, prop.value) for prop in sample1.properties)
+        assert values == {"Salinity": "6.7", "O2": "NaN", "Depth": "10"}
 
     def test_taxon_large_scale_rpkm_table(self):
         sample1 = Sample("P1993_101", None, None)
@@ -391,7 +794,7 @@ class SampleTestCase(unittest.TestCase):
 
         self.session.add_all(taxons)
         self.session.commit()
-        refresh_all_mat_views()
+        models.rebuild_aggregates()
 
         for i,taxon in enumerate(taxons):
             count_mode = i % 3
@@ -413,7 +816,7 @@ class SampleTestCase(unittest.TestCase):
             self.session.add(gene2)
 
         self.session.commit()
-        refresh_all_mat_views()
+        models.rebuild_aggregates()
 
         samples, rows, complete_val_to_val = Taxon.rpkm_table()
         assert len(samples) == 2
@@ -790,6 +1193,117 @@ class SampleTestCase(unittest.TestCase):
         assert annotation2.rpkm == { sample1: 0.001, sample2: 0.01 }
         assert annotation3.rpkm == { sample1: 0.002, sample2: 0.02 }
 
+    def test_rpkm_table_update_samples(self):
+        annotation1 = Pfam("PFAM0001")
+        gene1 = Gene("gene1", None)
+        taxon = Taxon(superkingdom="Bacteria")
+        gene1.taxon = taxon
+        annotation_source = AnnotationSource("Pfam", "v1.0", "rpsblast", "e_value=0.000001")
+        sample1 = Sample("P1993_101", None, None)
+        sample2 = Sample("P1993_102", None, None)
+        self.session.add(GeneAnnotation(annotation1, gene1, annotation_source))
+        self.session.add(GeneCount(gene1, sample1, 0.1))
+        self.session.commit()
+        models.update_sample_aggregates([sample1.id])
+        assert [(row.annotation_id, row.sample_id, row.rpkm) for row in RpkmTable.query.all()] == \
+                [(annotation1.id, sample1.id, 0.1)]
+
+        # Only the rows for the updated samples are recomputed
+        self.session.add(GeneCount(gene1, sample2, 0.2))
+        self.session.commit()
+        self.session.execute(RpkmTable.__table__.update().values(rpkm=1.0))
+        self.session.execute(models.TaxonLevelRpkmTable.__table__.update().values(rpkm=1.0))
+        models.update_sample_aggregates([sample2.id])
+        rows = RpkmTable.query.order_by(RpkmTable.sample_id).all()
+        assert [(row.sample_id, row.rpkm) for row in rows] == [(sample1.id, 1.0), (sample2.id, 0.2)]
+        assert TaxonRpkmTable.query.filter_by(sample_id=sample2.id).first().rpkm == 0.2
+        assert Taxon.rpkm_table_row(complete_taxonomy="Bacteria") == {sample1: 1.0, sample2: 0.2}
+        assert Taxon.rpkm_table_row(level="phylum", complete_taxonomy="Bacteria;") == {sample1: 1.0, sample2: 0.2}
+
+        models.delete_sample_aggregates([sample1.id])
+        assert [row.sample_id for row in RpkmTable.query.all()] == [sample2.id]
+        assert [row.sample_id for row in TaxonRpkmTable.query.all()] == [sample2.id]
+        assert set(row.sample_id for row in models.TaxonLevelRpkmTable.query.all()) == set([sample2.id])
+
+    def test_refresh_in_order(self):
+        refreshed = []
+        refreshers = dict((name, lambda connection, name=name: refreshed.append(name))
+                for name in ['taxon_level_rpkm_table', 'rpkm_table', 'taxon_rpkm_table'])
+        stats = materialized_view_factory.refresh_in_order(refreshers,
+                {'taxon_level_rpkm_table': ['taxon_rpkm_table', 'gene_count']})
+        assert set(refreshed) == set(refreshers.keys())
+        assert refreshed.index('taxon_rpkm_table') < refreshed.index('taxon_level_rpkm_table')
+        assert stats['rpkm_table'][1] == 0
+
+        with self.assertRaises(ValueError):
+            materialized_view_factory.refresh_in_order(refreshers,
+                    {'rpkm_table': ['taxon_rpkm_table'], 'taxon_rpkm_table': ['rpkm_table']})
+
+        stats = models.rebuild_aggregates()
+        assert set(stats.keys()) == set(['rpkm_table', 'taxon_rpkm_table', 'taxon_level_rpkm_table'])
+
+    def test_refresh_in_order_concurrently(self):
+        # Every refresher runs on a connection of its own, stubbed here
+        connection = mock.MagicMock()
+        connection.execute.return_value.scalar.return_value = 0
+        stub_db = mock.MagicMock()
+        stub_db.engine.begin.return_value.__enter__.return_value = connection
+
+        events = []
+        def refresher(name):
+            def refresh(refresh_connection):
+                assert refresh_connection is connection
+                events.append(('start', name))
+                time.sleep(0.2)
+                events.append(('end', name))
+            return refresh
+
+        refreshers = dict((name, refresher(name))
+                for name in ['taxon_level_rpkm_table', 'rpkm_table', 'taxon_rpkm_table'])
+        with mock.patch.object(materialized_view_factory, 'db', stub_db):
+            stats = materialized_view_factory.refresh_in_order(refreshers,
+                    {'taxon_level_rpkm_table': ['taxon_rpkm_table']}, max_workers=2)
+
+        assert set(stats.keys()) == set(refreshers.keys())
+        assert stub_db.engine.begin.call_count == 3
+        # The independent tables are refreshed at the same time, and the
+        # dependent one only after its dependency has finished
+        assert events.index(('start', 'rpkm_table')) < events.index(('end', 'taxon_rpkm_table'))
+        assert events.index(('start', 'taxon_rpkm_table')) < events.index(('end', 'rpkm_table'))
+        assert events.index(('end', 'taxon_rpkm_table')) < events.index(('start', 'taxon_level_rpkm_table'))
+
+    def test_load_stages(self):
+        ran = []
+        def stage(name, details=None):
+            def run():
+                ran.append(name)
+                return details
+            return run
+
+        completed = load_stages.run_stages(self.session, 'test',
+                [('first', stage('first', ['a', 1])), ('second', stage('second'))])
+        assert ran == ['first', 'second']
+        assert completed['first'].details == ['a', 1]
+        assert set(models.LoadStage.completed('test').keys()) == set(['first', 'second'])
+        assert models.LoadStage.completed('other') == {}
+
+        # Completed stages are skipped on a rerun
+        ran[:] = []
+        load_stages.run_stages(self.session, 'test',
+                [('first', stage('first')), ('second', stage('second')), ('third', stage('third'))])
+        assert ran == ['third']
+
+        ran[:] = []
+        load_stages.run_stages(self.session, 'test', [('first', stage('first'))], restart=True)
+        assert ran == ['first']
+        assert set(models.LoadStage.completed('test').keys()) == set(['first'])
+
+        def fail():
+            raise ValueError("Failing stage")
+        with self.assertRaises(ValueError):
+            load_stages.run_stages(self.session, 'test', [('failing', fail)])
+        assert 'failing' not in models.LoadStage.completed('test')
+
     def test_annotation_type_rpkm(self):
         # Test rpkm for the subclasses as well
 
@@ -914,7 +1428,7 @@ class SampleTestCase(unittest.TestCase):
             self.session.add(gene1)
             self.session.add(gene2)
         self.session.commit()
-        refresh_all_mat_views()
+        models.rebuild_aggregates()
         samples, rows = Annotation.rpkm_table()
         assert len(samples) == 2
         assert len(rows) == 20 # Default limit
@@ -928,7 +1442,7 @@ class SampleTestCase(unittest.TestCase):
         for annotation, sample_d in rows.items():
             # sample_d should be a ordered dict
             assert ["P1993_101", "P1993_102"] == [sample.scilifelab_code for sample in sample_d.keys()]
-        rpkms = [[rpkm for sample, rpkm in sample_d.items()] for annotation, sample_d in rows.items()]
+        rpkms = [["{0:.4f}".format(rpkm) for sample, rpkm in sample_d.items()] for annotation, sample_d in rows.items()]
 
         rpkms_flat = []
         for rpkm_row in rpkms:
@@ -962,7 +1476,7 @@ class SampleTestCase(unittest.TestCase):
             for annotation, sample_d in rows.items():
                 assert list(sample_d.keys()) == [sample]
 
-            rpkms = [[rpkm for sample, rpkm in sample_d.items()] for annotation, sample_d in rows.items()]
+            rpkms = [["{0:.4f}".format(rpkm) for sample, rpkm in sample_d.items()] for annotation, sample_d in rows.items()]
             if sample.scilifelab_code == "P1993_101":
                 for i, row in enumerate(rpkms[:65]):
                     assert row == ['0.0030']
@@ -991,7 +1505,7 @@ class SampleTestCase(unittest.TestCase):
                 for annotation, sample_d in rows.items():
                     assert list(sample_d.keys()) == [sample]
 
-                rpkms = [[rpkm for sample, rpkm in sample_d.items()] for annotation, sample_d in rows.items()]
+                rpkms = [["{0:.4f}".format(rpkm) for sample, rpkm in sample_d.items()] for annotation, sample_d in rows.items()]
                 if sample.scilifelab_code == "P1993_101":
                     for row in rpkms[:9]:
                         assert row == ['0.0030']
@@ -1017,3 +1531,294 @@ class SampleTestCase(unittest.TestCase):
                 assert len(samples) == 2
                 assert len(rows) == len(type_identifiers)
                 assert set([key.type_identifier for key in rows.keys()]) == set(type_identifiers)
+
+    def test_annotation_rpkm_table_matrix(self):
+        annotation_source = AnnotationSource("Pfam", "v1.0", "rpsblast", "e_value=0.000001")
+        sample1 = Sample("P1993_101", None, None)
+        sample2 = Sample("P1993_102", None, None)
+        for i in range(30):
+            gene = Gene("gene{}".format(i), None)
+            self.session.add(GeneCount(gene, sample1, 0.001*(i+1)))
+            self.session.add(GeneCount(gene, sample2, 0.01*(30-i)))
+            if i % 2:
+                annotation = Pfam("PFAM{:04d}".format(i))
+            else:
+                annotation = TigrFam("TIGRFAM{:04d}".format(i))
+            self.session.add(GeneAnnotation(annotation, gene, annotation_source))
+        self.session.commit()
+        # Rebuilding the rpkm table drops any matrix loaded before
+        models.rebuild_aggregates()
+        assert rpkm_matrix._MATRIX is None
+
+        all_kwargs = [{},
+                {'limit': None},
+                {'limit': 5, 'function_class': 'pfam'},
+                {'limit': None, 'samples': ["P1993_101"]},
+                {'limit': None, 'type_identifiers': ["PFAM0001", "TIGRFAM0004", "PFAM9999"]},
+                {'limit': 2, 'samples': ["P1993_102"], 'function_class': 'tigrfam'}]
+
+        for kwargs in all_kwargs:
+            samples, rows = Annotation.rpkm_table(**kwargs)
+            matrix_samples, matrix_rows = Annotation.rpkm_table_from_matrix(**kwargs)
+            assert set(samples) == set(matrix_samples)
+            assert list(rows.keys()) == list(matrix_rows.keys())
+            for annotation, sample_d in rows.items():
+                assert list(sample_d.keys()) == list(matrix_rows[annotation].keys())
+                for sample, rpkm in sample_d.items():
+                    assert abs(rpkm - matrix_rows[annotation][sample]) < 1e-9
+
+        samples, rows = Annotation.rpkm_table_from_matrix(type_identifiers=["PFAM9999"])
+        assert samples == []
+        assert rows == {}
+
+        # Updating the rpkm table also updates the matrix
+        annotation = Annotation.query.filter_by(type_identifier="PFAM0001").one()
+        gene = Gene("gene30", None)
+        self.session.add(GeneCount(gene, sample1, 1.0))
+        self.session.add(GeneAnnotation(annotation, gene, annotation_source))
+        self.session.commit()
+        RpkmTable.update_annotations([annotation.id])
+        self.session.commit()
+
+        samples, rows = Annotation.rpkm_table_from_matrix(type_identifiers=["PFAM0001"])
+        assert abs(rows[annotation][sample1] - (1.0 + 0.002)) < 1e-9
+
+    def test_annotation_search(self):
+        search.ANNOTATION_SEARCH_CACHE.clear()
+        annotations = [Pfam("PFAM{:04d}".format(i), description="Photosystem protein {}".format(i)) for i in range(30)]
+        annotations.append(TigrFam("TIGR0001", description="Photosynthetic 100% reaction center"))
+        self.session.add_all(annotations)
+        self.session.commit()
+
+        matches, total, exact = search.search_annotations("photos", 'all', limit=10)
+        assert len(matches) == 10
+        assert total == 31
+        assert exact
+
+        # Answered from the cached results for "photos"
+        matches, total, exact = search.search_annotations("photosynth", 'all')
+        assert [match.type_identifier for match in matches] == ["TIGR0001"]
+        assert total == 1
+
+        # The reused results are ranked for the longer term as the database ranks them
+        cached_matches, total, exact = search.search_annotations("photosystem protein 2", 'all')
+        assert total == 11
+        search.ANNOTATION_SEARCH_CACHE.clear()
+        matches, total, exact = search.search_annotations("photosystem protein 2", 'all')
+        assert total == 11
+        assert [match.type_identifier for match in cached_matches] == [match.type_identifier for match in matches]
+        assert matches[0].type_identifier == "PFAM0002"
+
+        matches, total, exact = search.search_annotations("PFAM001", 'pfam')
+        assert set(match.type_identifier for match in matches) == set(["PFAM{:04d}".format(i) for i in range(10, 20)])
+        matches, total, exact = search.search_annotations("PFAM001", 'tigrfam')
+        assert total == 0
+
+        # Wildcards are matched literally
+        matches, total, exact = search.search_annotations("0%", 'all')
+        assert [match.type_identifier for match in matches] == ["TIGR0001"]
+
+        # Counting stops one row after the cap, so that a count of exactly
+        # the cap is told apart from more than the cap
+        q = search.annotation_search_query("photos", 'all')
+        assert search.capped_count(q, cap=31) == 31
+        assert search.capped_count(q, cap=30) == 31
+        assert search.capped_count(q, cap=10) == 11
+
+    def test_taxon_search(self):
+        search.TAXON_SEARCH_CACHE.clear()
+        taxa = [Taxon(superkingdom="Bacteria", phylum="Cyanobacteria", taxclass="tc_{}".format(i)) for i in range(25)]
+        taxa.append(Taxon(superkingdom="Eukaryota", phylum="Chlorophyta"))
+        self.session.add_all(taxa)
+        self.session.commit()
+
+        matches, total, exact = search.search_taxa("bacteria")
+        assert len(matches) == 20
+        assert total == 25
+        assert exact
+
+        matches, total, exact = search.search_taxa("cyanobacteria;tc_1")
+        assert set(match.full_taxonomy for match in matches) == \
+                set(["Bacteria;Cyanobacteria;tc_1{};;;;;".format(i) for i in ['', *range(10)]])
+
+        matches, total, exact = search.search_taxa("CHLORO")
+        assert [match.full_taxonomy for match in matches] == ["Eukaryota;Chlorophyta;;;;;;"]
+
+    def test_sequence_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fasta_path = os.path.join(tmp_dir, "genes.faa")
+            with open(fasta_path, 'w') as fasta_fh:
+                fasta_fh.write(">gene1 first gene\nMKSH\nQFAS\n>gene2\nMAIS\n>gene3\nMTTL")
+
+            store = sequence_store.SequenceStore(fasta_path)
+            assert len(store) == 3
+            assert store.get("gene1") == ">gene1 first gene\nMKSH\nQFAS\n"
+            assert store.get("gene3") == ">gene3\nMTTL\n"
+            assert store.get("gene4") is None
+
+            records, missing = store.get_many(["gene3", "gene4", "gene1"])
+            assert records == [">gene1 first gene\nMKSH\nQFAS\n", ">gene3\nMTTL\n"]
+            assert missing == ["gene4"]
+
+            # A new store uses the saved index
+            assert os.path.isfile(fasta_path + '.offsets')
+            store = sequence_store.SequenceStore(fasta_path)
+            assert store.get("gene2") == ">gene2\nMAIS\n"
+
+    def test_blast_result_cache(self):
+        cache = blast.ResultCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        assert cache.get("a") == 1
+        # "b" is the least recently used entry
+        cache.put("c", 3)
+        assert len(cache) == 2
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+
+        cache = blast.ResultCache(ttl=-1)
+        cache.put("a", 1)
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+    def test_blast_runner(self):
+        def wait_until_idle(runner):
+            # The slots and the cache are updated just after the result is set
+            for i in range(100):
+                if not runner._running:
+                    return
+                time.sleep(0.01)
+
+        runner = blast.BlastRunner(max_workers=1, max_queued=0)
+        result = runner.run(["cat"], "  MKSH\r\nQFAS\n\n", timeout=10)
+        assert result.returncode == 0
+        assert result.stdout == b"MKSH\nQFAS\n"
+
+        # The same query is answered from the cache
+        assert runner.run(["cat"], "MKSH\nQFAS", timeout=10) is result
+
+        # Failed searches are not cached
+        assert runner.run(["false"], "MKSH", timeout=10).returncode != 0
+        wait_until_idle(runner)
+        assert len(runner._cache) == 1
+
+        # With the only worker taken, identical searches share the process
+        # and other searches are turned away
+        future = runner.submit(["sleep", "1"], "MKSH")
+        assert runner.submit(["sleep", "1"], "MKSH") is future
+        with self.assertRaises(blast.BlastQueueFull):
+            runner.submit(["sleep", "1"], "QFAS")
+        assert future.result(10).returncode == 0
+        wait_until_idle(runner)
+        assert runner.run(["cat"], "QFAS", timeout=10).returncode == 0
+
+    def test_blast_jobs(self):
+        names = ['qacc', 'sacc', 'pident', 'length']
+
+        def wait_for(jobs, job_id):
+            for i in range(100):
+                job = jobs.status(job_id)
+                if job['status'] != 'running':
+                    return job
+                time.sleep(0.1)
+            self.fail("The job did not finish")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            jobs = blast.BlastJobs(blast.BlastRunner(), tmp_dir)
+
+            # cat echoes the query, which is written as a blast hit table
+            job_id = jobs.submit(["cat"], "q1\tgene1\t99.5\t40\nq1\tgene2\t80.0\t20\n", names, {'e_value': 10})
+            job = wait_for(jobs, job_id)
+            assert job['status'] == 'finished'
+            assert job['total_hits'] == 2
+            assert job['form'] == {'e_value': 10}
+            hits = jobs.hits(job_id)
+            assert list(hits.index) == ["gene1", "gene2"]
+            assert list(hits['pident']) == [99.5, 80.0]
+
+            # A search without hits finishes with an empty hit table
+            job_id = jobs.submit(["true"], "MKSH", names, {})
+            job = wait_for(jobs, job_id)
+            assert job['status'] == 'finished'
+            assert job['total_hits'] == 0
+            assert len(jobs.hits(job_id)) == 0
+
+            job_id = jobs.submit(["false"], "MKSH", names, {})
+            assert wait_for(jobs, job_id)['status'] == 'failed'
+
+            assert jobs.status("0" * 32) is None
+            assert jobs.status("../job") is None
+
+            # A job running for too long is reported as failed
+            jobs = blast.BlastJobs(blast.BlastRunner(), tmp_dir, max_running=-1)
+            job_id = jobs.submit(["sleep", "1"], "MKSH", names, {})
+            assert jobs.status(job_id)['status'] == 'failed'
+            for i in range(100):
+                if 'returncode' in jobs.status(job_id):
+                    break
+                time.sleep(0.1)
+
+            # Old jobs are removed when a job is submitted
+            jobs = blast.BlastJobs(blast.BlastRunner(), tmp_dir, max_age=-1)
+            jobs.submit(["true"], "QFAS", names, {})
+            assert jobs.status(job_id) is None
+
+
+class CommittedTestCase(unittest.TestCase):
+    """Tests of loaders that work over connections of their own, which
+    only see what has been committed, so nothing is rolled back here"""
+    def setUp(self):
+        self.db = app.db
+        self.db.create_all()
+
+        self.session = self.db.session
+
+    def tearDown(self):
+        # clear the database
+        self.session.close()
+
+        self.db.drop_all()
+
+    def test_copy_gene_annotations_parallel(self):
+        reference_assembly = ReferenceAssembly("version 1")
+        pfam_source = AnnotationSource("Pfam", "v1.0", "rpsblast", "e_value=0.000001")
+        tigrfam_source = AnnotationSource("TigrFam", "v1.0", "rpsblast", "e_value=0.000001")
+        pfam1 = Pfam("pfam00001")
+        tigrfam1 = TigrFam("TIGR00001")
+        gene0 = Gene("gene0", reference_assembly)
+        self.session.add_all([reference_assembly, pfam_source, tigrfam_source, pfam1, tigrfam1, gene0])
+        self.session.commit()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pfam_path = os.path.join(tmp_dir, "all.pfam.standardized.tsv")
+            with open(pfam_path, 'w') as pfam_fh:
+                pfam_fh.write("gene0\tpfam00001\t2.9e-37\t123.5\n")
+                pfam_fh.write("gene1\tpfam00001\t2.4e-50\t165.0\n")
+                pfam_fh.write("gene2\tpfam00001\t2e-32\t108.1\n")
+                pfam_fh.write("gene3\tpfam99999\t2e-32\t108.1\n")
+            tigrfam_path = os.path.join(tmp_dir, "all.tigrfam.standardized.tsv")
+            with open(tigrfam_path, 'w') as tigrfam_fh:
+                tigrfam_fh.write("gene2\tTIGR00001\t1e-20\t80.0\n")
+                tigrfam_fh.write("gene4\tTIGR00001\t1e-10\t50.0\n")
+
+            annotation_ids = {"pfam00001": pfam1.id, "TIGR00001": tigrfam1.id}
+            gene_ids = {"gene0": gene0.id}
+            annotation_ingest.copy_gene_annotations(self.session,
+                    [("Pfam", pfam_path, pfam_source.id), ("TigrFam", tigrfam_path, tigrfam_source.id)],
+                    gene_ids, annotation_ids, reference_assembly.id, max_workers=2)
+
+        # gene2, in both files, is added once and gene3 only has an unknown annotation
+        genes = dict(self.session.query(Gene.name, Gene.id).all())
+        assert sorted(genes.keys()) == ["gene0", "gene1", "gene2", "gene4"]
+        assert gene_ids == genes
+
+        gene_annotations = self.session.query(Gene.name, Annotation.type_identifier, GeneAnnotation.annotation_source_id).\
+                join(GeneAnnotation, GeneAnnotation.gene_id == Gene.id).\
+                join(Annotation, GeneAnnotation.annotation_id == Annotation.id).all()
+        assert sorted(gene_annotations) == [
+                ("gene0", "pfam00001", pfam_source.id),
+                ("gene1", "pfam00001", pfam_source.id),
+                ("gene2", "TIGR00001", tigrfam_source.id),
+                ("gene2", "pfam00001", pfam_source.id),
+                ("gene4", "TIGR00001", tigrfam_source.id)]
@@ -7,7 +7,8 @@ import sys
 import logging
 import datetime
 
-from materialized_view_factory import refresh_all_mat_views
+from bulk_copy import defer_indexes, restore_indexes
+from gene_count_ingest import copy_gene_counts, sample_names
 
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
 
@@ -15,61 +16,48 @@ def main(args):
     # connect to database
     session = app.db.session()
 
-    # Fetch each gene from the gene count file and create the corresponding gene count
-    logging.info("Starting with gene counts")
-    gene_counts = pd.read_table(args.gene_counts, index_col=0)
-    total_gene_count_len = len(gene_counts)
-    val_cols = gene_counts.columns
-    nr_columns = len(val_cols)
-
-    commited_genes = {}
-    commited_genes.update(dict( session.query(Gene.name, Gene.id).all() ))
+    if args.bulk_load:
+        logging.info("Dropping indexes and constraints for the bulk load")
+        deferred_indexes = defer_indexes(session, ['gene_count'])
 
-    filtered_gene_counts = gene_counts
-    filtered_gene_counts['gene_name'] = filtered_gene_counts.index
-    filtered_gene_counts['gene_id'] = filtered_gene_counts['gene_name'].apply(lambda x: commited_genes[x])
+    # Stream the gene count matrix into the database a chunk of genes at a time
+    logging.info("Starting with gene counts")
+    commited_genes = dict( session.query(Gene.name, Gene.id).all() )
 
     all_samples = {}
     for sample in session.query(Sample).all():
         all_samples[sample.scilifelab_code] = sample
 
-    all_sample_ids = dict((sample_name, sample.id) for sample_name, sample in all_samples.items())
-    filtered_gene_counts.rename(columns=all_sample_ids, inplace=True)
-
-    sample_id_cols = filtered_gene_counts.columns.tolist()
-    sample_id_cols.remove('gene_id')
-    sample_id_cols.remove('gene_name')
-    sample_id_cols.remove('gene_length')
-    tot_nr_samples = len(sample_id_cols)
-
-    filtered_gene_counts.index = filtered_gene_counts['gene_id']
-    filtered_gene_counts = pd.DataFrame(filtered_gene_counts[sample_id_cols].stack())
-    filtered_gene_counts.reset_index(inplace=True)
-    filtered_gene_counts.columns = ['gene_id', 'sample_id', 'rpkm']
-
     logging.info("Start adding gene counts")
-
-    for i, sample_t in enumerate(filtered_gene_counts.groupby('sample_id')):
-        sample, sample_df = sample_t
-        with open(args.tmp_file, 'w') as gene_counts_file:
-            sample_df.to_csv(gene_counts_file, index=False, header=None)
-
-        logging.info("Adding gene counts from file. Sample {} ({}/{})".format(sample, i+1, tot_nr_samples))
-        session.execute("COPY gene_count (gene_id, sample_id, rpkm) FROM '{}' WITH CSV;".format(args.tmp_file))
-
-    logging.info("{} out of {} are annotated genes".format(len(filtered_gene_counts), total_gene_count_len))
+    nr_gene_counts = copy_gene_counts(session, args.gene_counts, commited_genes, all_samples)
+    logging.info("Added {} gene counts".format(nr_gene_counts))
     session.commit()
     logging.info("Commiting everything")
     session.commit()
-    logging.info("Refreshing materialized view")
-    refresh_all_mat_views()
+    if args.bulk_load:
+        logging.info("Rebuilding indexes and constraints")
+        restore_indexes(session, deferred_indexes)
+
+    if GeneCountVectorSample.in_use():
+        # Genes without a vector get one, the vectors of the other genes
+        # are not updated
+        nr_vectors = GeneCountVector.add_genes(commited_genes.values())
+        logging.info("Added {} gene count vectors".format(nr_vectors))
+        session.commit()
+        sample_ids = [all_samples[name].id for name in sample_names(args.gene_counts)]
+        if GeneCountVectorSample.query.filter(GeneCountVectorSample.sample_id.in_(sample_ids)).first() is not None:
+            logging.warning("Some samples already have gene count vectors, the counts updated "
+                    "for them are only in gene_count and not in the vectors")
+
+    logging.info("Updating the rpkm tables for the samples in the gene counts file")
+    update_sample_aggregates([all_samples[name].id for name in sample_names(args.gene_counts)])
     session.commit()
     logging.info("Finished!")
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--gene_counts", help="The gene counts, probably for all samples and sample sets")
-    parser.add_argument("--tmp_file", help="A file that will be used to import gene counts to postgres")
+    parser.add_argument("--bulk_load", action="store_true", help="Drop the indexes and constraints of the gene count table while loading and rebuild them afterwards")
     args = parser.parse_args()
 
     main(args)